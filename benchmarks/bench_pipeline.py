@@ -0,0 +1,435 @@
+"""
+Download/transcode pipeline benchmark, fully offline: a local stub media
+server (stub_server.py) plays the CDN and a yt-dlp fixture extractor
+(fixtures/yt_dlp_plugins) plays the site, so both engines run their real
+code paths against localhost.
+
+Each (engine, playlist size, format) runs in its own child process, so
+its peak RSS is its own. Per run it measures metadata latency (cold and
+cached), time-to-first-byte, per-track and aggregate fetch throughput,
+wall time, peak RSS of the process and of its running children (yt-dlp,
+FFmpeg) together, and what publishing progress events costs. A separate pass
+times one FFmpeg transcode of the fixture per output format.
+
+The fixture audio is generated with FFmpeg (a sine tone), which the
+transcode stage needs as well. Without FFmpeg only --fetch-only runs:
+synthetic bytes are served, each staged file is copied to its output
+instead of transcoded, and the transcode pass is skipped.
+
+    python benchmarks/bench_pipeline.py --sizes 10 100 1000 --json results.json
+    python benchmarks/bench_pipeline.py --engines inprocess subprocess --direct --compare results.json
+    python benchmarks/bench_pipeline.py --fetch-only --sizes 100
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Ensure src is in path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Compared by --compare: metric -> True when higher is better
+COMPARED = {
+    "metadata_s": False,
+    "ttfb_median_s": False,
+    "wall_s": False,
+    "aggregate_mb_s": True,
+    "tracks_per_s": True,
+    "track_mb_s_median": True,
+    "peak_rss_mb": False,
+    "emit_us_per_event": False,
+}
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def make_fixture(path: str, seconds: int, size: int) -> bool:
+    """
+    Write the audio served for every track. Returns False when FFmpeg
+    couldn't make real audio and `size` synthetic bytes were written instead.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg:
+        subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi",
+                        "-i", f"sine=frequency=440:duration={seconds}", "-ac", "2",
+                        "-c:a", "libmp3lame", "-b:a", "192k", path],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            return True
+    with open(path, "wb") as f:
+        # Starts like an MPEG audio frame; the rest is filler
+        f.write(b"\xff\xfb\x90\x64" + os.urandom(size - 4))
+    return False
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+class ChildRss:
+    """
+    Samples the summed RSS of this process's children (yt-dlp, FFmpeg) from /proc.
+    RUSAGE_CHILDREN can't stand in: a child's ru_maxrss keeps the parent's
+    high-water mark from before it exec'd. `peak_mb` stays None off Linux.
+    """
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="child-rss", daemon=True)
+
+    @staticmethod
+    def _rss_kb(pid: str) -> int:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            pass # Already exited
+        return 0
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            pids = set()
+            for path in glob.glob(f"/proc/{os.getpid()}/task/*/children"):
+                try:
+                    with open(path) as f:
+                        pids.update(f.read().split())
+                except OSError:
+                    pass
+            total = sum(self._rss_kb(pid) for pid in pids) / 1024
+            self.peak_mb = round(max(self.peak_mb or 0.0, total), 1)
+
+    def __enter__(self):
+        if os.path.exists(f"/proc/{os.getpid()}/task"):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+
+async def run_pipeline(cfg: dict) -> dict:
+    from src import events
+    from src.archive import DownloadArchive
+    from src.cache import MetadataCache
+    from src.core import Downloader
+    from src.jobs import JobStore
+
+    work = cfg["work_dir"]
+    out_dir = os.path.join(work, "out")
+    # Private state: nothing read from or written to ~/.music_dl
+    d = Downloader(jobs=cfg["jobs"], engine=cfg["engine"], direct=cfg["direct"],
+                   metadata_cache=MetadataCache(os.path.join(work, "metadata.db")),
+                   archive=DownloadArchive(os.path.join(work, "archive.db")),
+                   job_store=JobStore(os.path.join(work, "jobs.db")))
+    if cfg.get("fetch_only"):
+        # No FFmpeg: stage 2 just copies each staged file, so only the fetch stage is measured
+        async def copy_outputs(src, outputs, *args, **kwargs):
+            for dest, _, _ in outputs:
+                await asyncio.to_thread(shutil.copyfile, src, dest)
+            return True
+        d._transcode = copy_outputs
+
+    # Every event, timestamped when it's published; the time spent publishing
+    # it (subscribers plus the text callback) is the progress overhead
+    timeline = []
+    overhead = [0.0]
+    publish = d._emit
+    def timed_emit(event, progress_callback=None):
+        started = time.perf_counter()
+        publish(event, progress_callback)
+        overhead[0] += time.perf_counter() - started
+        timeline.append((started, event.kind, event.phase, event.track_id, event.bytes_done))
+    d._emit = timed_emit
+
+    # A UI-like subscriber draining the bus, and a text callback like the CLI's
+    queue = d.events.subscribe()
+    async def drain():
+        while await queue.get() is not None:
+            pass
+    drainer = asyncio.create_task(drain())
+    sink = open(os.devnull, "w")
+    def callback(message):
+        sink.write(message + "\n")
+
+    url = cfg["url"]
+    started = time.perf_counter()
+    tracks = await d.get_metadata(url, refresh=True)
+    metadata_s = time.perf_counter() - started
+    started = time.perf_counter()
+    await d.get_metadata(url)
+    metadata_cached_s = time.perf_counter() - started
+
+    timeline.clear()
+    overhead[0] = 0.0
+    started = time.perf_counter()
+    with ChildRss() as children:
+        report = await d.download_tracks(tracks, out_dir, cfg["format"], callback, url=url)
+    wall = time.perf_counter() - started
+
+    d.events.unsubscribe(queue)
+    await drainer
+    sink.close()
+
+    # Per track: fetch start, first byte, fetch end (staged: handed to FFmpeg; direct: written), size
+    fetch_start, first_byte, fetch_end, size = {}, {}, {}, {}
+    for at, kind, phase, key, done in timeline:
+        if kind == events.TRACK and phase == events.FETCHING:
+            fetch_start.setdefault(key, at)
+        elif kind == events.PROGRESS and done:
+            first_byte.setdefault(key, at)
+            size[key] = max(size.get(key, 0), done)
+        elif kind == events.TRACK and phase in (events.TRANSCODING, events.FINISHED):
+            fetch_end.setdefault(key, at)
+    ttfb = [first_byte[k] - fetch_start[k] for k in first_byte if k in fetch_start]
+    per_track = [size[k] / 1e6 / (fetch_end[k] - fetch_start[k])
+                 for k in size if k in fetch_start and k in fetch_end and fetch_end[k] > fetch_start[k]]
+    total_bytes = sum(size.values())
+    n_events = len(timeline)
+
+    return {
+        "engine": cfg["engine"],
+        "tracks": len(tracks),
+        "format": cfg["format"],
+        "direct": cfg["direct"],
+        "fetch_only": bool(cfg.get("fetch_only")),
+        "jobs": cfg["jobs"],
+        "completed": len(report.completed),
+        "failed": len(report.failed),
+        "metadata_s": round(metadata_s, 4),
+        "metadata_cached_s": round(metadata_cached_s, 4),
+        "first_byte_s": round(min(first_byte.values()) - started, 4) if first_byte else None,
+        "ttfb_median_s": round(statistics.median(ttfb), 4) if ttfb else None,
+        "ttfb_p95_s": round(percentile(ttfb, 0.95), 4) if ttfb else None,
+        "track_mb_s_median": round(statistics.median(per_track), 2) if per_track else None,
+        "track_mb_s_p5": round(percentile(per_track, 0.05), 2) if per_track else None,
+        "wall_s": round(wall, 3),
+        "aggregate_mb_s": round(total_bytes / 1e6 / wall, 2),
+        "tracks_per_s": round(len(report.completed) / wall, 2),
+        "fetch_busy_s": round(report.stats.fetch.busy, 3),
+        "transcode_busy_s": round(report.stats.transcode.busy, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_children_rss_mb": children.peak_mb,
+        "events": n_events,
+        "emit_s": round(overhead[0], 4),
+        "emit_us_per_event": round(overhead[0] / n_events * 1e6, 2) if n_events else None,
+        "emit_share": round(overhead[0] / wall, 5),
+    }
+
+async def run_transcode(cfg: dict) -> list:
+    from src.archive import DownloadArchive
+    from src.cache import MetadataCache
+    from src.core import Downloader
+    from src.jobs import JobStore
+
+    work = cfg["work_dir"]
+    d = Downloader(metadata_cache=MetadataCache(os.path.join(work, "metadata.db")),
+                   archive=DownloadArchive(os.path.join(work, "archive.db")),
+                   job_store=JobStore(os.path.join(work, "jobs.db")))
+    results = []
+    for format in cfg["formats"]:
+        times, ok, size = [], False, None
+        for i in range(cfg["runs"]):
+            dest = os.path.join(work, f"transcode_{i}.{format}")
+            started = time.perf_counter()
+            ok = await d._transcode(cfg["media"], [(dest, format, False)])
+            times.append(time.perf_counter() - started)
+            if not ok:
+                break
+            size = os.path.getsize(dest)
+            os.remove(dest)
+        results.append({
+            "format": format,
+            "ok": ok,
+            "runs": len(times),
+            "median_s": round(statistics.median(times), 4),
+            "min_s": round(min(times), 4),
+            "realtime_x": round(cfg["seconds"] / statistics.median(times), 1) if ok else None,
+            "output_bytes": size if ok else None,
+        })
+    return results
+
+def child(cfg: dict):
+    sys.path.insert(0, FIXTURES) # Fixture extractor for the in-process engine
+    if cfg["kind"] == "transcode":
+        result = asyncio.run(run_transcode(cfg))
+    else:
+        result = asyncio.run(run_pipeline(cfg))
+    # Last line of stdout; anything the Downloader printed comes before it
+    print(json.dumps(result))
+
+def spawn(cfg: dict, env: dict):
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(cfg)],
+                             capture_output=True, text=True, env=env)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        print(f"[WARNING] Benchmark run failed: {cfg}")
+        print(process.stderr.strip()[-2000:])
+        return None
+    return json.loads(lines[-1])
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results: dict, baseline_path: str, threshold: float) -> int:
+    """
+    Print how each run's metrics moved against a baseline results file.
+    Returns the number of regressions worse than `threshold` percent.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    def run_key(r):
+        return (r["engine"], r["tracks"], r["format"], r["direct"], r["jobs"], r.get("fetch_only", False))
+    before = {run_key(r): r for r in baseline.get("runs", [])}
+
+    regressions = 0
+    print(f"\nAgainst {baseline_path} (commit {baseline.get('meta', {}).get('commit')}):")
+    for r in results["runs"]:
+        old = before.get(run_key(r))
+        if old is None:
+            continue
+        changes = []
+        for metric, higher_is_better in COMPARED.items():
+            if not old.get(metric) or r.get(metric) is None:
+                continue
+            change = (r[metric] - old[metric]) / old[metric] * 100
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            changes.append(f"{metric} {change:+.1f}%{flag}")
+        print(f"  {r['engine']:<10} {r['tracks']:>5} {r['format']:<5} {'direct' if r['direct'] else 'staged'}: "
+              + ", ".join(changes))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Playlist sizes")
+    parser.add_argument("--engines", nargs="+", default=["inprocess"], choices=["inprocess", "subprocess"])
+    parser.add_argument("--formats", nargs="+", default=["mp3"], help="Output formats of the pipeline runs")
+    parser.add_argument("--direct", action="store_true", help="Pipe sources straight into FFmpeg (no staged files)")
+    parser.add_argument("--fetch-only", action="store_true",
+                        help="Copy staged files instead of transcoding them: fetch timings, no FFmpeg needed")
+    parser.add_argument("-j", "--jobs", type=int, default=4)
+    parser.add_argument("--seconds", type=int, default=30, help="Length of the fixture audio")
+    parser.add_argument("--track-size", type=int, default=720_000,
+                        help="Bytes per track with --fetch-only and no FFmpeg to generate the fixture")
+    parser.add_argument("--ttfb", type=float, default=0.0, help="Server delay before each media response (s)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Server bytes/s per connection (0: unlimited)")
+    parser.add_argument("--transcode-formats", nargs="*", default=["mp3", "flac", "wav", "opus", "m4a"],
+                        help="Formats for the transcode pass (none: skip it)")
+    parser.add_argument("--transcode-runs", type=int, default=3)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--compare", help="Baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="With --compare, exit non-zero when a metric is this many percent worse")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(json.loads(args.child))
+        return
+    if args.transcode_runs < 1:
+        parser.error("--transcode-runs must be at least 1")
+    if args.fetch_only and args.direct:
+        parser.error("--fetch-only needs staged files: it can't be combined with --direct")
+
+    from stub_server import StubMediaServer
+    import yt_dlp
+
+    work = tempfile.mkdtemp(prefix="bench_pipeline_")
+    media = os.path.join(work, "fixture.mp3")
+    real_audio = make_fixture(media, args.seconds, args.track_size)
+    if not real_audio and not args.fetch_only:
+        shutil.rmtree(work, ignore_errors=True)
+        sys.exit("FFmpeg is required to generate the fixture audio and run the transcode stage "
+                 "(use --fetch-only to time the fetch stage without it)")
+    with open(media, "rb") as f:
+        server = StubMediaServer(f.read(), duration=args.seconds, ttfb=args.ttfb, rate=args.rate).start()
+
+    # Fixture extractor for yt-dlp subprocesses (the subprocess engine)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (FIXTURES, env.get("PYTHONPATH")) if p)
+
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "yt_dlp": yt_dlp.version.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "real_audio": real_audio,
+            "fetch_only": args.fetch_only,
+            "track_bytes": len(server.media),
+            "args": {k: v for k, v in vars(args).items() if k not in ("child", "json", "compare")},
+        },
+        "runs": [],
+        "transcode": [],
+    }
+
+    print(f"{'engine':<10} {'tracks':>6} {'fmt':<5} {'mode':<6} {'meta s':>7} {'ttfb s':>7} "
+          f"{'trk MB/s':>8} {'MB/s':>7} {'trk/s':>6} {'wall s':>7} {'RSS MB':>7} {'kids':>6} {'us/evt':>7} {'ok':>5}")
+    try:
+        for engine in args.engines:
+            for n in args.sizes:
+                for format in args.formats:
+                    run_dir = tempfile.mkdtemp(dir=work)
+                    server.reset_counters()
+                    r = spawn({"kind": "pipeline", "engine": engine, "format": format, "direct": args.direct,
+                               "jobs": args.jobs, "work_dir": run_dir, "fetch_only": args.fetch_only,
+                               "url": f"benchfixture://{server.address}/playlist/{n}"}, env)
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                    if r is None:
+                        continue
+                    r["server_requests"] = server.requests
+                    results["runs"].append(r)
+                    print(f"{engine:<10} {n:>6} {format:<5} {'direct' if args.direct else 'staged':<6} "
+                          f"{r['metadata_s']:>7} {r['ttfb_median_s']!s:>7} {r['track_mb_s_median']!s:>8} "
+                          f"{r['aggregate_mb_s']:>7} {r['tracks_per_s']:>6} {r['wall_s']:>7} "
+                          f"{r['peak_rss_mb']:>7} {r['peak_children_rss_mb']!s:>6} {r['emit_us_per_event']!s:>7} "
+                          f"{r['completed']:>5}")
+
+        if args.transcode_formats and not args.fetch_only:
+            transcode = spawn({"kind": "transcode", "formats": args.transcode_formats, "runs": args.transcode_runs,
+                               "media": media, "seconds": args.seconds, "work_dir": work}, env)
+            if transcode:
+                results["transcode"] = transcode
+                print(f"\n{'format':<6} {'median s':>9} {'min s':>7} {'x realtime':>11} {'bytes':>10}")
+                for t in transcode:
+                    print(f"{t['format']:<6} {t['median_s']:>9} {t['min_s']:>7} {t['realtime_x']!s:>11} "
+                          f"{t['output_bytes']!s:>10}")
+    finally:
+        server.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
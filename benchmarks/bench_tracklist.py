@@ -0,0 +1,101 @@
+"""
+Memory per track for large listings: list of dict-backed objects (the old
+TrackInfo), list of slotted TrackInfo, and the columnar TrackList.
+TrackList's figure includes its lookup indexes; the lists' doesn't.
+
+    python benchmarks/bench_tracklist.py --sizes 100000 1000000
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Ensure src is in path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.core import TrackInfo, TrackList
+
+class DictTrackInfo:
+    # TrackInfo as it was before __slots__
+    def __init__(self, title, artist, duration, url, index, source_id=None):
+        self.title = title
+        self.artist = artist
+        self.duration = duration
+        self.url = url
+        self.index = index
+        self.source_id = source_id
+
+def fake_entries(n: int, channels: int = 50):
+    # Shaped like a flat yt-dlp channel listing; each entry is dropped after use
+    for i in range(n):
+        video_id = f"{i:011d}"
+        yield (f"Track number {i} (Official Audio)", f"Channel {i % channels}", 180 + i % 240,
+               f"https://www.youtube.com/watch?v={video_id}", i + 1, f"youtube:{video_id}")
+
+def build(kind: str, n: int):
+    if kind == "dict":
+        return [DictTrackInfo(*e) for e in fake_entries(n)]
+    if kind == "slots":
+        return [TrackInfo(*e) for e in fake_entries(n)]
+    return TrackList(TrackInfo(*e) for e in fake_entries(n))
+
+def measure(kind: str, n: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    tracks = build(kind, n)
+    build_time = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Lookups: by playlist index and by source id
+    probes = range(1, n + 1, max(1, n // 1000))
+    if kind == "columnar":
+        started = time.perf_counter()
+        for i in probes:
+            tracks.by_index(i)
+            tracks.by_source_id(f"youtube:{i - 1:011d}")
+    else:
+        by_source = {t.source_id: t for t in tracks} # What a list needs for O(1) lookups (not counted above)
+        started = time.perf_counter()
+        for i in probes:
+            tracks[i - 1]
+            by_source[f"youtube:{i - 1:011d}"]
+    lookup_us = (time.perf_counter() - started) / len(probes) * 1e6
+    del tracks
+
+    return {
+        "kind": kind,
+        "tracks": n,
+        "bytes_per_track": round(current / n, 1),
+        "peak_bytes_per_track": round(peak / n, 1),
+        "build_s": round(build_time, 3),
+        "lookup_us": round(lookup_us, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--kinds", nargs="+", default=["dict", "slots", "columnar"],
+                        choices=["dict", "slots", "columnar"])
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'kind':<10} {'tracks':>9} {'B/track':>9} {'peak B/track':>13} {'build s':>8} {'lookup us':>10}")
+    for n in args.sizes:
+        for kind in args.kinds:
+            r = measure(kind, n)
+            results.append(r)
+            print(f"{r['kind']:<10} {r['tracks']:>9} {r['bytes_per_track']:>9} "
+                  f"{r['peak_bytes_per_track']:>13} {r['build_s']:>8} {r['lookup_us']:>10}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+yt-dlp extractor for the benchmark stub server (benchmarks/stub_server.py).
+yt-dlp loads it as a plugin when benchmarks/fixtures is on sys.path or
+PYTHONPATH, which bench_pipeline.py arranges for both engines.
+
+    benchfixture://HOST:PORT/playlist/N    a playlist of N tracks
+    benchfixture://HOST:PORT/track/I       one track, a single plain HTTP audio format
+"""
+from yt_dlp.extractor.common import InfoExtractor
+
+class BenchFixtureIE(InfoExtractor):
+    IE_NAME = 'benchfixture'
+    _VALID_URL = r'benchfixture://(?P<host>[^/]+)/(?P<kind>playlist|track)/(?P<id>\d+)'
+
+    def _real_extract(self, url):
+        host, kind, item_id = self._match_valid_url(url).group('host', 'kind', 'id')
+        data = self._download_json(f'http://{host}/{kind}/{item_id}.json', item_id)
+
+        if kind == 'playlist':
+            entries = (
+                self.url_result(f'benchfixture://{host}/track/{e["id"]}', BenchFixtureIE, str(e['id']), e['title'],
+                                uploader=e['artist'], duration=e['duration'])
+                for e in data['entries']
+            )
+            return self.playlist_result(entries, f'playlist-{item_id}', f'Fixture playlist of {item_id} tracks')
+
+        return {
+            'id': item_id,
+            'title': data['title'],
+            'uploader': data['artist'],
+            'duration': data['duration'],
+            'formats': [{
+                'format_id': data['ext'],
+                'url': f'http://{host}/media/{item_id}.{data["ext"]}',
+                'ext': data['ext'],
+                'acodec': data['acodec'],
+                'vcodec': 'none',
+                'filesize': data['size'],
+            }],
+        }
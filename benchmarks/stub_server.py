@@ -0,0 +1,160 @@
+"""
+Local stand-in for a media host, for the pipeline benchmarks. Serves
+
+    /playlist/N.json    a listing of N tracks
+    /track/I.json       one track's metadata (what the fixture extractor reads)
+    /media/I.EXT        the track's audio: the same fixture file for every I
+
+over HTTP/1.1 with keep-alive and Range requests (If-Range against an ETag
+of the content; `ranges=False` serves whole files only). Media responses can
+be delayed (`ttfb`, seconds before the headers) and throttled (`rate`,
+bytes/s per connection) to look more like a real CDN. The tests use it too.
+
+    python benchmarks/stub_server.py --port 8790 --media fixture.mp3
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK = 64 * 1024
+
+class StubMediaServer:
+    def __init__(self, media: bytes, ext: str = "mp3", acodec: str = "mp3", duration: int = 30,
+                 host: str = "127.0.0.1", port: int = 0, ttfb: float = 0.0, rate: float = 0.0,
+                 ranges: bool = True):
+        self.set_media(media)
+        self.ext = ext
+        self.acodec = acodec
+        self.duration = duration
+        self.ttfb = ttfb
+        self.rate = rate
+        self.ranges = ranges
+        self.log = [] # (path, Range header) of every media request
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def set_media(self, media: bytes):
+        """
+        Replace the file served for every track; its ETag changes with it.
+        """
+        self.media = media
+        self.etag = '"%s"' % hashlib.md5(media).hexdigest()[:16]
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = self.bytes_sent = 0
+            self.log = []
+
+    def _count(self, sent: int):
+        with self._lock:
+            self.bytes_sent += sent
+
+    def track(self, i: int) -> dict:
+        return {"id": i, "title": f"Fixture track {i}", "artist": f"Fixture artist {i % 20}",
+                "duration": self.duration, "size": len(self.media), "ext": self.ext, "acodec": self.acodec}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, like a real CDN
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str, extra: dict = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (extra or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                started = time.monotonic()
+                for pos in range(0, len(body), CHUNK):
+                    self.wfile.write(body[pos:pos + CHUNK])
+                    server._count(min(CHUNK, len(body) - pos))
+                    if server.rate:
+                        # Pace to `rate` bytes/s for this connection
+                        ahead = (pos + CHUNK) / server.rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                match = re.fullmatch(r"/(playlist|track)/(\d+)\.json", self.path)
+                if match:
+                    n = int(match.group(2))
+                    if match.group(1) == "playlist":
+                        payload = {"entries": [server.track(i) for i in range(1, n + 1)]}
+                    else:
+                        payload = server.track(n)
+                    self._send(200, json.dumps(payload).encode(), "application/json")
+                    return
+                if re.fullmatch(r"/media/\d+\.\w+", self.path):
+                    with server._lock:
+                        server.log.append((self.path, self.headers.get("Range")))
+                    if server.ttfb:
+                        time.sleep(server.ttfb)
+                    media, etag = server.media, server.etag
+                    body, status, extra = media, 200, {"ETag": etag}
+                    wanted = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+                    if server.ranges:
+                        extra["Accept-Ranges"] = "bytes"
+                    if server.ranges and wanted and self.headers.get("If-Range") in (None, etag):
+                        start = int(wanted.group(1))
+                        end = min(int(wanted.group(2) or len(body) - 1), len(body) - 1)
+                        body, status = body[start:end + 1], 206
+                        extra["Content-Range"] = f"bytes {start}-{end}/{len(media)}"
+                    self._send(status, body, "audio/mpeg", extra)
+                    return
+                self._send(404, b"not found", "text/plain")
+
+        return Handler
+
+    def start(self) -> "StubMediaServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="stub-media", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--media", help="Audio file served for every track (default: 1 MB of zeros)")
+    parser.add_argument("--ttfb", type=float, default=0.0, help="Seconds before each media response")
+    parser.add_argument("--rate", type=float, default=0.0, help="Bytes/s per connection (0: unlimited)")
+    args = parser.parse_args()
+
+    if args.media:
+        with open(args.media, "rb") as f:
+            media = f.read()
+        ext = os.path.splitext(args.media)[1][1:] or "mp3"
+    else:
+        media, ext = bytes(1024 * 1024), "mp3"
+    server = StubMediaServer(media, ext, ext, port=args.port, ttfb=args.ttfb, rate=args.rate)
+    print(f"Serving on http://{server.address} (benchfixture://{server.address}/playlist/N)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
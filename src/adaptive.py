@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# yt-dlp / urllib error text for "slow down" responses
+THROTTLED_RE = re.compile(r'\b429\b|Too Many Requests', re.IGNORECASE)
+
+def is_throttled(message: str) -> bool:
+    return bool(THROTTLED_RE.search(message or ""))
+
+def parse_rate(text: Optional[str]) -> Optional[float]:
+    """
+    "500K", "2M", "1.5MB", "800000" -> bytes per second (None for empty).
+    """
+    if not text:
+        return None
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)i?B?(?:/s)?\s*', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid rate '{text}' (e.g. 500K, 2M)")
+    factor = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[match.group(2).upper()]
+    return float(match.group(1)) * factor
+
+class AdaptiveLimit:
+    """
+    Async semaphore whose capacity can be changed while it is in use.
+    Lowering the limit never interrupts holders; it just stops admitting
+    new ones until enough have left.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters = collections.deque()
+
+    async def __aenter__(self):
+        while self.active >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    self._wake() # Woken just before the cancel: pass the slot on
+                raise
+        self.active += 1
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        self._wake()
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+class SharedBandwidth:
+    """
+    A bandwidth cap (bytes/s) shared by every fetch in flight, as one token
+    bucket: fetches that pace themselves (fetch.py, the subprocess engine's
+    pipe) call take()/wait() for each chunk, so between them they get the
+    whole cap however many are running. yt-dlp's own downloaders only take
+    a fixed rate; share() gives them the cap split over the fetches active
+    when they start.
+    """
+    def __init__(self, rate: float, active: Callable[[], int] = lambda: 1, burst: float = 0.25):
+        self.rate = rate
+        self.active = active
+        self.burst = burst # Seconds of unused bandwidth that can be caught up on
+        self._next = time.monotonic() # When the bytes taken so far are paid for
+        self._lock = threading.Lock() # take() is called from worker threads
+
+    def _reserve(self, n: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now - self.burst) + n / self.rate
+            return self._next - now
+
+    def take(self, n: int):
+        """
+        Blocking: for worker threads.
+        """
+        delay = self._reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait(self, n: int):
+        delay = self._reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def share(self) -> float:
+        return self.rate / max(1, self.active())
+
+class HostState:
+    """
+    Controller state for one host: its limit plus the counters of the current window.
+    """
+    def __init__(self, limit: int):
+        self.slot = AdaptiveLimit(limit)
+        self.window_start = time.monotonic()
+        self.bytes = 0
+        self.ok = 0
+        self.failed = 0
+        self.throttled = 0
+        self.rate = 0.0 # Throughput of the last finished window (bytes/s)
+        self.last_increase = False
+        self.backed_off_at = float('-inf')
+
+class ConcurrencyController:
+    """
+    AIMD control of in-flight track downloads, per host.
+    Every `window` seconds each host's throughput and error rate are checked:
+      - any 429 (or more than `max_error_ratio` failures): halve the limit
+        right away (at most once per window)
+      - all slots busy, bytes flowing, throughput not worse than before and
+        under the bandwidth cap: one more slot
+      - the last extra slot made throughput drop: take it back
+    Limits stay within [min_jobs, max_jobs]. With a `bandwidth_cap` (bytes/s),
+    every download draws from one SharedBandwidth (`rate_per_track`).
+    `on_change(host, old, new, reason)` is called for every adjustment.
+    """
+    def __init__(self, min_jobs: int = 1, max_jobs: int = 16, start: Optional[int] = None,
+                 bandwidth_cap: Optional[float] = None, window: float = 3.0,
+                 max_error_ratio: float = 0.25, on_change: Optional[Callable[[str, int, int, str], None]] = None):
+        self.min_jobs = max(1, min_jobs)
+        self.max_jobs = max(self.min_jobs, max_jobs)
+        self.start = min(max(start or self.min_jobs, self.min_jobs), self.max_jobs)
+        self.bandwidth_cap = bandwidth_cap
+        self.bandwidth = SharedBandwidth(bandwidth_cap, lambda: self.active) if bandwidth_cap else None
+        self.window = window
+        self.max_error_ratio = max_error_ratio
+        self.on_change = on_change
+        self.hosts: Dict[str, HostState] = {}
+
+    def _host(self, host: str) -> HostState:
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.start)
+        return self.hosts[host]
+
+    def slot(self, host: str) -> AdaptiveLimit:
+        return self._host(host).slot
+
+    @property
+    def active(self) -> int:
+        return sum(h.slot.active for h in self.hosts.values())
+
+    @property
+    def total_rate(self) -> float:
+        return sum(h.rate for h in self.hosts.values())
+
+    def rate_per_track(self) -> Optional[SharedBandwidth]:
+        """
+        The `rate_limit` for one download (None = no cap): the shared bucket
+        itself, so the cap is split over whatever is in flight chunk by chunk.
+        """
+        return self.bandwidth
+
+    def add_bytes(self, host: str, n: int):
+        state = self._host(host)
+        state.bytes += n
+        self._maybe_adjust(host, state)
+
+    def record(self, host: str, ok: bool, throttled: bool = False):
+        """
+        Outcome of one fetch attempt.
+        """
+        state = self._host(host)
+        if ok:
+            state.ok += 1
+        else:
+            state.failed += 1
+        if throttled:
+            state.throttled += 1
+            # Back off now instead of at the end of the window, but only once per
+            # window: the other requests in flight went out before the limit dropped
+            if time.monotonic() - state.backed_off_at >= self.window:
+                self._end_window(host, state)
+                return
+        self._maybe_adjust(host, state)
+
+    def _maybe_adjust(self, host: str, state: HostState):
+        if time.monotonic() - state.window_start >= self.window:
+            self._end_window(host, state)
+
+    def _set(self, host: str, state: HostState, limit: int, reason: str):
+        old = state.slot.limit
+        limit = min(max(limit, self.min_jobs), self.max_jobs)
+        state.last_increase = limit > old
+        if limit != old:
+            state.slot.set_limit(limit)
+            if self.on_change:
+                self.on_change(host, old, limit, reason)
+
+    def _end_window(self, host: str, state: HostState):
+        now = time.monotonic()
+        elapsed = now - state.window_start
+        rate = state.bytes / elapsed if elapsed > 0 else 0.0
+        attempts = state.ok + state.failed
+        limit = state.slot.limit
+
+        if state.throttled:
+            self._set(host, state, limit // 2, "throttled (429)")
+            state.backed_off_at = now
+        elif attempts and state.failed / attempts > self.max_error_ratio:
+            self._set(host, state, limit // 2, f"{state.failed}/{attempts} failed")
+        elif state.last_increase and state.rate and rate < state.rate * 0.8:
+            self._set(host, state, limit - 1, "throughput dropped")
+        elif (rate and state.slot.active >= limit and (not state.rate or rate >= state.rate * 0.9)
+              and (not self.bandwidth_cap or self.total_rate < self.bandwidth_cap * 0.9)):
+            self._set(host, state, limit + 1, "saturated")
+        else:
+            state.last_increase = False
+
+        state.rate = rate
+        state.window_start = now
+        state.bytes = state.ok = state.failed = state.throttled = 0
+
+    def describe(self) -> str:
+        """
+        One-line controller state, e.g. for progress output.
+        """
+        if not self.hosts:
+            return f"{self.min_jobs}-{self.max_jobs} jobs per host"
+        parts = [f"{host} {h.slot.active}/{h.slot.limit} jobs {h.rate / 1e6:.2f} MB/s"
+                 for host, h in self.hosts.items()]
+        cap = f", cap {self.bandwidth_cap / 1e6:.2f} MB/s" if self.bandwidth_cap else ""
+        return "; ".join(parts) + cap
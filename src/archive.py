@@ -0,0 +1,87 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from src.cache import DEFAULT_STATE_DIR
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class DownloadArchive:
+    """
+    Local index of finished downloads: (source id, format, output dir) -> file path + hash.
+    Lets the downloader skip tracks it already produced without touching the network.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(DEFAULT_STATE_DIR, "archive.db")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS archive (
+                source_id TEXT NOT NULL,
+                format TEXT NOT NULL,
+                output_dir TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (source_id, format, output_dir)
+            )
+        """)
+        self._db.commit()
+
+    def lookup(self, source_id: str, format: str, output_dir: str, verify: bool = False) -> Optional[str]:
+        """
+        Path of the archived file, or None if it was never downloaded or has
+        since been deleted/changed. Size is always checked; `verify` also re-hashes the file.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT path, size, sha256 FROM archive WHERE source_id = ? AND format = ? AND output_dir = ?",
+                (source_id, format, os.path.abspath(output_dir))
+            ).fetchone()
+        if row is None:
+            return None
+        path, size, sha256 = row
+        try:
+            if os.path.getsize(path) != size:
+                return None
+        except OSError:
+            return None
+        if verify and file_sha256(path) != sha256:
+            return None
+        return path
+
+    def record(self, source_id: str, format: str, output_dir: str, path: str):
+        """
+        Add a finished file. Hashes the whole file, so call it off the event loop.
+        """
+        sha256 = file_sha256(path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO archive (source_id, format, output_dir, path, size, sha256, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source_id, format, os.path.abspath(output_dir), os.path.abspath(path),
+                 os.path.getsize(path), sha256, time.time())
+            )
+            self._db.commit()
+
+    def forget(self, source_id: str, format: str, output_dir: str):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM archive WHERE source_id = ? AND format = ? AND output_dir = ?",
+                (source_id, format, os.path.abspath(output_dir))
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
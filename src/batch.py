@@ -0,0 +1,103 @@
+import asyncio
+import time
+from typing import Callable, Iterable, List, Optional
+
+from src.core import DownloadReport, Downloader
+
+class BatchJob:
+    """
+    One line of a batch file: `URL [FORMAT] [ITEMS]`.
+    """
+    def __init__(self, url: str, format: str, items: Optional[str] = None, line: int = 0):
+        self.url = url
+        self.format = format
+        self.items = items # e.g. "1,3,5-10"
+        self.line = line
+        self.report: Optional[DownloadReport] = None
+        self.error: Optional[str] = None
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return f"<BatchJob {self.url} {self.format} {self.items or 'all'}>"
+
+def parse_batch(lines: Iterable[str], default_format: str, formats: List[str]) -> List[BatchJob]:
+    """
+    Parse batch file lines. Blank lines and lines starting with # are ignored.
+    The optional second field is a format (or a comma-separated list of
+    formats) if it names them, otherwise it's ITEMS.
+    """
+    jobs = []
+    for lineno, raw in enumerate(lines, 1):
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        url, rest = fields[0], fields[1:]
+        format = default_format
+        if rest and all(f in formats for f in rest[0].split(",")):
+            format = rest.pop(0)
+        items = rest.pop(0) if rest else None
+        if rest:
+            raise ValueError(f"line {lineno}: expected 'URL [FORMAT] [ITEMS]', got '{line}'")
+        jobs.append(BatchJob(url, format, items, lineno))
+    return jobs
+
+async def run_batch(downloader: Downloader,
+                    jobs: List[BatchJob],
+                    output_dir: str,
+                    parse_items: Callable[[Optional[str]], Optional[List[int]]],
+                    progress_callback: Optional[Callable[[BatchJob, str], None]] = None,
+                    url_concurrency: Optional[int] = None) -> List[BatchJob]:
+    """
+    Run every job on one Downloader. Tracks from all URLs share its global
+    fetch/transcode limits; `url_concurrency` caps how many URLs are being
+    listed and scheduled at once (default: the Downloader's job limit).
+    """
+    url_slots = asyncio.Semaphore(url_concurrency or downloader.jobs)
+
+    async def run(job: BatchJob):
+        async with url_slots:
+            if downloader.is_cancelled:
+                job.error = "Cancelled"
+                return
+            started = time.monotonic()
+            try:
+                job.report = await downloader.download(
+                    url=job.url,
+                    output_dir=output_dir,
+                    format=job.format,
+                    track_indices=parse_items(job.items),
+                    progress_callback=(lambda msg: progress_callback(job, msg)) if progress_callback else None
+                )
+            except Exception as e:
+                job.error = str(e)
+            job.elapsed = time.monotonic() - started
+
+    await asyncio.gather(*(run(job) for job in jobs))
+    return jobs
+
+def summarize(jobs: List[BatchJob], elapsed: float) -> List[str]:
+    """
+    Human-readable summary lines for a finished batch.
+    """
+    lines = []
+    completed = failed = skipped = errors = 0
+    for job in jobs:
+        if job.report is not None:
+            r = job.report
+            completed += len(r.completed)
+            failed += len(r.failed)
+            skipped += len(r.skipped)
+            status = f"{len(r.completed)} ok, {len(r.failed)} failed, {len(r.skipped)} skipped"
+            if not r.total and not r.skipped:
+                status = "no tracks found"
+        elif job.error:
+            errors += 1
+            status = f"ERROR: {job.error}"
+        else:
+            # spotdl fallback doesn't produce a per-track report
+            status = "done"
+        lines.append(f"  [{job.line}] {job.url} ({job.format}): {status} in {job.elapsed:.1f}s")
+    lines.append(f"Total: {len(jobs)} URLs, {completed} tracks downloaded, {failed} failed, "
+                 f"{skipped} skipped, {errors} URLs with errors, {elapsed:.1f}s")
+    return lines
@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Where the app keeps its local state (metadata cache, etc.)
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".music_dl")
+
+# Query parameters that don't change what a URL points to
+TRACKING_PARAMS = {'si', 'feature', 'pp', 't', 'ab_channel', 'fbclid', 'gclid', 'ref'}
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of a source URL, so share links, mobile links and
+    tracking parameters all map to the same cache entry.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip("/") or "/"
+    query = parse_qsl(parts.query)
+
+    # youtu.be/<id> -> youtube.com/watch?v=<id>
+    if host == "youtu.be" and path != "/":
+        query.append(("v", path.lstrip("/")))
+        host, path = "youtube.com", "/watch"
+
+    query = sorted((k, v) for k, v in query if k not in TRACKING_PARAMS and not k.startswith("utm_"))
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+class MetadataCache:
+    """
+    On-disk cache of extracted playlist metadata, keyed by normalized URL
+    (plus an optional namespace for other per-URL data, e.g. Spotify matches).
+    Entries expire after `ttl` seconds; once the stored payloads exceed
+    `max_bytes`, the least recently used entries are evicted.
+    """
+    def __init__(self, path: Optional[str] = None, ttl: float = 24 * 3600, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path or os.path.join(DEFAULT_STATE_DIR, "metadata.db")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # get_metadata runs in worker threads, so share one connection behind a lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+
+    @staticmethod
+    def _key(url: str, namespace: str) -> str:
+        key = normalize_url(url)
+        return f"{namespace}:{key}" if namespace else key
+
+    def get(self, url: str, namespace: str = "") -> Optional[Any]:
+        key = self._key(url, namespace)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT payload, created FROM metadata WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._db.execute("DELETE FROM metadata WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE metadata SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, url: str, value: Any, namespace: str = ""):
+        key = self._key(url, namespace)
+        payload = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO metadata (key, payload, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def invalidate(self, url: str, namespace: str = ""):
+        with self._lock:
+            self._db.execute("DELETE FROM metadata WHERE key = ?", (self._key(url, namespace),))
+            self._db.commit()
+
+    def _evict(self):
+        # Drop expired entries, then least recently used ones until under the size cap
+        self._db.execute("DELETE FROM metadata WHERE created < ?", (time.time() - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM metadata").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM metadata ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM metadata WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,60 +2,166 @@ import asyncio
 import click
 import os
 import sys
+import time
 # Ensure src is in path if run directly
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from src.core import Downloader
+from src.adaptive import parse_rate
+from src.batch import parse_batch, run_batch, summarize
+from src import events
+from src.core import Downloader, PostProcessing, parse_items, parse_job_format, split_formats
+from src.sync import SnapshotStore, sync_playlist
 
-def parse_items(items_str: str) -> list[int]:
-    """Parse string like '1,2,5-10' into [1, 2, 5, 6, 7, 8, 9, 10]"""
-    if not items_str:
-        return None
-    
-    indices = set()
-    parts = items_str.split(',')
-    for part in parts:
-        part = part.strip()
-        if '-' in part:
-            try:
-                start, end = map(int, part.split('-'))
-                indices.update(range(start, end + 1))
-            except ValueError:
-                click.echo(f"Warning: Invalid range format '{part}'")
-        else:
-            try:
-                indices.add(int(part))
-            except ValueError:
-                click.echo(f"Warning: Invalid number '{part}'")
-    return sorted(list(indices))
+FORMATS = ['mp3', 'wav', 'flac', 'm4a', 'opus']
+ENGINES = ['subprocess', 'inprocess']
+
+def format_list(ctx, param, value):
+    """
+    Click callback for --format: one format or a comma-separated list of them.
+    """
+    formats = split_formats(value or "")
+    for f in formats:
+        if f not in FORMATS:
+            raise click.BadParameter(f"'{f}' is not one of {', '.join(FORMATS)}")
+    if not formats:
+        raise click.BadParameter("no format given")
+    return ",".join(formats)
+
+async def print_progress(queue: asyncio.Queue, interval: float = 1.0):
+    """
+    Print overall progress from a Downloader event subscription, at most once
+    per `interval` seconds, until the subscription is closed.
+    """
+    speeds = {} # Latest speed of every track being fetched
+    last = 0.0
+    while True:
+        event = await queue.get()
+        if event is None:
+            break
+        if event.kind == events.TRACK and event.phase != events.FETCHING:
+            speeds.pop(event.track_id, None)
+        if event.kind != events.PROGRESS:
+            continue
+        speeds[event.track_id] = event.speed or 0.0
+        now = time.monotonic()
+        if now - last < interval:
+            continue
+        last = now
+        line = (f"[INFO] Downloading: {event.percent:.1f}% ({event.completed + event.failed}/{event.total} tracks, "
+                f"{sum(speeds.values()) / 1e6:.2f} MB/s)")
+        if event.jobs:
+            line += f" [{event.jobs}]"
+        click.echo(line)
+
+async def with_progress(downloader: Downloader, coro):
+    """
+    Run `coro` while printing the Downloader's progress events.
+    """
+    queue = downloader.events.subscribe(maxsize=100)
+    printer = asyncio.create_task(print_progress(queue))
+    try:
+        return await coro
+    finally:
+        downloader.events.unsubscribe(queue)
+        await printer
+
+# Downloader options shared by the download commands (see downloader_options)
+PIPELINE_OPTIONS = [
+    click.option('--adaptive', is_flag=True, help='Tune tracks per host to the measured throughput, errors and 429s, starting at --jobs'),
+    click.option('--min-jobs', default=1, type=click.IntRange(min=1), help='Lower bound for --adaptive (default: 1)'),
+    click.option('--max-jobs', type=click.IntRange(min=1), help='Upper bound for --adaptive (default: 4x --jobs)'),
+    click.option('--max-rate', help='Total bandwidth cap, e.g. 500K or 2M (bytes/s)'),
+    click.option('--direct', is_flag=True, help='Pipe each download straight into FFmpeg instead of staging it on disk (stream copy when the codec already matches)'),
+    click.option('--smart', is_flag=True, help='Keep the source codec when it can be remuxed (opus, m4a, mp3, flac); --format is only used for sources that must be transcoded'),
+    click.option('--normalize', is_flag=True, help='EBU R128 loudness normalization (forces a re-encode)'),
+    click.option('--tag', is_flag=True, help='Write title, artist and track number tags'),
+    click.option('--cover-art', is_flag=True, help='Embed the thumbnail as cover art (mp3, m4a, flac)'),
+    click.option('--segments', default=1, type=click.IntRange(min=1), help='Parallel Range requests per track for plain HTTP sources (default: 1 = off)'),
+    click.option('--segment-size', help='Bytes per Range request with --segments, e.g. 4M (default: 8M)'),
+]
+
+def pipeline_options(command):
+    for option in reversed(PIPELINE_OPTIONS):
+        command = option(command)
+    return command
+
+def downloader_options(jobs, engine, max_rate=None, normalize=False, tag=False, cover_art=False,
+                       segment_size=None, **options) -> dict:
+    """
+    Downloader keyword arguments from the command line options.
+    """
+    try:
+        bandwidth_cap = parse_rate(max_rate)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--max-rate')
+    try:
+        # Same suffixes as a rate: 512K, 8M...
+        segment_size = parse_rate(segment_size)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--segment-size')
+    post_processing = PostProcessing(normalize=normalize, tags=tag, cover_art=cover_art)
+    return dict(jobs=jobs, engine=engine, bandwidth_cap=bandwidth_cap, post_processing=post_processing,
+                segment_size=int(segment_size) if segment_size else None, **options)
+
+def describe_jobs(downloader: Downloader) -> str:
+    text = str(downloader.jobs)
+    if downloader.adaptive:
+        text += f" per host to start, adaptive {downloader.min_jobs}-{downloader.max_jobs}"
+    if downloader.bandwidth_cap:
+        text += f", max {downloader.bandwidth_cap / 1e6:.2f} MB/s"
+    return text
 
 @click.command()
-@click.option('--url', required=True, help='URL of the song or playlist (YouTube/Spotify/SoundCloud)')
-@click.option('--format', default='wav', type=click.Choice(['mp3', 'wav', 'flac', 'm4a']), help='Output format (default: wav)')
+@click.option('--url', help='URL of the song or playlist (YouTube/Spotify/SoundCloud)')
+@click.option('--batch', type=click.File('r'), help='File with one "URL [FORMAT] [ITEMS]" per line ("-" for stdin)')
+@click.option('--format', default='wav', callback=format_list, help=f"Output format: {', '.join(FORMATS)}, or several separated by commas (e.g. flac,mp3), all written from one fetch (default: wav)")
 @click.option('--output', '-o', default='downloads', help='Output directory (default: ./downloads)')
 @click.option('--items', help='Specific playlist items to download (e.g. "1,3,5-10"). 1-based indices.')
-def main(url, format, output, items):
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='Number of tracks to download at once (default: 4)')
+@click.option('--engine', default='subprocess', type=click.Choice(ENGINES), help='yt-dlp engine: one process per track, or in-process worker threads (default: subprocess)')
+@click.option('--refresh-metadata', is_flag=True, help='Ignore cached playlist metadata and fetch it again')
+@click.option('--force', is_flag=True, help='Re-download tracks that are already in the download archive')
+@pipeline_options
+def main(url, batch, format, output, items, jobs, engine, refresh_metadata, force, **pipeline):
     """
     Music Downloader CLI
     """
+    if bool(url) == bool(batch):
+        raise click.UsageError("Pass exactly one of --url or --batch")
+    options = downloader_options(jobs, engine, **pipeline)
+    if batch:
+        run_batch_file(batch, format, output, options)
+        return
+
     click.echo(f"Processing URL: {url}")
-    click.echo(f"Format: {format}")
+    click.echo(f"Format: {format}" + (" (smart: remux when the source allows)" if options["smart"] else ""))
     click.echo(f"Output: {output}")
+    downloader = Downloader(**options)
+    click.echo(f"Jobs: {describe_jobs(downloader)}")
     
     track_indices = parse_items(items)
     if track_indices:
         click.echo(f"Selecting tracks: {track_indices}")
 
-    downloader = Downloader()
-
     async def run_download():
-        await downloader.download(
+        report = await with_progress(downloader, downloader.download(
             url=url, 
             output_dir=output, 
             format=format, 
             track_indices=track_indices,
-            progress_callback=lambda msg: click.echo(f"[INFO] {msg}")
-        )
+            progress_callback=lambda msg: click.echo(f"[INFO] {msg}"),
+            refresh_metadata=refresh_metadata,
+            force=force
+        ))
+        if report is not None:
+            click.echo(f"[INFO] Downloaded {len(report.completed)}, failed {len(report.failed)}, "
+                       f"skipped {len(report.skipped)} (already downloaded)")
+        if downloader.metadata_cache is not None:
+            click.echo(f"[INFO] Metadata cache: {downloader.metadata_cache.stats()}")
+        if downloader.session is not None:
+            click.echo(f"[INFO] HTTP: {downloader.session.stats()}")
+        if downloader.controller is not None:
+            click.echo(f"[INFO] Concurrency: {downloader.controller.describe()}")
 
     try:
         asyncio.run(run_download())
@@ -64,5 +170,240 @@ def main(url, format, output, items):
     except Exception as e:
         click.echo(f"\nError: {e}")
 
+def run_batch_file(batch_file, format, output, options):
+    """
+    Process every URL in a batch file as one job on a shared Downloader.
+    """
+    try:
+        batch_jobs = parse_batch(batch_file, format, FORMATS)
+    except ValueError as e:
+        raise click.UsageError(f"Invalid batch file: {e}")
+    if not batch_jobs:
+        click.echo("Batch file contains no URLs.")
+        return
+
+    click.echo(f"Batch: {len(batch_jobs)} URLs")
+    click.echo(f"Output: {output}")
+    downloader = Downloader(**options)
+    click.echo(f"Jobs: {describe_jobs(downloader)} (shared by all URLs)")
+
+    def on_progress(job, msg):
+        click.echo(f"[{job.line}] {msg}")
+
+    async def run():
+        started = time.monotonic()
+        await run_batch(downloader, batch_jobs, output, parse_items, on_progress)
+        click.echo("\nSummary:")
+        for line in summarize(batch_jobs, time.monotonic() - started):
+            click.echo(line)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        click.echo("\nBatch cancelled by user.")
+
+@click.command()
+@click.option('--url', required=True, help='URL of the playlist to mirror')
+@click.option('--format', default='wav', callback=format_list, help=f"Output format: {', '.join(FORMATS)}, or several separated by commas (e.g. flac,mp3), all written from one fetch (default: wav)")
+@click.option('--output', '-o', default='downloads', help='Output directory (default: ./downloads)')
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='Number of tracks to download at once (default: 4)')
+@click.option('--engine', default='subprocess', type=click.Choice(ENGINES), help='yt-dlp engine (default: subprocess)')
+@click.option('--prune', is_flag=True, help='Delete files of tracks that were removed from the playlist')
+@pipeline_options
+def sync(url, format, output, jobs, engine, prune, **pipeline):
+    """
+    Download only what changed in a playlist since the last sync
+    """
+    options = downloader_options(jobs, engine, **pipeline)
+    click.echo(f"Syncing: {url}")
+    click.echo(f"Format: {format}" + (" (smart: remux when the source allows)" if options["smart"] else ""))
+    click.echo(f"Output: {output}")
+
+    downloader = Downloader(**options)
+    store = SnapshotStore()
+
+    async def run_sync():
+        result = await with_progress(downloader, sync_playlist(
+            downloader, store, url, output, format,
+            prune=prune,
+            progress_callback=lambda msg: click.echo(f"[INFO] {msg}")
+        ))
+        report = result.report
+        click.echo(f"[INFO] Downloaded {len(report.completed)}, failed {len(report.failed)}, "
+                   f"skipped {len(report.skipped)} (already downloaded)")
+        if prune:
+            click.echo(f"[INFO] Pruned {len(result.pruned)} removed tracks")
+
+    try:
+        asyncio.run(run_sync())
+    except KeyboardInterrupt:
+        click.echo("\nSync cancelled by user.")
+    except Exception as e:
+        click.echo(f"\nError: {e}")
+
+@click.command()
+@click.option('--list', 'list_only', is_flag=True, help='Only list unfinished jobs')
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='Number of tracks to download at once (default: 4)')
+@click.option('--engine', default='subprocess', type=click.Choice(ENGINES), help='yt-dlp engine (default: subprocess)')
+@pipeline_options
+def resume(list_only, jobs, engine, **pipeline):
+    """
+    Continue every unfinished download job where it left off
+    """
+    downloaders = {}
+    def downloader_for(smart: bool) -> Downloader:
+        # A job resumes in the mode it was started in, whatever --smart says
+        if smart not in downloaders:
+            downloaders[smart] = Downloader(**downloader_options(jobs, engine, **dict(pipeline, smart=smart)))
+        return downloaders[smart]
+
+    downloader = downloader_for(pipeline['smart'])
+    if downloader.job_store is None:
+        click.echo("Job store unavailable.")
+        return
+    unfinished = downloader.job_store.unfinished_jobs()
+    if not unfinished:
+        click.echo("No unfinished jobs.")
+        return
+    for job in unfinished:
+        click.echo(f"{job} -> {job.output_dir}")
+    if list_only:
+        return
+
+    async def run():
+        async def run_job(job):
+            smart, format = parse_job_format(job.format)
+            try:
+                await downloader_for(smart).download(
+                    url=job.url,
+                    output_dir=job.output_dir,
+                    format=format,
+                    track_indices=job.track_indices,
+                    progress_callback=lambda msg: click.echo(f"[#{job.id}] {msg}")
+                )
+            except Exception as e:
+                click.echo(f"[#{job.id}] Error: {e}")
+        await asyncio.gather(*(run_job(job) for job in unfinished))
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        click.echo("\nResume cancelled by user.")
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1; there is no authentication)')
+@click.option('--port', default=8750, type=click.IntRange(1, 65535), help='Port to listen on (default: 8750)')
+@click.option('--format', default='mp3', callback=format_list, help='Format(s) for jobs that don\'t name one (default: mp3)')
+@click.option('--output', '-o', default='downloads', help='Root directory for all job output (default: ./downloads)')
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='Tracks downloaded at once, across all jobs (default: 4)')
+@click.option('--max-urls', type=click.IntRange(min=1), help='Jobs listed and scheduled at once (default: --jobs)')
+@click.option('--engine', default='inprocess', type=click.Choice(ENGINES), help='yt-dlp engine (default: inprocess)')
+@pipeline_options
+def serve(host, port, format, output, jobs, max_urls, engine, **pipeline):
+    """
+    Run a headless HTTP/JSON API server for submitting and watching jobs
+    """
+    from src.server import ApiServer
+    downloader = Downloader(**downloader_options(jobs, engine, **pipeline))
+
+    def ready(server):
+        click.echo(f"[INFO] Serving on http://{server.host}:{server.port} (output: {server.output_dir})")
+        click.echo(f"Jobs: {describe_jobs(downloader)} (shared by all clients)")
+
+    async def run():
+        server = ApiServer(downloader, output, host, port, format, max_urls)
+        await server.run(on_ready=ready)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        click.echo("\nServer stopped.")
+    except OSError as e:
+        click.echo(f"\nError: {e}")
+
+@click.command()
+@click.option('--url', required=True, help='URL of the playlist to split between workers')
+@click.option('--format', default='wav', callback=format_list, help=f"Output format: {', '.join(FORMATS)}, or several separated by commas (e.g. flac,mp3), all written from one fetch (default: wav)")
+@click.option('--items', help='Specific playlist items to download (e.g. "1,3,5-10"). 1-based indices.')
+@click.option('--transport', default='tcp://127.0.0.1:8770', help='tcp://HOST:PORT to listen on, or a queue directory shared with the workers (default: tcp://127.0.0.1:8770)')
+@click.option('--unit-size', default=25, type=click.IntRange(min=1), help='Tracks per work unit (default: 25)')
+@click.option('--lease', default=300.0, type=click.FloatRange(min=5), help='Seconds a worker may go silent before its unit is reassigned (default: 300)')
+@click.option('--max-attempts', default=3, type=click.IntRange(min=1), help='Leases per unit before giving it up (default: 3)')
+@click.option('--refresh-metadata', is_flag=True, help='Ignore cached playlist metadata and fetch it again')
+def coordinate(url, format, items, transport, unit_size, lease, max_attempts, refresh_metadata):
+    """
+    Split a playlist into leased work units for `worker` processes
+    """
+    from src.distributed import LeaseTable, open_coordinator, split_units
+    downloader = Downloader()
+
+    async def run():
+        click.echo(f"[INFO] Fetching metadata for {url}...")
+        tracks = list(await downloader.get_metadata(url, refresh=refresh_metadata))
+        wanted = parse_items(items)
+        if wanted:
+            tracks = [t for t in tracks if t.index in wanted]
+        if not tracks:
+            click.echo("No tracks to download.")
+            return
+        units = split_units(tracks, format, unit_size, lease)
+        table = LeaseTable(units, max_attempts, on_change=lambda msg: click.echo(f"[INFO] {msg}"))
+        coordinator = open_coordinator(transport, table)
+        click.echo(f"[INFO] {len(tracks)} tracks in {len(units)} units, waiting for workers on {transport}")
+        await coordinator.run()
+        click.echo(f"[INFO] {table.summary()}")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        click.echo("\nCoordinator stopped.")
+    except Exception as e:
+        click.echo(f"\nError: {e}")
+
+@click.command()
+@click.option('--transport', default='tcp://127.0.0.1:8770', help='tcp://HOST:PORT of the coordinator, or its queue directory (default: tcp://127.0.0.1:8770)')
+@click.option('--output', '-o', default='downloads', help='Output directory (default: ./downloads)')
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='Number of tracks to download at once (default: 4)')
+@click.option('--engine', default='subprocess', type=click.Choice(ENGINES), help='yt-dlp engine (default: subprocess)')
+@pipeline_options
+def worker(transport, output, jobs, engine, **pipeline):
+    """
+    Download and transcode work units handed out by `coordinate`
+    """
+    from src.distributed import Worker, open_queue, worker_id
+    downloader = Downloader(**downloader_options(jobs, engine, **pipeline))
+    name = worker_id()
+    click.echo(f"[INFO] Worker {name} pulling from {transport}, output: {output}")
+
+    async def run():
+        os.makedirs(output, exist_ok=True)
+        node = Worker(downloader, open_queue(transport, name), output)
+        done = await node.run(progress_callback=lambda msg: click.echo(f"[INFO] {msg}"))
+        click.echo(f"[INFO] Finished {done} units")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        click.echo("\nWorker stopped.")
+    except Exception as e:
+        click.echo(f"\nError: {e}")
+
+@click.group()
+def cli():
+    """
+    Music Downloader CLI
+    """
+
+cli.add_command(main, name='download')
+cli.add_command(sync)
+cli.add_command(resume)
+cli.add_command(serve)
+cli.add_command(coordinate)
+cli.add_command(worker)
+
 if __name__ == '__main__':
-    main()
+    # `cli.py --url ...` keeps working; `cli.py sync ...` selects a subcommand
+    if len(sys.argv) > 1 and sys.argv[1] in cli.commands:
+        cli()
+    else:
+        main()
@@ -1,7 +1,27 @@
 import asyncio
+import math
 import os
+import re
+import shutil
 import subprocess
-from typing import List, Dict, Optional, Callable
+import threading
+import time
+import urllib.request
+from array import array
+from collections.abc import Sequence
+from typing import List, Dict, Optional, Callable, Iterable, Iterator, AsyncIterator, Tuple, Union
+from urllib.parse import urlparse
+
+from src.adaptive import ConcurrencyController
+from src.archive import DownloadArchive
+from src.cache import MetadataCache, normalize_url
+from src.engines import ENGINES, CannotStream, Throttled
+from src.session import USER_AGENT, YtSession
+from src import events
+from src.events import ProgressBus, ProgressEvent
+from src.fetch import SEGMENT_SIZE
+from src.jobs import DONE, DOWNLOADING, FAILED, TRANSCODING, JobStore
+from src.spotify import SpotifyClient, TrackMatcher, youtube_search
 
 # Try importing yt_dlp, handle if not installed (though it should be)
 try:
@@ -17,21 +37,595 @@ except ImportError:
 # However, let's try to see if we can use basic spotdl detection.
 
 class TrackInfo:
-    def __init__(self, title: str, artist: str, duration: int, url: str, index: int):
+    # No per-instance __dict__: listings can hold hundreds of thousands of these
+    __slots__ = ('title', 'artist', 'duration', 'url', 'index', 'source_id')
+
+    def __init__(self, title: str, artist: str, duration: int, url: str, index: int, source_id: Optional[str] = None):
         self.title = title
         self.artist = artist
         self.duration = duration # in seconds
         self.url = url
         self.index = index
+        self.source_id = source_id # "<extractor>:<video id>", stable across playlists
+
+    @property
+    def key(self) -> str:
+        """
+        Identity used by the download archive.
+        """
+        return self.source_id or normalize_url(self.url)
 
     def __repr__(self):
         return f"{self.index}. {self.artist} - {self.title} ({self.duration}s)"
 
-class Downloader:
+    def to_dict(self) -> Dict:
+        return {
+            'title': self.title,
+            'artist': self.artist,
+            'duration': self.duration,
+            'url': self.url,
+            'index': self.index,
+            'source_id': self.source_id,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "TrackInfo":
+        return cls(d['title'], d['artist'], d['duration'], d['url'], d['index'], d.get('source_id'))
+
+# Canonical page URL per extractor, so TrackList can rebuild instead of storing it
+CANONICAL_URLS = {
+    'youtube': "https://www.youtube.com/watch?v={}",
+}
+
+def _canonical_url(source_id: Optional[str]) -> Optional[str]:
+    if not source_id:
+        return None
+    extractor, _, video_id = source_id.partition(":")
+    template = CANONICAL_URLS.get(extractor)
+    return template.format(video_id) if template else None
+
+class TrackList(Sequence):
+    """
+    Columnar (struct-of-arrays) collection of tracks for very large listings,
+    e.g. whole channels. Each field lives in its own list/array, repeated
+    artist names are stored once, canonical URLs are rebuilt from the source_id
+    instead of stored, and TrackInfo objects are only built when
+    an item is read. Lookup by playlist index and by source_id is O(1).
+    Behaves like a read-only list of TrackInfo, plus append/extend.
+    """
+    def __init__(self, tracks: Iterable[TrackInfo] = ()):
+        self._titles: List[str] = []
+        self._artists: List[str] = []
+        self._urls: List[Optional[str]] = [] # None = canonical URL of the source_id
+        self._source_ids: List[Optional[str]] = []
+        self._durations = array('d') # NaN = unknown
+        self._indices = array('l')
+        self._artist_names: Dict[str, str] = {} # Dedupes artist strings
+        self._by_source: Dict[str, int] = {}
+        self._by_index: Optional[Dict[int, int]] = None # Only built once indices stop being 1..n
+        self.extend(tracks)
+
+    def append(self, track: TrackInfo):
+        pos = len(self._titles)
+        self._titles.append(track.title)
+        self._artists.append(self._artist_names.setdefault(track.artist, track.artist))
+        self._urls.append(None if track.url == _canonical_url(track.source_id) else track.url)
+        self._source_ids.append(track.source_id)
+        self._durations.append(math.nan if track.duration is None else track.duration)
+        self._indices.append(track.index)
+        if track.source_id is not None:
+            self._by_source.setdefault(track.source_id, pos)
+        if self._by_index is not None:
+            self._by_index.setdefault(track.index, pos)
+        elif track.index != pos + 1:
+            # Not a plain 1..n listing any more (e.g. filtered): index positions explicitly
+            self._by_index = {}
+            for i, index in enumerate(self._indices):
+                self._by_index.setdefault(index, i)
+
+    def extend(self, tracks: Iterable[TrackInfo]):
+        for track in tracks:
+            self.append(track)
+
+    def __len__(self):
+        return len(self._titles)
+
+    def _track(self, pos: int) -> TrackInfo:
+        duration = self._durations[pos]
+        if math.isnan(duration):
+            duration = None
+        elif duration.is_integer():
+            duration = int(duration)
+        url = self._urls[pos] or _canonical_url(self._source_ids[pos])
+        return TrackInfo(self._titles[pos], self._artists[pos], duration, url,
+                         self._indices[pos], self._source_ids[pos])
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self._track(i) for i in range(*pos.indices(len(self)))]
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError("TrackList index out of range")
+        return self._track(pos)
+
+    def by_index(self, index: int) -> Optional[TrackInfo]:
+        """
+        Track with playlist index `index` (1-based), if present.
+        """
+        if self._by_index is None:
+            return self._track(index - 1) if 1 <= index <= len(self) else None
+        pos = self._by_index.get(index)
+        return self._track(pos) if pos is not None else None
+
+    def by_source_id(self, source_id: str) -> Optional[TrackInfo]:
+        pos = self._by_source.get(source_id)
+        return self._track(pos) if pos is not None else None
+
+    def to_dicts(self) -> List[Dict]:
+        return [self._track(i).to_dict() for i in range(len(self))]
+
+    @classmethod
+    def from_dicts(cls, dicts: Iterable[Dict]) -> "TrackList":
+        return cls(TrackInfo.from_dict(d) for d in dicts)
+
+    def __repr__(self):
+        return f"<TrackList {len(self)} tracks>"
+
+def source_id_of(info: Dict) -> Optional[str]:
+    """
+    "<extractor>:<id>" for a yt-dlp info dict or flat playlist entry.
+    """
+    extractor = info.get('ie_key') or info.get('extractor_key')
+    if not extractor or not info.get('id'):
+        return None
+    return f"{extractor.lower()}:{info['id']}"
+
+# Title of the stand-in TrackInfo used when Spotify metadata can't be resolved
+SPOTIFY_PLACEHOLDER = "Spotify URL (Metadata pending)"
+
+# FFmpeg encoder settings per output format
+AUDIO_CODECS = {
+    'mp3': ['-c:a', 'libmp3lame', '-b:a', '192k'],
+    'm4a': ['-c:a', 'aac', '-b:a', '192k'],
+    'flac': ['-c:a', 'flac'],
+    'wav': ['-c:a', 'pcm_s16le'],
+    'opus': ['-c:a', 'libopus', '-b:a', '160k'],
+}
+
+# Source codecs (as yt-dlp reports them) each format can take as-is, without re-encoding
+COPY_CODECS = {
+    'mp3': ('mp3',),
+    'm4a': ('mp4a', 'aac'),
+    'opus': ('opus',),
+    'flac': ('flac',),
+}
+
+def split_formats(format: str) -> List[str]:
+    """
+    "flac,mp3" -> ['flac', 'mp3']: every format is written from the same fetch.
+    """
+    return list(dict.fromkeys(f.strip() for f in format.split(",") if f.strip()))
+
+def parse_items(items_str: str) -> Optional[List[int]]:
+    """Parse string like '1,2,5-10' into [1, 2, 5, 6, 7, 8, 9, 10]"""
+    if not items_str:
+        return None
+    
+    indices = set()
+    parts = items_str.split(',')
+    for part in parts:
+        part = part.strip()
+        if '-' in part:
+            try:
+                start, end = map(int, part.split('-'))
+                indices.update(range(start, end + 1))
+            except ValueError:
+                print(f"[WARNING] Invalid range format '{part}'")
+        else:
+            try:
+                indices.add(int(part))
+            except ValueError:
+                print(f"[WARNING] Invalid number '{part}'")
+    return sorted(list(indices))
+
+def job_format(format: str, smart: bool = False) -> str:
+    """
+    Format a job is stored under. Smart-mode jobs are kept apart from plain
+    ones: "smart:mp3", mp3 being what sources that can't be remuxed become.
+    """
+    return f"smart:{format}" if smart else format
+
+def parse_job_format(stored: str) -> Tuple[bool, str]:
+    """
+    job_format reversed: "smart:mp3" -> (True, "mp3").
+    """
+    if stored.startswith("smart:"):
+        return True, stored[len("smart:"):]
+    return False, stored
+
+def can_copy(acodec: Optional[str], format: str) -> bool:
+    return bool(acodec) and acodec.lower().startswith(COPY_CODECS.get(format, ()))
+
+# Smart mode: the format each source codec is remuxed into (anything else is transcoded)
+SMART_TARGETS = [('opus', 'opus'), ('mp4a', 'm4a'), ('aac', 'm4a'), ('mp3', 'mp3'), ('flac', 'flac')]
+
+# Extension of a staged file -> its codec, for files fetched before a restart
+# (webm may hold opus or vorbis, so it isn't guessed)
+STAGED_CODECS = {'.opus': 'opus', '.m4a': 'mp4a', '.mp3': 'mp3', '.flac': 'flac'}
+
+# Output size per second for the lossy encoders above (bytes/s)
+OUTPUT_RATES = {'mp3': 192000 // 8, 'm4a': 192000 // 8, 'opus': 160000 // 8}
+
+# Rough CPU cost of transcoding a compressed source to each format, in seconds
+# per minute of audio on one core; only used to estimate what smart mode saved
+TRANSCODE_COST = {'wav': 0.2, 'flac': 0.6, 'mp3': 1.5, 'm4a': 1.2, 'opus': 1.2}
+
+def smart_target(acodec: Optional[str]) -> Optional[str]:
+    codec = (acodec or "").lower()
+    for prefix, format in SMART_TARGETS:
+        if codec.startswith(prefix):
+            return format
+    return None
+
+def estimated_size(format: str, duration: float, source: Optional[Dict] = None) -> int:
+    """
+    Size of `duration` seconds transcoded to `format` (PCM at the source's rate for wav/flac).
+    """
+    if format in OUTPUT_RATES:
+        return int(duration * OUTPUT_RATES[format])
+    source = source or {}
+    pcm = duration * (source.get('asr') or 44100) * (source.get('channels') or 2) * 2
+    return int(pcm * 0.6 if format == 'flac' else pcm) # FLAC: ~60% of PCM for music
+
+def safe_filename(name: str) -> str:
+    """
+    Make a title usable as a file name (same rules yt-dlp applies to %(title)s).
+    """
+    if yt_dlp is not None:
+        return yt_dlp.utils.sanitize_filename(name) or "Unknown"
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip(' .')
+    return name or "Unknown"
+
+async def _as_batches(tracks: Union[Sequence, AsyncIterator[List[TrackInfo]]]) -> AsyncIterator[List[TrackInfo]]:
+    if isinstance(tracks, Sequence):
+        yield tracks
+    else:
+        async for batch in tracks:
+            yield batch
+
+async def _filter_batches(batches: AsyncIterator[List[TrackInfo]], wanted: Optional[set]) -> AsyncIterator[List[TrackInfo]]:
+    try:
+        async for batch in batches:
+            if wanted:
+                batch = [t for t in batch if t.index in wanted]
+            if batch:
+                yield batch
+    finally:
+        await batches.aclose()
+
+class StageStats:
+    """
+    Throughput counters for one pipeline stage.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0 # Summed worker time spent on items
+        self.first_start: Optional[float] = None
+        self.last_end: Optional[float] = None
+
+    def record(self, started: float, ended: float, size: int = 0):
+        self.items += 1
+        self.bytes += size
+        self.busy += ended - started
+        if self.first_start is None or started < self.first_start:
+            self.first_start = started
+        if self.last_end is None or ended > self.last_end:
+            self.last_end = ended
+
+    @property
+    def elapsed(self) -> float:
+        if self.first_start is None or self.last_end is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    def __str__(self):
+        elapsed = self.elapsed or 1e-9
+        return (f"{self.name}: {self.items} tracks, {self.bytes / 1e6:.1f} MB in {self.elapsed:.1f}s "
+                f"({self.items / elapsed:.2f} tracks/s, {self.bytes / 1e6 / elapsed:.2f} MB/s)")
+
+class PostProcessing:
+    """
+    Extras applied by the same FFmpeg run that writes the output file, so no
+    file is read or written a second time:
+      normalize - EBU R128 loudness normalization (FFmpeg's loudnorm in
+                  single-pass mode, which measures as it goes); needs a
+                  re-encode, so it turns stream copies off
+      tags      - title, artist and track number from the TrackInfo
+      cover_art - the source's thumbnail as an attached picture (mp3, m4a, flac)
+    """
+    COVER_FORMATS = ('mp3', 'm4a', 'flac') # Containers FFmpeg can attach a picture to
+
+    def __init__(self, normalize: bool = False, tags: bool = False, cover_art: bool = False,
+                 loudness: float = -16.0, true_peak: float = -1.5, lra: float = 11.0):
+        self.normalize = normalize
+        self.tags = tags
+        self.cover_art = cover_art
+        self.loudness = loudness # Integrated loudness target (LUFS)
+        self.true_peak = true_peak # dBTP
+        self.lra = lra # Loudness range target (LU)
+
+    def wants_cover(self, format: str, source: Optional[Dict]) -> bool:
+        return self.cover_art and format in self.COVER_FORMATS and bool((source or {}).get('thumbnail'))
+
+    def ffmpeg_args(self, track: Optional[TrackInfo], format: str, source: Optional[Dict] = None,
+                    cover: Optional[str] = None):
+        """
+        (extra inputs, output options) for the FFmpeg command writing `format`.
+        """
+        inputs, outputs = [], []
+        if cover:
+            inputs += ["-i", cover]
+            outputs += ["-map", "0:a", "-map", "1:v", "-c:v", "mjpeg", "-disposition:v", "attached_pic"]
+            if format == 'mp3':
+                outputs += ["-id3v2_version", "3"] # Most players' cover support
+        else:
+            outputs.append("-vn")
+        if self.normalize:
+            # loudnorm resamples to 192 kHz internally; write the source rate back (opus needs 48 kHz)
+            rate = 48000 if format == 'opus' else (source or {}).get('asr') or 48000
+            outputs += ["-af", f"loudnorm=I={self.loudness}:TP={self.true_peak}:LRA={self.lra}", "-ar", str(rate)]
+        if self.tags and track is not None:
+            outputs += ["-metadata", f"title={track.title}", "-metadata", f"artist={track.artist}",
+                        "-metadata", f"track={track.index}"]
+        return inputs, outputs
+
+class SmartStats:
+    """
+    What smart format mode saved, compared to transcoding every track to `baseline`.
+    Both savings are estimates (estimated_size, TRANSCODE_COST), not measurements,
+    and are reported as such.
+    """
+    def __init__(self, baseline: str):
+        self.baseline = baseline
+        self.remuxed = 0
+        self.transcoded = 0
+        self.bytes_saved = 0
+        self.cpu_saved = 0.0 # Estimated, see TRANSCODE_COST
+
+    def record(self, track: TrackInfo, source: Optional[Dict], format: str, copied: bool, size: int) -> str:
+        """
+        Count one finished track; returns its log line.
+        """
+        codec = (source or {}).get('acodec') or "unknown codec"
+        if not copied:
+            self.transcoded += 1
+            return f"Transcoded {codec} -> {format}: {track.title}"
+        self.remuxed += 1
+        line = f"Remuxed {codec} -> {format}: {track.title} ({size / 1e6:.1f} MB"
+        if track.duration:
+            saved = estimated_size(self.baseline, track.duration, source) - size
+            cpu = TRANSCODE_COST.get(self.baseline, 0.0) * track.duration / 60
+            self.bytes_saved += saved
+            self.cpu_saved += cpu
+            line += f", est. {saved / 1e6:.1f} MB and {cpu:.1f}s CPU saved vs. {self.baseline}"
+        return line + ")"
+
+    def __str__(self):
+        return (f"Smart: {self.remuxed} remuxed, {self.transcoded} transcoded, "
+                f"estimated {self.bytes_saved / 1e6:.1f} MB and {self.cpu_saved:.1f}s CPU saved vs. {self.baseline} "
+                f"(from typical bitrates and encoder speeds, not measured)")
+
+class PipelineStats:
+    """
+    Per-stage throughput plus the depth of the fetch -> transcode queue.
+    """
+    def __init__(self):
+        self.fetch = StageStats("Fetch")
+        self.transcode = StageStats("Transcode")
+        self.smart: Optional[SmartStats] = None # Set in smart format mode
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def set_queue_depth(self, depth: int):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def __str__(self):
+        text = f"{self.fetch} | {self.transcode} | peak queue {self.max_queue_depth}"
+        return f"{text} | {self.smart}" if self.smart is not None else text
+
+class DownloadReport:
+    """
+    Outcome of a scheduled download run.
+    """
     def __init__(self):
+        self.completed: List[TrackInfo] = []
+        self.failed: List[TrackInfo] = []
+        self.skipped: List[TrackInfo] = [] # Already in the download archive or done earlier in this job
+        self.job_id: Optional[int] = None # JobStore id, when the run was tracked
+        self.stats = PipelineStats()
+
+    @property
+    def total(self) -> int:
+        return len(self.completed) + len(self.failed)
+
+    def __repr__(self):
+        return (f"<DownloadReport completed={len(self.completed)} failed={len(self.failed)} "
+                f"skipped={len(self.skipped)}>")
+
+class Downloader:
+    def __init__(self, jobs: int = 4, per_host: Optional[int] = None, retries: int = 2,
+                 transcoders: Optional[int] = None, queue_size: Optional[int] = None,
+                 engine: str = "subprocess", metadata_cache: Optional[MetadataCache] = None,
+                 archive: Optional[DownloadArchive] = None, spotify_client: Optional[SpotifyClient] = None,
+                 track_matcher: Optional[TrackMatcher] = None, job_store: Optional[JobStore] = None,
+                 adaptive: bool = False, min_jobs: int = 1, max_jobs: Optional[int] = None,
+                 bandwidth_cap: Optional[float] = None, direct: bool = False, smart: bool = False,
+                 post_processing: Optional[PostProcessing] = None, segments: int = 1,
+                 segment_size: Optional[int] = None):
         self.ffmpeg_path = self._check_ffmpeg()
-        self.is_cancelled = False
+        # Cancellation: a thread-safe flag (cancel() may come from a UI thread) plus
+        # an asyncio.Event on the running loop for anything that needs to wait on it
+        self._cancelled = threading.Event()
+        self._cancel_event: Optional[asyncio.Event] = None
+        self._cancel_loop = None
         self.current_process = None # For spotdl subprocess
+        self.processes = set() # Running ffmpeg subprocesses
+
+        # Scheduler settings
+        self.set_concurrency(jobs, adaptive, min_jobs, max_jobs) # Tracks downloaded at once
+        self.per_host = per_host # Max concurrent tracks per host (None = same as jobs)
+        self.retries = retries # Extra attempts per track before giving up
+        self.bandwidth_cap = bandwidth_cap # Total bytes/s for all fetches (None = unlimited)
+        self.controller: Optional[ConcurrencyController] = None # Built by _limits
+
+        # Pipeline settings: stage 1 fetches raw audio, stage 2 transcodes it
+        self.transcoders = max(1, transcoders or os.cpu_count() or 1) # FFmpeg processes at once
+        self.queue_size = queue_size or 2 * self.transcoders # Fetched tracks waiting for FFmpeg
+        # Direct mode: pipe each source stream straight into the FFmpeg writing the
+        # final file (stream copy when the codec already matches), no staged file
+        self.direct = direct
+        # Smart mode: keep the source codec whenever it can be remuxed (opus, AAC,
+        # mp3, flac) and transcode to the requested format only when it can't
+        self.smart = smart
+        # Loudness normalization, tags and cover art, done while writing the output
+        self.post_processing = post_processing or PostProcessing()
+
+        # Fetch engine: "subprocess" (python -m yt_dlp per track) or "inprocess" (YoutubeDL on worker threads)
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}' (choose from {', '.join(ENGINES)})")
+        # Long-lived YoutubeDL instances (pooled connections, warm extractor caches)
+        # shared by metadata listing, Spotify matching and the in-process engine
+        self.session = YtSession() if yt_dlp is not None else None
+        # Large plain HTTP sources: `segments` parallel Range requests per track (1 = off)
+        self.engine = ENGINES[engine](workers=self.max_jobs, session=self.session,
+                                      segments=segments, segment_size=segment_size or SEGMENT_SIZE)
+
+        # On-disk metadata cache (set to None to disable)
+        self.metadata_cache = metadata_cache if metadata_cache is not None else self._open_state(MetadataCache, "Metadata cache")
+
+        # Index of finished files, consulted before scheduling (set to None to disable)
+        self.archive = archive if archive is not None else self._open_state(DownloadArchive, "Download archive")
+
+        # Durable per-track job state, so downloads resume after a pause or crash (set to None to disable)
+        self.job_store = job_store if job_store is not None else self._open_state(JobStore, "Job store")
+
+        # Spotify resolution: the client is created on first use (needs credentials),
+        # matches against audio sources are cached alongside the metadata
+        self.spotify_client = spotify_client
+        self.track_matcher = track_matcher or TrackMatcher(
+            search=(lambda query, duration: youtube_search(query, duration, self.session)) if self.session else None,
+            cache=self.metadata_cache
+        )
+
+        # Structured progress for every download on this Downloader (see src/events.py)
+        self.events = ProgressBus()
+
+        # Limits shared by every download running on this Downloader (see _limits)
+        self._limits_key = None
+        self._fetch_slots: Optional[asyncio.Semaphore] = None
+        self._transcode_slots: Optional[asyncio.Semaphore] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._concurrency_callback = None # Text callback of the latest download, for controller changes
+
+    def set_concurrency(self, jobs: int, adaptive: bool = False, min_jobs: int = 1, max_jobs: Optional[int] = None):
+        """
+        Fixed: `jobs` tracks at once. Adaptive (see src/adaptive.py): every host
+        starts at `jobs` and its limit moves between `min_jobs` and `max_jobs`
+        (default 4 x jobs) with the measured throughput, errors and 429s.
+        Takes effect for the next download.
+        """
+        self.jobs = max(1, jobs)
+        self.adaptive = adaptive
+        self.min_jobs = max(1, min_jobs)
+        self.max_jobs = max(self.jobs, max_jobs or 4 * self.jobs) if adaptive else self.jobs
+
+    def _limits(self):
+        """
+        Global fetch / transcode / per-host slots. Concurrent download() calls
+        (e.g. a batch of URLs) all draw from these, so `jobs` and `transcoders`
+        cap the whole Downloader rather than each call.
+        Rebuilt when the settings change or a new event loop is running.
+        """
+        key = (self.jobs, self.transcoders, self.per_host, self.adaptive, self.min_jobs, self.max_jobs,
+               self.bandwidth_cap, asyncio.get_running_loop())
+        if key != self._limits_key:
+            self._limits_key = key
+            self._fetch_slots = asyncio.Semaphore(self.max_jobs)
+            self._transcode_slots = asyncio.Semaphore(self.transcoders)
+            self._host_slots = {}
+            # Without adaptive mode the controller only splits the bandwidth cap (min = max)
+            start = self.per_host or self.jobs
+            self.controller = ConcurrencyController(
+                min_jobs=self.min_jobs if self.adaptive else start,
+                max_jobs=self.max_jobs if self.adaptive else start,
+                start=start, bandwidth_cap=self.bandwidth_cap, on_change=self._on_concurrency_change
+            ) if self.adaptive or self.bandwidth_cap else None
+        return self._fetch_slots, self._transcode_slots
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urlparse(url).netloc or "default"
+
+    def _host_slot(self, url: str):
+        host = self._host(url)
+        if self.controller is not None:
+            return self.controller.slot(host)
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host or self.jobs)
+        return self._host_slots[host]
+
+    def _on_concurrency_change(self, host: str, old: int, new: int, reason: str):
+        rate = self.controller.hosts[host].rate
+        self._emit(ProgressEvent(
+            events.CONCURRENCY, f"Concurrency for {host}: {old} -> {new} ({reason}, {rate / 1e6:.2f} MB/s)",
+            jobs=self.controller.describe()
+        ), self._concurrency_callback)
+
+    def archive_formats(self, format: str) -> List[str]:
+        # Smart-mode files are archived apart, as "smart:<requested format>":
+        # what each requested format turns into depends on the source
+        formats = split_formats(format)
+        return [f"smart:{f}" for f in formats] if self.smart else formats
+
+    def _archive_entries(self, format: str, source: Optional[Dict], written: List[tuple]) -> List[tuple]:
+        """
+        (archive format, path) for the outputs `written` for a track, one per archive_formats entry.
+        """
+        if not self.smart:
+            return [(f, dest) for dest, f, _ in written]
+        paths = {f: dest for dest, f, _ in written}
+        return [(f"smart:{f}", paths.get(self._output(f, source)[0], written[0][0])) for f in split_formats(format)]
+
+    def _output(self, format: str, source: Optional[Dict]):
+        """
+        (format to write, whether FFmpeg can stream-copy) for a source.
+        """
+        acodec = (source or {}).get('acodec')
+        if self.smart:
+            format = smart_target(acodec) or format
+        return format, can_copy(acodec, format) and not self.post_processing.normalize
+
+    def _outputs(self, format: str, source: Optional[Dict]) -> List[tuple]:
+        """
+        _output for each of the requested formats, without duplicates (smart
+        mode can map several of them to the same remux target).
+        """
+        outputs = {}
+        for f in split_formats(format):
+            out_format, copy = self._output(f, source)
+            outputs.setdefault(out_format, copy)
+        return list(outputs.items())
+
+    def _open_state(self, cls, label):
+        try:
+            return cls()
+        except Exception as e:
+            print(f"[WARNING] {label} unavailable: {e}")
+            return None
 
     def _check_ffmpeg(self):
         # ... (unchanged)
@@ -53,201 +647,811 @@ class Downloader:
         print("[WARNING] FFmpeg not found! Conversions may fail.")
         return "ffmpeg" # Default and hope for the best
 
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def reset_cancel(self):
+        """
+        Clear a previous cancel() before starting new work.
+        """
+        self._cancelled.clear()
+        self.engine.reset()
+        if self._cancel_event is not None:
+            self._cancel_event.clear()
+
+    def _cancel_waiter(self) -> asyncio.Event:
+        # asyncio.Event bound to the running loop, set by cancel() from any thread
+        loop = asyncio.get_running_loop()
+        if self._cancel_loop is not loop:
+            self._cancel_loop = loop
+            self._cancel_event = asyncio.Event()
+            if self.is_cancelled:
+                self._cancel_event.set()
+        return self._cancel_event
+
+    async def _sleep_unless_cancelled(self, delay: float) -> bool:
+        """
+        Sleep for `delay` seconds, waking early on cancel(). True if cancelled.
+        """
+        try:
+            await asyncio.wait_for(self._cancel_waiter().wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_cancelled
+
     def cancel(self):
-        self.is_cancelled = True
+        self._cancelled.set()
+        loop, event = self._cancel_loop, self._cancel_event
+        if event is not None:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass # Loop already closed
         if self.current_process:
             try:
                 self.current_process.terminate()
             except:
                 pass
+        self.engine.cancel()
+        for proc in list(self.processes):
+            try:
+                proc.kill()
+            except:
+                pass
 
-    def _get_yt_metadata(self, url: str) -> List[TrackInfo]:
+    def _iter_yt_metadata(self, url: str, stop: Optional[threading.Event] = None) -> Iterator[TrackInfo]:
         """
-        Fetch metadata using yt-dlp for YouTube/SoundCloud/etc.
+        Fetch metadata using yt-dlp for YouTube/SoundCloud/etc., one track at a time.
+        With process=False the playlist entries come back as a lazy generator, so
+        continuation pages are only requested as we iterate and each raw entry
+        can be dropped as soon as its TrackInfo is built.
         """
         ydl_opts = {
             'extract_flat': 'in_playlist', # Don't download, just list
-            'dump_single_json': True,
-            'quiet': True,
+            'lazy_playlist': True,
             'ignoreerrors': True,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         }
         
-        tracks = []
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Borrowed from the shared session: connections and extractor caches carry over between calls
+        with self.session.borrow(**ydl_opts) as ydl:
             try:
-                info = ydl.extract_info(url, download=False)
+                info = ydl.extract_info(url, download=False, process=False)
+                if info and info.get('_type') in ('url', 'url_transparent'):
+                    # Redirect to another extractor, let yt-dlp resolve it fully
+                    info = ydl.extract_info(url, download=False)
             except Exception as e:
                 print(f"Error extracting info: {e}")
                 info = None
             
             if not info:
                 # Could not fetch metadata
-                return []
+                return
 
             if 'entries' in info:
                 # It's a playlist
-                for idx, entry in enumerate(info['entries']):
-                    if entry:
-                        title = entry.get('title', 'Unknown')
-                        artist = entry.get('uploader', 'Unknown')
-                        duration = entry.get('duration', 0)
-                        entry_url = entry.get('url', url)
-                        # playlist indices are 1-based usually
-                        tracks.append(TrackInfo(title, artist, duration, entry_url, idx + 1))
+                try:
+                    for idx, entry in enumerate(info['entries']):
+                        if stop is not None and stop.is_set():
+                            return
+                        if entry:
+                            title = entry.get('title', 'Unknown')
+                            artist = entry.get('uploader', 'Unknown')
+                            duration = entry.get('duration', 0)
+                            entry_url = entry.get('url', url)
+                            # playlist indices are 1-based usually
+                            yield TrackInfo(title, artist, duration, entry_url, idx + 1, source_id_of(entry))
+                except Exception as e:
+                    # A later page failed: keep what we already have
+                    print(f"Error extracting playlist page: {e}")
             else:
                 # It's a single video
                 title = info.get('title', 'Unknown')
                 artist = info.get('uploader', 'Unknown')
                 duration = info.get('duration', 0)
-                tracks.append(TrackInfo(title, artist, duration, url, 1))
-                
+                yield TrackInfo(title, artist, duration, url, 1, source_id_of(info))
+
+    def _get_yt_metadata(self, url: str) -> TrackList:
+        return TrackList(self._iter_yt_metadata(url))
+
+    async def _get_spotify_metadata(self, url: str) -> List[TrackInfo]:
+        """
+        Resolve a Spotify track/album/playlist into TrackInfo objects whose url
+        points at a matched audio source, so Spotify jobs go through the same
+        pipeline as YouTube ones. If the Spotify API is unreachable or no
+        credentials are configured, returns a single placeholder and the
+        download falls back to spotdl.
+        """
+        try:
+            if self.spotify_client is None:
+                self.spotify_client = SpotifyClient()
+            items = await asyncio.to_thread(self.spotify_client.get_tracks, url)
+        except Exception as e:
+            print(f"[WARNING] Spotify metadata unavailable ({e}), falling back to spotdl")
+            return [TrackInfo(SPOTIFY_PLACEHOLDER, "Spotify", 0, url, 1)]
+
+        matches = await self.track_matcher.match_all(items)
+        tracks = []
+        for idx, (item, match) in enumerate(zip(items, matches)):
+            if match is None:
+                print(f"[WARNING] No audio source found for: {item['artist']} - {item['title']}")
+                continue
+            # Index follows the Spotify listing so --items stays meaningful
+            tracks.append(TrackInfo(item['title'], item['artist'], item['duration'], match['url'],
+                                    idx + 1, f"spotify:{item['id']}"))
         return tracks
 
-    def _get_spotify_metadata(self, url: str) -> List[TrackInfo]:
+    def _emit(self, event: ProgressEvent, progress_callback: Optional[Callable[[str], None]] = None):
         """
-        Fetch metadata using spotdl.
-        Since spotdl library is heavy, we'll shell out to `spotdl --print-errors save ...` 
-        or just assume we download everything if precise metadata is hard.
-        Actually, let's try to use `spotdl` to fetch songs if possible.
-        
-        For now, implementing a simplified version that might just return a generic 
-        "Playlist detected" if we can't easily parse without downloading.
-        
-        However, `spotdl` save file format is distinct. 
-        Let's try to just run a quick check or return a placeholder for Spotify 
-        implementation until we verify spotdl library usage.
+        Publish a progress event to subscribers (see self.events).
+        The plain-text `progress_callback` gets log lines only, not per-byte progress.
         """
-        # Placeholder for now, handling spotify metadata is complex without credentials 
-        # or properly initialized Spotdl client.
-        # We will implement the actual download logic which handles it automatically.
-        # For the UI list, we might just say "Spotify Playlist (Metadata fetch deferred)"
-        return [TrackInfo("Spotify URL (Metadata pending)", "Spotify", 0, url, 1)]
+        self.events.publish(event)
+        if progress_callback and event.kind != events.PROGRESS:
+            progress_callback(str(event))
 
-    async def get_metadata(self, url: str) -> List[TrackInfo]:
+    def _status(self, message: str, progress_callback=None, url: Optional[str] = None):
+        self._emit(ProgressEvent(events.STATUS, message, url=url), progress_callback)
+
+    @staticmethod
+    def _is_spotify_placeholder(tracks: List[TrackInfo]) -> bool:
+        return len(tracks) == 1 and tracks[0].title == SPOTIFY_PLACEHOLDER and tracks[0].source_id is None
+
+    async def get_metadata(self, url: str, refresh: bool = False) -> Sequence:
         """
         Detects source and fetches metadata.
+        Results are served from the metadata cache unless `refresh` is set.
         """
+        cache = self.metadata_cache
+        if cache is not None and not refresh:
+            cached = await asyncio.to_thread(cache.get, url)
+            if cached is not None:
+                return TrackList.from_dicts(cached)
+
         if "spotify.com" in url:
-            # Run in executor to avoid blocking
-            return await asyncio.to_thread(self._get_spotify_metadata, url)
+            tracks = await self._get_spotify_metadata(url)
+            if self._is_spotify_placeholder(tracks):
+                return tracks
         else:
-            return await asyncio.to_thread(self._get_yt_metadata, url)
+            # Run in executor to avoid blocking
+            tracks = await asyncio.to_thread(self._get_yt_metadata, url)
+
+        if cache is not None and tracks:
+            await asyncio.to_thread(cache.put, url, [t.to_dict() for t in tracks])
+        return tracks
+
+    async def iter_metadata(self, url: str, batch_size: int = 50, refresh: bool = False) -> AsyncIterator[List[TrackInfo]]:
+        """
+        Like get_metadata, but yields TrackInfo batches as the listing is paged in,
+        so callers can start on the first page while the rest is still loading.
+        """
+        if "spotify.com" in url:
+            yield await self.get_metadata(url, refresh=refresh)
+            return
+
+        cache = self.metadata_cache
+        if cache is not None and not refresh:
+            cached = await asyncio.to_thread(cache.get, url)
+            if cached is not None:
+                for i in range(0, len(cached), batch_size):
+                    yield [TrackInfo.from_dict(d) for d in cached[i:i + batch_size]]
+                return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for track in self._iter_yt_metadata(url, stop):
+                    loop.call_soon_threadsafe(queue.put_nowait, track)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        producer = loop.run_in_executor(None, produce)
+        collected = TrackList() # Compact copy for the cache
+        finished = False
+        try:
+            while not finished:
+                # Wait for one track, then take whatever else already arrived (one page, usually)
+                batch = [await queue.get()]
+                while len(batch) < batch_size and not queue.empty():
+                    batch.append(queue.get_nowait())
+                if batch[-1] is done:
+                    batch.pop()
+                    finished = True
+                if batch:
+                    collected.extend(batch)
+                    yield batch
+        finally:
+            # Stops the listing thread if the consumer gave up early
+            stop.set()
+        await producer
+
+        # Only complete listings reach this point and go into the cache
+        if cache is not None and collected:
+            await asyncio.to_thread(cache.put, url, collected.to_dicts())
 
     async def download(self, 
                        url: str, 
                        output_dir: str, 
                        format: str = 'wav', 
                        track_indices: Optional[List[int]] = None,
-                       progress_callback: Optional[Callable[[str], None]] = None):
+                       progress_callback: Optional[Callable[[str], None]] = None,
+                       tracks: Optional[Union[Sequence, AsyncIterator[List[TrackInfo]]]] = None,
+                       refresh_metadata: bool = False,
+                       force: bool = False,
+                       resume: bool = True):
         """
         Download logic.
+        `tracks` can be passed when metadata was already fetched (e.g. by the GUI)
+        to skip a second extraction, as a list or as an async iterator of batches
+        that are still being listed. `force` re-downloads tracks found in the archive.
+        With `resume`, an unfinished job for the same URL/output/format and
+        `track_indices` is continued: its finished tracks are skipped and its
+        staged ones go straight to FFmpeg. Callers passing a subset as `tracks`
+        should pass its indices as `track_indices` too, so it gets its own job.
         """
-        self.is_cancelled = False
+        self.reset_cancel()
+        self._cancel_waiter() # Bind the cancel event to this loop so cancel() can wake waiters
         
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        if "spotify.com" in url:
-            await self._download_spotify(url, output_dir, format, track_indices, progress_callback)
+        if "spotify.com" in url and (tracks is None or isinstance(tracks, Sequence)):
+            if tracks is None:
+                self._status("Resolving Spotify tracks...", progress_callback, url)
+                tracks = await self.get_metadata(url, refresh=refresh_metadata)
+            if self._is_spotify_placeholder(tracks):
+                await self._download_spotify(url, output_dir, format, track_indices, progress_callback)
+                return None
+
+        job = None
+        if self.job_store is not None and resume:
+            job = await asyncio.to_thread(self.job_store.open_job, url, output_dir, job_format(format, self.smart),
+                                          track_indices)
+            if job.total:
+                self._status(f"Resuming job #{job.id}: {job.done}/{job.total} tracks already done", progress_callback, url)
+
+        return await self._download_yt(url, output_dir, format, track_indices, progress_callback, tracks,
+                                       refresh_metadata, force, job)
+
+    async def _download_yt(self, url, output_dir, format, track_indices, progress_callback, tracks=None,
+                           refresh_metadata=False, force=False, job=None):
+        wanted = set(track_indices) if track_indices else None
+        job_id = job.id if job else None
+
+        if tracks is not None and not isinstance(tracks, Sequence):
+            # Still being listed by the caller: download each batch as it arrives
+            return await self.download_tracks(_filter_batches(tracks, wanted), output_dir, format,
+                                              progress_callback, force, job_id, url)
+
+        if tracks is None and job is not None and job.listed:
+            # The job already knows every track: no need to list the playlist again
+            tracks = [TrackInfo.from_dict(d) for d in await asyncio.to_thread(self.job_store.track_dicts, job.id)]
+            if not tracks:
+                await asyncio.to_thread(self.job_store.set_status, job.id, "done")
+                self._status("All done! (nothing left in this job)", progress_callback, url)
+                return DownloadReport()
+
+        if tracks is None:
+            self._status("Fetching metadata...", progress_callback, url)
+            # Start downloading the first page while the rest of the listing loads
+            batches = self.iter_metadata(url, refresh=refresh_metadata)
+            return await self.download_tracks(_filter_batches(batches, wanted), output_dir, format,
+                                              progress_callback, force, job_id, url)
+
+        if wanted:
+            tracks = [t for t in tracks if t.index in wanted]
+
+        if not tracks:
+            self._status("No tracks to download.", progress_callback, url)
+            return DownloadReport()
+
+        return await self.download_tracks(tracks, output_dir, format, progress_callback, force, job_id, url)
+
+    async def download_tracks(self,
+                              tracks: Union[Sequence, AsyncIterator[List[TrackInfo]]],
+                              output_dir: str,
+                              format: str = 'wav',
+                              progress_callback: Optional[Callable[[str], None]] = None,
+                              force: bool = False,
+                              job_id: Optional[int] = None,
+                              url: Optional[str] = None) -> DownloadReport:
+        """
+        Two-stage pipeline scheduler.
+        Stage 1 runs up to `self.jobs` yt-dlp fetches of the raw bestaudio stream,
+        each with its own retry budget and a slot from its host's limit.
+        Fetched files go through a bounded queue to stage 2, where
+        `self.transcoders` FFmpeg workers convert them to `format`.
+        This keeps the network busy while FFmpeg runs and vice versa.
+        The limits are shared with any other download running on this Downloader.
+
+        `tracks` is either a list or an async iterator of batches (see iter_metadata),
+        in which case fetching starts as soon as the first batch arrives.
+        With a `job_id`, every track state change is written to the job store.
+        Progress is published on `self.events`, tagged with `url`.
+        """
+        report = DownloadReport()
+        report.job_id = job_id
+        stats = report.stats
+        progress: Dict[int, float] = {}
+        staging_dir = os.path.join(output_dir, ".staging")
+        os.makedirs(staging_dir, exist_ok=True)
+
+        streaming = not isinstance(tracks, Sequence)
+        n_fetchers = self.max_jobs if streaming else min(self.max_jobs, len(tracks))
+        n_transcoders = self.transcoders if streaming else min(self.transcoders, len(tracks))
+
+        self.engine.ensure_workers(self.max_jobs)
+        fetch_slots, transcode_slots = self._limits()
+        controller = self.controller
+        self._concurrency_callback = progress_callback
+        received: Dict[int, int] = {} # Bytes of each track seen so far, for the controller
+        sources: Dict[int, Dict] = {} # Source format of each track, as reported by the engine
+        archive_formats = self.archive_formats(format)
+        if self.smart:
+            stats.smart = SmartStats(split_formats(format)[0])
+
+        pending = asyncio.Queue()
+        fetched = asyncio.Queue(maxsize=self.queue_size)
+
+        store = self.job_store if job_id is not None else None
+        done_keys, staged = set(), {}
+        if store is not None:
+            done_keys = await asyncio.to_thread(store.done_keys, job_id)
+            staged = await asyncio.to_thread(store.staged_paths, job_id)
+
+        async def set_state(track, state, **kwargs):
+            # Every job store write commits: off the event loop, like the archive's
+            if store is not None:
+                await asyncio.to_thread(store.set_state, job_id, track.key, state, **kwargs)
+
+        def overall() -> float:
+            return sum(progress.values()) / len(progress) if progress else 0.0
+
+        def emit_track(track, phase, **kwargs):
+            self._emit(ProgressEvent(
+                events.TRACK, url=url, track=track, phase=phase, percent=overall(),
+                completed=len(report.completed), failed=len(report.failed), total=len(progress),
+                queue_depth=stats.queue_depth, **kwargs
+            ), progress_callback if phase in (events.FINISHED, events.FAILED) else None)
+
+        def on_fetch_progress(track, done, total, speed):
+            if controller is not None:
+                # done drops back to 0 (or to a resumed offset) when a fetch restarts
+                controller.add_bytes(self._host(track.url), max(0, done - received.get(track.index, done)))
+                received[track.index] = done
+            if total:
+                # Leave headroom for the transcode stage
+                progress[track.index] = min(done / total, 1.0) * 90.0
+            self._emit(ProgressEvent(
+                events.PROGRESS, url=url, track=track, phase=events.FETCHING,
+                bytes_done=done, bytes_total=total, speed=speed, percent=overall(),
+                completed=len(report.completed), failed=len(report.failed), total=len(progress),
+                jobs=controller.describe() if controller is not None else None
+            ))
+
+        def on_format(track, source):
+            sources[track.index] = source
+
+        async def finish(track, ok, dest=None):
+            await set_state(track, DONE if ok else FAILED, path=dest)
+            if ok:
+                report.completed.append(track)
+                progress[track.index] = 100.0
+            else:
+                report.failed.append(track)
+            emit_track(track, events.FINISHED if ok else events.FAILED)
+
+        async def feeder():
+            batches = _as_batches(tracks)
+            complete = False
+            try:
+                async for batch in batches:
+                    if self.is_cancelled:
+                        break
+                    if store is not None:
+                        await asyncio.to_thread(store.add_tracks, job_id, batch)
+                        # Finished earlier in this job (e.g. before a pause or crash)
+                        done = [t for t in batch if t.key in done_keys]
+                        if done:
+                            report.skipped.extend(done)
+                            batch = [t for t in batch if t.key not in done_keys]
+                    # Tracks already in the archive are skipped before any network call
+                    if self.archive is not None and not force:
+                        archived = await asyncio.to_thread(
+                            lambda: [all(self.archive.lookup(t.key, f, output_dir) for f in archive_formats)
+                                     for t in batch]
+                        )
+                        skipped = [t for t, path in zip(batch, archived) if path]
+                        batch = [t for t, path in zip(batch, archived) if not path]
+                        if skipped:
+                            report.skipped.extend(skipped)
+                            self._status(f"Skipping {len(skipped)} tracks already downloaded", progress_callback, url)
+                    for t in batch:
+                        progress[t.index] = 0.0
+                        if t.key in staged:
+                            # Fetched before the interruption: straight to the transcoders
+                            await fetched.put((t, staged[t.key]))
+                        else:
+                            pending.put_nowait(t)
+                else:
+                    complete = not self.is_cancelled
+            finally:
+                if complete and store is not None:
+                    await asyncio.to_thread(store.mark_listed, job_id)
+                if streaming:
+                    await tracks.aclose()
+                for _ in range(n_fetchers):
+                    pending.put_nowait(None)
+
+        async def complete(track, written, source):
+            # written: (path, format, stream-copied) of every output file
+            if stats.smart is not None:
+                for dest, out_format, copied in written:
+                    line = stats.smart.record(track, source, out_format, copied, os.path.getsize(dest))
+                    self._status(line, progress_callback, url)
+            if self.archive is not None:
+                for f, dest in self._archive_entries(format, source, written):
+                    await asyncio.to_thread(self.archive.record, track.key, f, output_dir, dest)
+            await finish(track, True, written[0][0])
+
+        async def fetcher():
+            while not self.is_cancelled:
+                track = await pending.get()
+                if track is None:
+                    break
+                await set_state(track, DOWNLOADING)
+                if self.direct:
+                    base = os.path.join(output_dir, safe_filename(track.title))
+                    staged_fallback = False
+                    async with fetch_slots, self._host_slot(track.url):
+                        emit_track(track, events.FETCHING)
+                        started = time.monotonic()
+                        try:
+                            written = await self._stream_track(track, base, format, on_fetch_progress,
+                                                               transcode_slots, on_format, staging_dir)
+                        except CannotStream:
+                            written, staged_fallback = None, True
+                    received.pop(track.index, None)
+                    if self.is_cancelled:
+                        break
+                    if not staged_fallback:
+                        if written:
+                            stats.fetch.record(started, time.monotonic(),
+                                               sum(os.path.getsize(dest) for dest, _, _ in written))
+                            await complete(track, written, sources.pop(track.index, None))
+                        else:
+                            await finish(track, False)
+                        continue
+
+                async with fetch_slots, self._host_slot(track.url):
+                    emit_track(track, events.FETCHING)
+                    started = time.monotonic()
+                    path = await self._fetch_track(track, staging_dir, on_fetch_progress, on_format)
+                received.pop(track.index, None)
+
+                if self.is_cancelled:
+                    break
+                if path is None:
+                    await finish(track, False)
+                    continue
+                stats.fetch.record(started, time.monotonic(), os.path.getsize(path))
+                await set_state(track, TRANSCODING, bytes=os.path.getsize(path), path=path)
+                emit_track(track, events.TRANSCODING, bytes_done=os.path.getsize(path))
+
+                # Blocks while the transcoders are behind
+                await fetched.put((track, path))
+                stats.set_queue_depth(fetched.qsize())
+
+        async def transcoder():
+            while True:
+                item = await fetched.get()
+                stats.set_queue_depth(fetched.qsize())
+                if item is None:
+                    break
+                track, path = item
+                if self.is_cancelled:
+                    # Keep the staged file: resuming picks it up without refetching
+                    continue
+
+                try:
+                    # Reported by the engine, or guessed for a file staged before a restart
+                    source = sources.pop(track.index, None) or {'acodec': STAGED_CODECS.get(os.path.splitext(path)[1])}
+                    base = os.path.join(output_dir, safe_filename(track.title))
+                    outputs = [(f"{base}.{out_format}", out_format, copy)
+                               for out_format, copy in self._outputs(format, source)]
+                    cover = await self._fetch_cover(track, source, [f for _, f, _ in outputs], staging_dir)
+                    async with transcode_slots:
+                        started = time.monotonic()
+                        ok = await self._transcode(path, outputs, track, source, cover)
+                    if cover:
+                        self._remove_quietly(cover)
+                    if self.is_cancelled:
+                        continue
+                    self._remove_quietly(path)
+                    if ok:
+                        stats.transcode.record(started, time.monotonic(),
+                                               sum(os.path.getsize(dest) for dest, _, _ in outputs))
+                        await complete(track, outputs, source)
+                    else:
+                        await finish(track, False)
+                except Exception as e:
+                    # FFmpeg missing, a failed rename, an archive write...: this track
+                    # fails, the worker carries on with the rest of the queue
+                    print(f"[WARNING] Transcoding failed for {track.title}: {e}")
+                    await finish(track, False)
+
+        if self.adaptive:
+            self._status(f"Starting downloads ({self.per_host or self.jobs} per host, adapting between "
+                         f"{self.min_jobs} and {self.max_jobs}; {n_transcoders} transcoders)...", progress_callback, url)
         else:
-            await self._download_yt(url, output_dir, format, track_indices, progress_callback)
+            self._status(f"Starting downloads ({n_fetchers} at a time, {n_transcoders} transcoders)...", progress_callback, url)
+        if self.direct:
+            self._status("Streaming straight into FFmpeg (no staged files)", progress_callback, url)
 
-    async def _download_yt(self, url, output_dir, format, track_indices, progress_callback):
-        # Build yt-dlp command
-        # We use subprocess to allow immediate killing
-        import sys
-        
-        # Base command: python -m yt_dlp [url] ...
-        cmd = [sys.executable, "-m", "yt_dlp", url]
-        
-        # Output template
-        cmd.extend(["-o", os.path.join(output_dir, '%(title)s.%(ext)s')])
-        
-        # Audio extraction options
-        cmd.extend([
-            "-x", # Extract audio
-            "--audio-format", format,
-            "--audio-quality", "192K",
-            "--ffmpeg-location", self.ffmpeg_path,
-        ])
-        
-        # Playlist items
-        if track_indices:
-            items_str = ",".join(map(str, track_indices))
-            cmd.extend(["--playlist-items", items_str])
-        
-        # Other opts
-        cmd.extend([
-            "--newline", # Important for regex parsing
-            "--no-colors",
-            "--user-agent", 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        ])
-        
-        if progress_callback:
-            progress_callback(f"Starting download process...")
+        feed = asyncio.create_task(feeder())
+        fetchers = [asyncio.create_task(fetcher()) for _ in range(n_fetchers)]
+        transcoders = [asyncio.create_task(transcoder()) for _ in range(n_transcoders)]
 
-        self.current_process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        # Monitor output
-        import re
-        # Regex to capture progress: [download]  45.0% of 10.00MiB at 2.00MiB/s
-        progress_re = re.compile(r'\[download\]\s+(\d+\.\d+)%')
-        
-        while True:
-            if self.is_cancelled:
-                self.current_process.kill() # Hard kill for immediate stop
-                raise Exception("Download Cancelled by User")
-                
+        async def close_transcoders():
+            # Once stage 1 is done, one sentinel per transcoder
+            await asyncio.gather(feed, *fetchers)
+            for _ in transcoders:
+                await fetched.put(None)
+
+        closer = asyncio.create_task(close_transcoders())
+        workers = [feed, closer] + fetchers + transcoders
+        try:
+            # A worker dying ends the run instead of leaving the others blocked on the queues
+            done, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+            for w in done:
+                if not w.cancelled() and w.exception() is not None:
+                    raise w.exception()
+        except asyncio.CancelledError:
+            # This download alone was cancelled (e.g. one job of the API server)
+            if store is not None:
+                await asyncio.to_thread(store.set_status, job_id, "paused")
+            raise
+        finally:
+            for w in workers:
+                w.cancel()
             try:
-                line = await asyncio.wait_for(self.current_process.stdout.readline(), timeout=0.1)
-            except asyncio.TimeoutError:
-                 if self.current_process.returncode is not None:
-                     break
-                 continue
-
-            if not line:
-                break
-                
-            line_str = line.decode('utf-8', errors='replace').strip()
-            
-            # Parse progress
-            if line_str:
-                match = progress_re.search(line_str)
-                if match and progress_callback:
-                    p = match.group(1)
-                    progress_callback(f"Downloading: {p}%")
-                elif "[ExtractAudio]" in line_str and progress_callback:
-                    progress_callback("Converting audio...")
-                elif progress_callback:
-                    # Optional: verbose logging? 
-                    # progress_callback(f"yt-dlp: {line_str}")
-                    pass
+                os.rmdir(staging_dir)
+            except OSError:
+                pass
+
+        if store is not None:
+            await asyncio.to_thread(store.set_status, job_id,
+                                    "paused" if self.is_cancelled else "failed" if report.failed else "done")
 
-        await self.current_process.wait()
-        self.current_process = None
-        
         if self.is_cancelled:
             raise Exception("Download Cancelled by User")
-            
-        if self.current_process and self.current_process.returncode != 0:
-            # Check stderr?
-            # stderr = await self.current_process.stderr.read()
-            # print(stderr.decode())
+
+        if report.failed and not report.completed:
+            raise Exception(f"Download failed for all {len(report.failed)} tracks")
+
+        def done(message):
+            self._emit(ProgressEvent(events.DONE, message, url=url, percent=100.0,
+                                     completed=len(report.completed), failed=len(report.failed),
+                                     total=len(progress)), progress_callback)
+
+        if not progress:
+            done("All done! (nothing new to download)")
+            return report
+        self._status(str(stats), progress_callback, url)
+        done(f"All done! ({len(report.failed)} failed)" if report.failed else "All done!")
+        return report
+
+    @staticmethod
+    def _remove_quietly(path: str):
+        try:
+            os.remove(path)
+        except OSError:
             pass
 
-        if progress_callback:
-            progress_callback("All done!")
+    async def _fetch_track(self, track: TrackInfo, staging_dir, on_progress, on_format=None) -> Optional[str]:
+        """
+        Stage 1: fetch the raw audio stream of a single track, retrying with backoff on failure.
+        Returns the path of the fetched file, or None if every attempt failed.
+        """
+        return await self._with_retries(
+            track, on_progress,
+            lambda rate_limit: self.engine.fetch(track, staging_dir, on_progress, rate_limit, on_format)
+        )
+
+    async def _stream_track(self, track: TrackInfo, base: str, format: str, on_progress,
+                            transcode_slots: asyncio.Semaphore, on_format=None,
+                            staging_dir: Optional[str] = None) -> Optional[List[tuple]]:
+        """
+        Direct mode: both stages at once. The engine streams the source into
+        FFmpeg's stdin and FFmpeg writes `base` + the extension of each output
+        format, so nothing is staged on disk. A source already in the target
+        codec is stream-copied, without taking a transcode slot (unless another
+        output needs an encoder). Retries like _fetch_track.
+        Returns a list with the (path, format, copied) of each output written,
+        or None if every attempt failed.
+        Raises CannotStream when the track has to go through the staged path
+        (the engine can't stream it, or FFmpeg can't read it from a pipe).
+        """
+        async def try_once(rate_limit):
+            return await self._stream_once(track, base, format, on_progress, transcode_slots, rate_limit,
+                                           on_format, staging_dir)
+
+        return await self._with_retries(track, on_progress, try_once)
+
+    async def _stream_once(self, track, base, format, on_progress, transcode_slots, rate_limit,
+                           on_format, staging_dir) -> Optional[List[tuple]]:
+        state = {}
+
+        async def open_sink(source):
+            if on_format:
+                on_format(track, source)
+            state['outputs'] = outputs = [(f"{base}.{out_format}", out_format, copy)
+                                          for out_format, copy in self._outputs(format, source)]
+            tmp_outputs = [(f"{base}.tmp.{f}", f, copy) for _, f, copy in outputs]
+            if staging_dir:
+                state['cover'] = await self._fetch_cover(track, source, [f for _, f, _ in outputs], staging_dir)
+            if not all(copy for _, _, copy in outputs):
+                await transcode_slots.acquire()
+                state['slot'] = True
+            process = await asyncio.create_subprocess_exec(
+                *self._transcode_cmd("pipe:0", tmp_outputs, track, source, state.get('cover')),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            self.processes.add(process)
+            state['process'] = process
+            return process.stdin
+
+        streamed = False
+        try:
+            streamed = await self.engine.stream(track, open_sink, on_progress, rate_limit)
+        finally:
+            process = state.get('process')
+            if process is not None:
+                if not streamed and process.returncode is None:
+                    process.kill() # Failed or cancelled: don't let FFmpeg finish a truncated file
+                await process.wait()
+                self.processes.discard(process)
+                if not streamed:
+                    self._remove_outputs(state['outputs'], base)
+            if state.get('slot'):
+                transcode_slots.release()
+            if state.get('cover'):
+                self._remove_quietly(state['cover'])
 
-    # Removed _run_yt_dlp as it is no longer used
+        if process is None:
+            return None
+        if not streamed or process.returncode != 0 or self.is_cancelled:
+            self._remove_outputs(state['outputs'], base)
+            if streamed and not self.is_cancelled:
+                # The whole source arrived and FFmpeg still failed: it needs a seekable
+                # input (e.g. an MP4 with its index at the end), refetching won't help
+                raise CannotStream(track.url)
+            return None
+        for dest, f, _ in state['outputs']:
+            os.replace(f"{base}.tmp.{f}", dest)
+        return state['outputs']
+
+    def _remove_outputs(self, outputs, base: str):
+        # Temporary files of a failed or cancelled direct-mode run
+        for _, f, _ in outputs:
+            self._remove_quietly(f"{base}.tmp.{f}")
+
+    async def _with_retries(self, track: TrackInfo, on_progress, try_once: Callable):
+        """
+        Run `try_once(rate_limit)` until it returns something, with backoff
+        between tries and every outcome reported to the concurrency controller.
+        """
+        controller = self.controller
+        host = self._host(track.url)
+        for attempt in range(self.retries + 1):
+            if self.is_cancelled:
+                return None
+            if attempt:
+                if await self._sleep_unless_cancelled(2 ** attempt):
+                    return None
+                on_progress(track, 0, None, None)
+
+            rate_limit = controller.rate_per_track() if controller is not None else None
+            try:
+                path = await try_once(rate_limit)
+                throttled = False
+            except Throttled:
+                path, throttled = None, True
+            if controller is not None and not self.is_cancelled:
+                controller.record(host, ok=bool(path), throttled=throttled)
+            if path:
+                return path
+        return None
+
+    def _transcode_cmd(self, src: str, outputs: List[tuple], track: Optional[TrackInfo] = None,
+                       source: Optional[Dict] = None, cover: Optional[str] = None) -> List[str]:
+        """
+        One FFmpeg run that decodes `src` once and writes every (path, format, copy)
+        in `outputs`, each with its own encoder and post-processing options.
+        """
+        inputs, args = [], []
+        for dest, format, copy in outputs:
+            attach = cover if self.post_processing.wants_cover(format, source) else None
+            extra, options = self.post_processing.ffmpeg_args(track, format, source, attach)
+            inputs = inputs or extra # The cover is an input of its own, added once
+            args += [*options, *(['-c:a', 'copy'] if copy else AUDIO_CODECS[format]), dest]
+        return [
+            self.ffmpeg_path, "-hide_banner", "-nostdin", "-loglevel", "error", "-y",
+            "-i", src, *inputs,
+            *args,
+        ]
+
+    async def _fetch_cover(self, track: TrackInfo, source: Optional[Dict], formats: List[str],
+                           staging_dir: str) -> Optional[str]:
+        """
+        Download the track's thumbnail for embedding. None when cover art is
+        off, none of the containers can hold it or the download failed.
+        """
+        if not any(self.post_processing.wants_cover(f, source) for f in formats):
+            return None
+        path = os.path.join(staging_dir, f"{safe_filename(track.key)}.cover")
+
+        def fetch():
+            req = urllib.request.Request(source['thumbnail'], headers={'User-Agent': USER_AGENT})
+            opener = self.session.urlopen if self.session is not None else (lambda r: urllib.request.urlopen(r, timeout=30))
+            with opener(req) as resp, open(path, "wb") as f:
+                shutil.copyfileobj(resp, f)
+            return path
+
+        try:
+            return await asyncio.to_thread(fetch)
+        except Exception as e:
+            print(f"[WARNING] No cover art for {track.title}: {e}")
+            self._remove_quietly(path)
+            return None
+
+    async def _transcode(self, src: str, outputs: List[tuple], track: Optional[TrackInfo] = None,
+                         source: Optional[Dict] = None, cover: Optional[str] = None) -> bool:
+        """
+        Stage 2: convert a fetched file to every (path, format, copy) in `outputs`
+        with one FFmpeg run (remux only where `copy`), applying the post-processing
+        in the same run.
+        Writes to temporary names first so a killed FFmpeg never leaves a truncated file behind.
+        """
+        tmps = ["%s.tmp%s" % os.path.splitext(dest) for dest, _, _ in outputs]
+        process = await asyncio.create_subprocess_exec(
+            *self._transcode_cmd(src, [(tmp, f, copy) for tmp, (_, f, copy) in zip(tmps, outputs)],
+                                 track, source, cover),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        self.processes.add(process)
+        try:
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                # The download's task was cancelled
+                process.kill()
+                for tmp in tmps:
+                    self._remove_quietly(tmp)
+            self.processes.discard(process)
+
+        if process.returncode != 0 or self.is_cancelled:
+            for tmp in tmps:
+                self._remove_quietly(tmp)
+            return False
+        for tmp, (dest, _, _) in zip(tmps, outputs):
+            os.replace(tmp, dest)
+        return True
 
     async def _download_spotify(self, url, output_dir, format, track_indices, progress_callback):
-        if progress_callback:
-            progress_callback("Starting Spotify download (this may take a while)...")
+        self._status("Starting Spotify download (this may take a while)...", progress_callback, url)
+        formats = split_formats(format)
+        if len(formats) > 1:
+            # spotdl writes a single format
+            self._status(f"SpotDL fallback: only writing {formats[0]}", progress_callback, url)
+            format = formats[0]
             
         # Use python -m spotdl to ensure we use the venv version
         import sys
@@ -256,27 +1460,16 @@ class Downloader:
         self.current_process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.STDOUT # Drained with stdout, so a chatty run can't fill the pipe
         )
-        
-        # Monitor output for progress
-        while True:
-            if self.is_cancelled:
-                self.current_process.terminate()
-                raise Exception("Download Cancelled by User")
-                
-            try:
-                line = await asyncio.wait_for(self.current_process.stdout.readline(), timeout=0.5)
-            except asyncio.TimeoutError:
-                if self.current_process.returncode is not None:
-                    break
-                continue
-                
-            if not line:
-                break
-            line_str = line.decode().strip()
-            if line_str and progress_callback:
-                progress_callback(f"SpotDL: {line_str}")
+        if self.is_cancelled:
+            self.current_process.terminate()
+
+        # Monitor output for progress; cancel() terminates the process, which ends the stream
+        async for line in self.current_process.stdout:
+            line_str = line.decode(errors='replace').strip()
+            if line_str:
+                self._status(f"SpotDL: {line_str}", progress_callback, url)
                 
         await self.current_process.wait()
         self.current_process = None
@@ -284,5 +1477,4 @@ class Downloader:
         if self.is_cancelled:
              raise Exception("Download Cancelled by User")
              
-        if progress_callback:
-            progress_callback("Spotify download finished.")
+        self._status("Spotify download finished.", progress_callback, url)
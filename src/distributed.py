@@ -0,0 +1,442 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.core import Downloader, TrackInfo
+
+# Work unit states
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_PORT = 8770
+
+class WorkUnit:
+    """
+    A slice of a track listing, handed to one worker at a time under a lease.
+    """
+    def __init__(self, id: int, tracks: List[Dict], format: str, lease: float):
+        self.id = id
+        self.tracks = tracks # TrackInfo.to_dict() of each track
+        self.format = format
+        self.lease = lease # Seconds a worker may go without renewing
+        self.state = PENDING
+        self.worker: Optional[str] = None
+        self.expires = 0.0
+        self.attempts = 0
+        self.result: Optional[Dict] = None
+
+    def to_dict(self) -> Dict:
+        return {'id': self.id, 'tracks': self.tracks, 'format': self.format, 'lease': self.lease,
+                'attempts': self.attempts}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "WorkUnit":
+        unit = cls(d['id'], d['tracks'], d['format'], d['lease'])
+        unit.attempts = d.get('attempts', 0)
+        return unit
+
+def split_units(tracks: List[TrackInfo], format: str, unit_size: int = 25, lease: float = 300.0) -> List[WorkUnit]:
+    return [WorkUnit(n, [t.to_dict() for t in tracks[i:i + unit_size]], format, lease)
+            for n, i in enumerate(range(0, len(tracks), unit_size), 1)]
+
+class LeaseTable:
+    """
+    Coordinator-side bookkeeping of who holds which unit until when.
+    A lease that isn't renewed in time expires and the unit goes back to
+    pending for the next worker; after `max_attempts` leases it is given up.
+    The first result reported for a unit wins (a worker presumed dead may
+    still finish it).
+    """
+    def __init__(self, units: List[WorkUnit], max_attempts: int = 3,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.units: Dict[int, WorkUnit] = {u.id: u for u in units}
+        self.max_attempts = max_attempts
+        self.on_change = on_change
+
+    def _note(self, message: str):
+        if self.on_change:
+            self.on_change(message)
+
+    def assign(self, unit_id: int, worker: str, at: Optional[float] = None) -> Optional[WorkUnit]:
+        unit = self.units.get(unit_id)
+        if unit is None or unit.state != PENDING:
+            return None
+        unit.state, unit.worker = LEASED, worker
+        unit.expires = (at or time.time()) + unit.lease
+        unit.attempts += 1
+        self._note(f"Unit {unit.id} leased to {worker} (attempt {unit.attempts})")
+        return unit
+
+    def lease(self, worker: str) -> Optional[WorkUnit]:
+        self.expire()
+        for unit in self.units.values():
+            if unit.state == PENDING:
+                return self.assign(unit.id, worker)
+        return None
+
+    def renew(self, worker: str, unit_id: int, at: Optional[float] = None) -> bool:
+        unit = self.units.get(unit_id)
+        if unit is None or unit.state != LEASED or unit.worker != worker:
+            return False # Expired and handed to someone else, or already done
+        unit.expires = (at or time.time()) + unit.lease
+        return True
+
+    def complete(self, worker: str, unit_id: int, result: Dict) -> bool:
+        unit = self.units.get(unit_id)
+        if unit is None or unit.state in (DONE, FAILED):
+            return False
+        unit.state, unit.worker, unit.result = DONE, worker, result
+        self._note(f"Unit {unit.id} done by {worker}: {len(result.get('completed', []))} ok, "
+                   f"{len(result.get('failed', []))} failed, {len(result.get('skipped', []))} skipped "
+                   f"[{self.count(DONE)}/{len(self.units)} units]")
+        return True
+
+    def expire(self, now: Optional[float] = None) -> List[WorkUnit]:
+        """
+        Put back (or give up) every unit whose lease ran out; returns them.
+        """
+        now = now or time.time()
+        expired = []
+        for unit in self.units.values():
+            if unit.state == LEASED and unit.expires < now:
+                if unit.attempts >= self.max_attempts:
+                    unit.state = FAILED
+                    self._note(f"Unit {unit.id} given up after {unit.attempts} expired leases")
+                else:
+                    unit.state = PENDING
+                    self._note(f"Lease of unit {unit.id} by {unit.worker} expired, unit requeued")
+                unit.worker = None
+                expired.append(unit)
+        return expired
+
+    def count(self, state: str) -> int:
+        return sum(1 for u in self.units.values() if u.state == state)
+
+    @property
+    def finished(self) -> bool:
+        return all(u.state in (DONE, FAILED) for u in self.units.values())
+
+    def summary(self) -> str:
+        completed = failed = skipped = 0
+        for unit in self.units.values():
+            if unit.result:
+                completed += len(unit.result.get('completed', []))
+                failed += len(unit.result.get('failed', []))
+                skipped += len(unit.result.get('skipped', []))
+            elif unit.state == FAILED:
+                failed += len(unit.tracks)
+        workers = sorted({u.worker for u in self.units.values() if u.state == DONE})
+        return (f"{self.count(DONE)}/{len(self.units)} units done, {self.count(FAILED)} given up; "
+                f"{completed} tracks downloaded, {failed} failed, {skipped} skipped by {len(workers)} workers")
+
+# Transports. A coordinator serves a LeaseTable until every unit is finished:
+#   await coordinator.run(poll)
+# and workers reach it through a queue with the same three calls whatever the transport:
+#   await queue.lease() -> (WorkUnit or None, finished)
+#   await queue.renew(unit) -> bool (False: the lease was lost)
+#   await queue.complete(unit, result) -> bool
+# Connection problems raise OSError.
+
+class TcpCoordinator:
+    """
+    Serves the lease table over TCP, one JSON request line and one JSON reply per connection.
+    """
+    def __init__(self, table: LeaseTable, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        self.table = table
+        self.host = host
+        self.port = port
+
+    def _answer(self, request: Dict) -> Dict:
+        op, worker = request.get('op'), str(request.get('worker'))
+        if op == 'lease':
+            unit = self.table.lease(worker)
+            return {'unit': unit.to_dict() if unit else None, 'finished': self.table.finished}
+        if op == 'renew':
+            return {'ok': self.table.renew(worker, request.get('unit'))}
+        if op == 'complete':
+            return {'ok': self.table.complete(worker, request.get('unit'), request.get('result') or {})}
+        return {'error': f"Unknown op {op!r}"}
+
+    async def _handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            try:
+                reply = self._answer(json.loads(line))
+            except (ValueError, AttributeError):
+                reply = {'error': "Expected one JSON object per line"}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, poll: float = 2.0, linger: float = 10.0):
+        """
+        Serve until every unit is finished, then `linger` seconds more so
+        polling workers hear that there is nothing left.
+        """
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with server:
+            while not self.table.finished:
+                await asyncio.sleep(poll)
+                self.table.expire()
+            await asyncio.sleep(linger)
+
+class TcpQueue:
+    def __init__(self, host: str, port: int, worker: str):
+        self.host = host
+        self.port = port
+        self.worker = worker
+
+    async def _call(self, **request) -> Dict:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout=30)
+        try:
+            writer.write(json.dumps(dict(request, worker=self.worker)).encode() + b"\n")
+            await writer.drain()
+            line = await asyncio.wait_for(reader.readline(), timeout=30)
+        finally:
+            writer.close()
+        if not line:
+            raise ConnectionError("Coordinator closed the connection")
+        return json.loads(line)
+
+    async def lease(self) -> Tuple[Optional[WorkUnit], bool]:
+        reply = await self._call(op='lease')
+        return (WorkUnit.from_dict(reply['unit']) if reply.get('unit') else None), bool(reply.get('finished'))
+
+    async def renew(self, unit: WorkUnit) -> bool:
+        return bool((await self._call(op='renew', unit=unit.id)).get('ok'))
+
+    async def complete(self, unit: WorkUnit, result: Dict) -> bool:
+        return bool((await self._call(op='complete', unit=unit.id, result=result)).get('ok'))
+
+class FileCoordinator:
+    """
+    Shares the work through a directory every node can reach (local disk or a network share):
+      units/<id>.json           unit definitions
+      pending/<id>              up for grabs; a worker leases it by renaming it to
+      leased/<id>@<worker>      whose mtime is the worker's last heartbeat
+      results/<id>.json         what the worker reports back
+      finished                  written once every unit is done or given up
+    Renames are atomic, so two workers can never take the same unit.
+    """
+    def __init__(self, table: LeaseTable, directory: str):
+        self.table = table
+        self.directory = directory
+
+    def _path(self, *parts) -> str:
+        return os.path.join(self.directory, *parts)
+
+    def _setup(self):
+        if os.path.isdir(self.directory) and os.listdir(self.directory):
+            raise RuntimeError(f"Queue directory {self.directory} is not empty")
+        for sub in ("units", "pending", "leased", "results"):
+            os.makedirs(self._path(sub), exist_ok=True)
+        for unit in self.table.units.values():
+            with open(self._path("units", f"{unit.id}.json"), "w") as f:
+                json.dump(unit.to_dict(), f)
+            open(self._path("pending", str(unit.id)), "w").close()
+
+    def _sync(self):
+        for name in os.listdir(self._path("results")):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(self._path("results", name)) as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self.table.complete(result.get('worker', "?"), int(name[:-5]), result)
+
+        for name in os.listdir(self._path("leased")):
+            unit_id, _, worker = name.partition("@")
+            try:
+                heartbeat = os.path.getmtime(self._path("leased", name))
+            except OSError:
+                continue # Completed meanwhile
+            unit = self.table.units.get(int(unit_id))
+            if unit is None:
+                continue
+            if unit.state == PENDING:
+                self.table.assign(unit.id, worker, at=heartbeat)
+            else:
+                self.table.renew(worker, unit.id, at=heartbeat)
+
+        for unit in self.table.expire():
+            leases = [n for n in os.listdir(self._path("leased")) if n.startswith(f"{unit.id}@")]
+            for name in leases:
+                try:
+                    if unit.state == PENDING:
+                        os.rename(self._path("leased", name), self._path("pending", str(unit.id)))
+                    else:
+                        os.remove(self._path("leased", name))
+                except OSError:
+                    pass # The worker finished or gave it up just now
+
+    async def run(self, poll: float = 2.0, linger: float = 0.0):
+        await asyncio.to_thread(self._setup)
+        while not self.table.finished:
+            await asyncio.sleep(poll)
+            await asyncio.to_thread(self._sync)
+        open(self._path("finished"), "w").close()
+
+class FileQueue:
+    def __init__(self, directory: str, worker: str):
+        self.directory = directory
+        self.worker = worker.replace("@", "_").replace(os.sep, "_")
+
+    def _path(self, *parts) -> str:
+        return os.path.join(self.directory, *parts)
+
+    def _lease(self) -> Tuple[Optional[WorkUnit], bool]:
+        for name in sorted(os.listdir(self._path("pending")), key=int):
+            lease = self._path("leased", f"{name}@{self.worker}")
+            try:
+                os.rename(self._path("pending", name), lease)
+            except OSError:
+                continue # Another worker was faster
+            os.utime(lease)
+            with open(self._path("units", f"{name}.json")) as f:
+                return WorkUnit.from_dict(json.load(f)), False
+        return None, os.path.exists(self._path("finished"))
+
+    def _renew(self, unit: WorkUnit) -> bool:
+        try:
+            os.utime(self._path("leased", f"{unit.id}@{self.worker}"))
+            return True
+        except FileNotFoundError:
+            return False # Expired and put back by the coordinator
+
+    def _complete(self, unit: WorkUnit, result: Dict) -> bool:
+        path = self._path("results", f"{unit.id}.json")
+        first = not os.path.exists(path) # Else a worker presumed dead got there first
+        if first:
+            tmp = f"{path}.{self.worker}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(dict(result, worker=self.worker), f)
+            os.replace(tmp, path)
+        try:
+            os.remove(self._path("leased", f"{unit.id}@{self.worker}"))
+        except FileNotFoundError:
+            pass
+        return first
+
+    async def lease(self) -> Tuple[Optional[WorkUnit], bool]:
+        return await asyncio.to_thread(self._lease)
+
+    async def renew(self, unit: WorkUnit) -> bool:
+        return await asyncio.to_thread(self._renew, unit)
+
+    async def complete(self, unit: WorkUnit, result: Dict) -> bool:
+        return await asyncio.to_thread(self._complete, unit, result)
+
+def _tcp_address(spec: str) -> Tuple[str, int]:
+    host, _, port = spec[len("tcp://"):].rpartition(":")
+    return host or "127.0.0.1", int(port or DEFAULT_PORT)
+
+def open_coordinator(spec: str, table: LeaseTable):
+    """
+    "tcp://HOST:PORT" (address to listen on) or a shared queue directory.
+    """
+    if spec.startswith("tcp://"):
+        return TcpCoordinator(table, *_tcp_address(spec))
+    return FileCoordinator(table, spec)
+
+def open_queue(spec: str, worker: str):
+    """
+    "tcp://HOST:PORT" (the coordinator's address) or a shared queue directory.
+    """
+    if spec.startswith("tcp://"):
+        return TcpQueue(*_tcp_address(spec), worker)
+    if not os.path.isdir(os.path.join(spec, "pending")):
+        raise RuntimeError(f"{spec} is not a queue directory (start the coordinator first)")
+    return FileQueue(spec, worker)
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class Worker:
+    """
+    Pulls units from a queue and runs them through this node's Downloader,
+    renewing the lease while the unit is in progress. A unit whose lease
+    was lost (the coordinator gave it to someone else) is abandoned.
+    Stops when the coordinator reports that nothing is left, or can't be
+    reached `max_misses` times in a row.
+    """
+    def __init__(self, downloader: Downloader, queue, output_dir: str, poll: float = 2.0, max_misses: int = 5):
+        self.downloader = downloader
+        self.queue = queue
+        self.output_dir = output_dir
+        self.poll = poll
+        self.max_misses = max_misses
+        self.units_done = 0
+
+    async def run(self, progress_callback: Optional[Callable[[str], None]] = None) -> int:
+        misses = 0
+        while not self.downloader.is_cancelled:
+            try:
+                unit, finished = await self.queue.lease()
+                misses = 0
+            except (OSError, asyncio.TimeoutError) as e:
+                misses += 1
+                if misses >= self.max_misses:
+                    print(f"[WARNING] Coordinator unreachable, stopping: {e}")
+                    break
+                await asyncio.sleep(self.poll)
+                continue
+            if unit is None:
+                if finished:
+                    break
+                await asyncio.sleep(self.poll)
+                continue
+
+            if progress_callback:
+                progress_callback(f"Unit {unit.id}: {len(unit.tracks)} tracks to {unit.format}")
+            result = await self._run_unit(unit, progress_callback)
+            if result is None:
+                continue # Lease lost
+            try:
+                if await self.queue.complete(unit, result):
+                    self.units_done += 1
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"[WARNING] Could not report unit {unit.id}: {e}")
+        return self.units_done
+
+    async def _run_unit(self, unit: WorkUnit, progress_callback=None) -> Optional[Dict]:
+        tracks = [TrackInfo.from_dict(d) for d in unit.tracks]
+        started = time.monotonic()
+        task = asyncio.create_task(self.downloader.download_tracks(tracks, self.output_dir, unit.format,
+                                                                   progress_callback))
+        # Renew well before the lease runs out
+        while not task.done():
+            await asyncio.wait([task], timeout=unit.lease / 3)
+            if task.done():
+                break
+            try:
+                renewed = await self.queue.renew(unit)
+            except (OSError, asyncio.TimeoutError):
+                continue # Keep going; the next renewal may get through
+            if not renewed:
+                print(f"[WARNING] Lease of unit {unit.id} lost, abandoning it")
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return None
+
+        result = {'completed': [], 'failed': [], 'skipped': [], 'elapsed': round(time.monotonic() - started, 1)}
+        try:
+            report = task.result()
+        except Exception as e:
+            # All tracks failed, or the Downloader was cancelled
+            result['failed'] = [t.key for t in tracks]
+            result['error'] = str(e)
+            return result
+        result['completed'] = [t.key for t in report.completed]
+        result['failed'] = [t.key for t in report.failed]
+        result['skipped'] = [t.key for t in report.skipped]
+        return result
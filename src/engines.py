@@ -0,0 +1,579 @@
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from src.adaptive import is_throttled
+from src.fetch import SEGMENT_SIZE, FetchCancelled, FetchError, fetch_resumable, fetch_segmented, fetch_stream
+from src.session import USER_AGENT, YtSession
+
+# Try importing yt_dlp, handle if not installed (though it should be)
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+# Staged files are keyed by extractor + id so parallel jobs never collide
+STAGING_TEMPLATE = '%(extractor)s-%(id)s.%(ext)s'
+
+# Machine-readable progress line for the subprocess engine (missing values print as NA)
+PROGRESS_TEMPLATE = ('download:[progress] %(progress.downloaded_bytes)s %(progress.total_bytes)s '
+                     '%(progress.total_bytes_estimate)s %(progress.speed)s')
+PROGRESS_RE = re.compile(r'^\[progress\] (\S+) (\S+) (\S+) (\S+)$')
+
+# Printed before the download starts: what the chosen source format contains
+FORMAT_TEMPLATE = 'before_dl:[format] %(acodec)s %(ext)s %(asr)s %(audio_channels)s %(thumbnail)s'
+FORMAT_RE = re.compile(r'^\[format\] (\S+) (\S+) (\S+) (\S+) (\S+)$')
+
+# Fetch engines: both download the raw bestaudio stream of one track into a
+# staging directory and return its path (or None on failure).
+#   fetch(track, staging_dir, on_progress, rate_limit=None, on_format=None) -> Optional[str]
+# on_progress(track, bytes_done, bytes_total, speed) is always called on the
+# event loop thread; bytes_total and speed (bytes/s) may be None.
+# on_format(track, source) gets the chosen source format before the download
+# starts, as {'acodec', 'ext', 'asr', 'channels', 'thumbnail'} (values may be None).
+# rate_limit caps the fetch's bandwidth: bytes/s, or an adaptive.SharedBandwidth
+# that every fetch in flight draws from. A fetch the host refused
+# with 429 Too Many Requests raises Throttled instead of returning None.
+# Cancelling the awaiting task stops that fetch alone (cancel() stops them all).
+#
+# Both can also stream a track instead of staging it:
+#   stream(track, open_sink, on_progress, rate_limit=None) -> bool
+# Once the source format is known, `await open_sink(source)` (same dict as above)
+# returns an asyncio.StreamWriter (e.g. FFmpeg's stdin); the engine writes the
+# media into it, closes it and returns whether the whole stream got through.
+# Tracks that can't be streamed raise CannotStream before open_sink is called.
+#
+# With `segments` > 1, plain HTTP(S) sources are staged by fetch_segmented:
+# that many parallel Range requests of `segment_size` bytes each.
+
+class Throttled(Exception):
+    pass
+
+class CannotStream(Exception):
+    pass
+
+def _number(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _source(acodec, ext, asr=None, channels=None, thumbnail=None) -> dict:
+    # yt-dlp prints missing fields as NA and uses 'none' for "no audio"
+    def text(value):
+        return None if value in (None, 'NA', 'none') else str(value)
+    asr, channels = _number(asr), _number(channels)
+    return {'acodec': text(acodec), 'ext': text(ext),
+            'asr': int(asr) if asr else None, 'channels': int(channels) if channels else None,
+            'thumbnail': text(thumbnail)}
+
+def _source_of(info: dict) -> dict:
+    return _source(info.get('acodec'), info.get('ext'), info.get('asr'), info.get('audio_channels'),
+                   info.get('thumbnail'))
+
+def _is_plain_http(info: dict) -> bool:
+    # HLS, DASH and merged video+audio formats need yt-dlp's own downloaders
+    return bool(info.get('url')) and not info.get('requested_formats') and info.get('protocol') in ('http', 'https')
+
+def _fixed_rate(rate_limit) -> Optional[float]:
+    # yt-dlp's own downloaders take one rate for the whole download
+    return rate_limit.share() if hasattr(rate_limit, "share") else rate_limit
+
+def _fetch_http(info: dict, dest: str, report: Callable, should_stop: Callable,
+                urlopen: Optional[Callable] = None, rate_limit: Optional[float] = None,
+                segments: int = 1, segment_size: int = SEGMENT_SIZE) -> str:
+    """
+    Fetch a resolved plain HTTP(S) format to `dest`: segmented when enabled,
+    otherwise resumable. `report(done, total, speed)` as for the engines.
+    """
+    started = time.monotonic()
+    first = [] # Bytes already there when the first report came in (resumed files)
+
+    def on_bytes(done, total):
+        if not first:
+            first.append(done)
+        elapsed = time.monotonic() - started
+        report(done, total, (done - first[0]) / elapsed if elapsed > 0 else None)
+
+    headers = {'User-Agent': USER_AGENT}
+    headers.update(info.get('http_headers') or {})
+    options = dict(
+        source_url=info.get('webpage_url') or info['url'],
+        headers=headers,
+        expected_size=info.get('filesize'),
+        on_bytes=on_bytes,
+        should_stop=should_stop,
+        urlopen=urlopen,
+        rate_limit=rate_limit,
+    )
+    if segments > 1:
+        return fetch_segmented(info['url'], dest, segments=segments, segment_size=segment_size, **options)
+    chunk = (info.get('downloader_options') or {}).get('http_chunk_size')
+    return fetch_resumable(info['url'], dest, request_size=chunk, **options)
+
+class SubprocessEngine:
+    """
+    Runs `python -m yt_dlp` once per track.
+    Isolated and easy to kill, but pays interpreter start + extractor import every time.
+    """
+    name = "subprocess"
+
+    def __init__(self, workers: int = 4, session: Optional[YtSession] = None,
+                 segments: int = 1, segment_size: int = SEGMENT_SIZE):
+        # `workers` and `session` are unused: every fetch gets its own process (and connections)
+        self.processes = set()
+        self.is_cancelled = False
+        self.segments = max(1, segments)
+        self.segment_size = segment_size
+
+    def reset(self):
+        self.is_cancelled = False
+
+    def ensure_workers(self, workers: int):
+        pass
+
+    def cancel(self):
+        self.is_cancelled = True
+        for proc in list(self.processes):
+            try:
+                proc.kill()
+            except:
+                pass
+
+    def close(self):
+        pass
+
+    async def _resolve(self, track, staging_dir: str) -> Optional[dict]:
+        """
+        The chosen format's info JSON (with the staging 'filename'), without downloading.
+        """
+        cmd = [sys.executable, "-m", "yt_dlp", track.url, "--no-playlist",
+               "-o", os.path.join(staging_dir, STAGING_TEMPLATE),
+               "-f", "bestaudio/best",
+               "--dump-json",
+               "--no-colors",
+               "--user-agent", USER_AGENT]
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self.processes.add(process)
+        if self.is_cancelled:
+            process.kill()
+        try:
+            stdout, stderr = await process.communicate()
+        finally:
+            if process.returncode is None:
+                process.kill()
+            self.processes.discard(process)
+        if process.returncode != 0:
+            if is_throttled(stderr.decode('utf-8', errors='replace')):
+                raise Throttled(track.url)
+            return None
+        try:
+            return json.loads(stdout)
+        except ValueError:
+            return None
+
+    async def _fetch_segmented(self, track, staging_dir: str, on_progress: Callable,
+                               rate_limit: Optional[float], on_format: Optional[Callable]):
+        """
+        Resolve with yt-dlp, then fetch plain HTTP(S) formats here in parallel segments.
+        False when the format needs yt-dlp's own download (fetch() then runs it as usual).
+        """
+        info = await self._resolve(track, staging_dir)
+        if info is None:
+            return None
+        if not _is_plain_http(info) or not info.get('filename'):
+            return False
+        if on_format:
+            on_format(track, _source_of(info))
+        loop = asyncio.get_running_loop()
+
+        def report(done, total, speed):
+            loop.call_soon_threadsafe(on_progress, track, done, total, speed)
+
+        stop = threading.Event() # This fetch's task was cancelled
+        try:
+            return await asyncio.to_thread(
+                _fetch_http, info, info['filename'], report, lambda: self.is_cancelled or stop.is_set(),
+                rate_limit=rate_limit, segments=self.segments, segment_size=self.segment_size)
+        except asyncio.CancelledError:
+            stop.set()
+            raise
+        except FetchCancelled:
+            return None # Part file and sidecar are kept for the next attempt
+        except FetchError as e:
+            if is_throttled(str(e)):
+                raise Throttled(track.url)
+            return None
+
+    async def fetch(self, track, staging_dir: str, on_progress: Callable,
+                    rate_limit: Optional[float] = None, on_format: Optional[Callable] = None) -> Optional[str]:
+        if self.segments > 1:
+            filepath = await self._fetch_segmented(track, staging_dir, on_progress, rate_limit, on_format)
+            if filepath is not False:
+                return filepath
+
+        # Base command: python -m yt_dlp [url] ...
+        cmd = [sys.executable, "-m", "yt_dlp", track.url, "--no-playlist"]
+
+        # Output template
+        cmd.extend(["-o", os.path.join(staging_dir, STAGING_TEMPLATE)])
+
+        # Raw audio stream only, transcoding happens in stage 2
+        cmd.extend([
+            "-f", "bestaudio/best",
+            "--print", "after_move:filepath", # Implies --quiet, so turn progress back on
+            "--print", FORMAT_TEMPLATE,
+            "--progress",
+            "--progress-template", PROGRESS_TEMPLATE,
+            "--continue", # Pick up a kept .part file from a paused run
+        ])
+
+        # Other opts
+        cmd.extend([
+            "--newline", # One progress update per line
+            "--no-colors",
+            "--user-agent", USER_AGENT,
+        ])
+        if rate_limit:
+            cmd.extend(["--limit-rate", str(int(_fixed_rate(rate_limit)))])
+
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT # Read along with stdout, for the error lines
+        )
+        self.processes.add(process)
+        if self.is_cancelled:
+            # cancel() ran before this process existed
+            process.kill()
+
+        # No polling: cancel() kills the process, which ends the stream
+        filepath = None
+        throttled = False
+        staging = os.path.abspath(staging_dir)
+        try:
+            async for line in process.stdout:
+                line_str = line.decode('utf-8', errors='replace').strip()
+                match = PROGRESS_RE.match(line_str)
+                if match:
+                    done, total, estimate, speed = (_number(v) for v in match.groups())
+                    on_progress(track, int(done or 0), int(total or estimate or 0) or None, speed)
+                elif FORMAT_RE.match(line_str):
+                    if on_format:
+                        on_format(track, _source(*FORMAT_RE.match(line_str).groups()))
+                elif line_str.startswith("ERROR:"):
+                    throttled = throttled or is_throttled(line_str)
+                elif line_str and os.path.abspath(line_str).startswith(staging):
+                    filepath = line_str
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill() # The awaiting task was cancelled
+            self.processes.discard(process)
+
+        if throttled and process.returncode != 0:
+            raise Throttled(track.url)
+        if process.returncode != 0 or not filepath or not os.path.exists(filepath):
+            return None
+        return filepath
+
+    async def stream(self, track, open_sink: Callable, on_progress: Callable,
+                     rate_limit: Optional[float] = None) -> bool:
+        # Media goes to stdout; with `-o -` yt-dlp moves its own output to stderr
+        cmd = [sys.executable, "-m", "yt_dlp", track.url, "--no-playlist",
+               "-o", "-",
+               "-f", "bestaudio/best",
+               "--print", FORMAT_TEMPLATE,
+               "--progress",
+               "--progress-template", PROGRESS_TEMPLATE,
+               "--newline",
+               "--no-colors",
+               "--user-agent", USER_AGENT]
+        shared = rate_limit if hasattr(rate_limit, "wait") else None
+        if rate_limit and not shared:
+            cmd.extend(["--limit-rate", str(int(rate_limit))])
+
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self.processes.add(process)
+        if self.is_cancelled:
+            process.kill()
+
+        async def pipe(sink):
+            # Until yt-dlp's stdout ends or the sink (FFmpeg) goes away
+            piped = False
+            try:
+                while chunk := await process.stdout.read(256 * 1024):
+                    sink.write(chunk)
+                    await sink.drain()
+                    if shared:
+                        # Reading slower holds yt-dlp back through the pipe
+                        await shared.wait(len(chunk))
+                piped = True
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                sink.close()
+                if not piped and process.returncode is None:
+                    # Nobody reads its stdout anymore: yt-dlp would block on the
+                    # full pipe and never close stderr
+                    process.kill()
+            return piped
+
+        copier = None
+        throttled = False
+        try:
+            async for line in process.stderr:
+                line_str = line.decode('utf-8', errors='replace').strip()
+                match = PROGRESS_RE.match(line_str)
+                if match:
+                    done, total, estimate, speed = (_number(v) for v in match.groups())
+                    on_progress(track, int(done or 0), int(total or estimate or 0) or None, speed)
+                    continue
+                match = FORMAT_RE.match(line_str)
+                if match and copier is None:
+                    try:
+                        sink = await open_sink(_source(*match.groups()))
+                    except OSError as e:
+                        # FFmpeg missing or couldn't start: only this track fails
+                        print(f"[WARNING] Could not start FFmpeg for {track.title}: {e}")
+                        process.kill()
+                        break
+                    copier = asyncio.create_task(pipe(sink))
+                elif line_str.startswith("ERROR:"):
+                    throttled = throttled or is_throttled(line_str)
+            piped = await copier if copier is not None else False
+            await process.wait()
+        finally:
+            if copier is not None and not copier.done():
+                copier.cancel()
+            if process.returncode is None:
+                process.kill()
+            self.processes.discard(process)
+
+        if throttled and process.returncode != 0:
+            raise Throttled(track.url)
+        return piped and process.returncode == 0
+
+class InProcessEngine:
+    """
+    Drives yt_dlp.YoutubeDL on a pool of long-lived worker threads.
+    YoutubeDL instances come from a YtSession (normally the Downloader's),
+    so the interpreter start, extractor imports, HTTP connections and player
+    caches are paid once per session instead of once per track. Progress
+    comes from yt-dlp's progress hooks; cancelling sets a flag that the
+    hooks turn into DownloadCancelled.
+    """
+    name = "inprocess"
+
+    def __init__(self, workers: int = 4, session: Optional[YtSession] = None,
+                 segments: int = 1, segment_size: int = SEGMENT_SIZE):
+        if yt_dlp is None:
+            raise RuntimeError("The in-process engine needs the yt_dlp package")
+        self.session = session or YtSession()
+        self.session.add_progress_hook(self._progress_hook)
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="yt-dlp")
+        self._local = threading.local()
+        self._cancel_flag = threading.Event()
+        self.segments = max(1, segments)
+        self.segment_size = segment_size
+
+    def reset(self):
+        self._cancel_flag.clear()
+
+    def cancel(self):
+        self._cancel_flag.set()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def ensure_workers(self, workers: int):
+        """
+        Grow the thread pool when the job limit is raised.
+        """
+        if workers > self.workers:
+            self.executor.shutdown(wait=False)
+            self.workers = workers
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="yt-dlp")
+
+    def _stopped(self, stop: threading.Event) -> bool:
+        # cancel() for every fetch, `stop` for the one whose task was cancelled
+        return self._cancel_flag.is_set() or stop.is_set()
+
+    def _progress_hook(self, d):
+        report = getattr(self._local, "report", None)
+        if report is None:
+            return # Not one of our fetches (the session is shared)
+        if self._stopped(self._local.stop):
+            raise yt_dlp.utils.DownloadCancelled()
+        if d.get('status') != 'downloading':
+            return
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        report(d.get('downloaded_bytes', 0), int(total) if total else None, d.get('speed'))
+
+    def _fetch_direct(self, ydl, info: dict, report: Callable, rate_limit: Optional[float],
+                      stop: threading.Event) -> Optional[str]:
+        """
+        Plain HTTP(S) formats are fetched with fetch_resumable (or
+        fetch_segmented), so a paused or failed download continues from its
+        partial file via Range requests.
+        Returns None for formats yt-dlp has to download itself (HLS, DASH, merges).
+        """
+        if not _is_plain_http(info):
+            return None
+        dest = ydl.prepare_filename(info)
+        if os.path.exists(dest):
+            return dest
+        if self.segments > 1:
+            # Segments run on their own threads: each request borrows an idle instance
+            urlopen = self.session.urlopen
+        else:
+            urlopen = lambda req: self.session.urlopen(req, ydl)
+        return _fetch_http(info, dest, report, lambda: self._stopped(stop), urlopen, rate_limit,
+                           self.segments, self.segment_size)
+
+    def _fetch_blocking(self, url: str, staging_dir: str, report: Callable, stop: threading.Event,
+                        rate_limit: Optional[float] = None, on_format: Optional[Callable] = None) -> Optional[str]:
+        if self._stopped(stop):
+            return None
+        self._local.report = report
+        self._local.stop = stop
+        opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(staging_dir, STAGING_TEMPLATE),
+            'noplaylist': True,
+            'ratelimit': _fixed_rate(rate_limit),
+        }
+        try:
+            with self.session.borrow(**opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+                if not info:
+                    return None
+                if on_format:
+                    on_format(_source_of(info))
+                filepath = self._fetch_direct(ydl, info, report, rate_limit, stop)
+                if filepath:
+                    return filepath
+                info = ydl.process_ie_result(info, download=True)
+        except FetchCancelled:
+            # Partial file and sidecar are kept for the next attempt
+            return None
+        except Exception as e:
+            # FetchError, DownloadError, DownloadCancelled, network errors...
+            if is_throttled(str(e)):
+                raise Throttled(url)
+            return None
+        finally:
+            self._local.report = None
+
+        if not info:
+            return None
+        downloads = info.get('requested_downloads') or []
+        filepath = downloads[0].get('filepath') if downloads else None
+        if not filepath or not os.path.exists(filepath):
+            return None
+        return filepath
+
+    async def fetch(self, track, staging_dir: str, on_progress: Callable,
+                    rate_limit: Optional[float] = None, on_format: Optional[Callable] = None) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+
+        def report(done, total, speed):
+            loop.call_soon_threadsafe(on_progress, track, done, total, speed)
+
+        def report_format(source):
+            loop.call_soon_threadsafe(on_format, track, source)
+
+        stop = threading.Event()
+        try:
+            return await loop.run_in_executor(self.executor, self._fetch_blocking, track.url, staging_dir,
+                                              report, stop, rate_limit, report_format if on_format else None)
+        except asyncio.CancelledError:
+            stop.set() # The worker thread notices at its next progress update
+            raise
+
+    def _stream_blocking(self, url: str, open_sink: Callable, report: Callable,
+                         rate_limit: Optional[float], loop, stop: threading.Event) -> bool:
+        if self._stopped(stop):
+            return False
+        try:
+            with self.session.borrow(format='bestaudio/best', noplaylist=True) as ydl:
+                info = ydl.extract_info(url, download=False)
+                if not info:
+                    return False
+                if not _is_plain_http(info):
+                    raise CannotStream(url) # yt-dlp has to download those itself
+
+                def call(coro):
+                    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+                async def write(chunk):
+                    sink.write(chunk)
+                    await sink.drain()
+
+                started = time.monotonic()
+
+                def on_bytes(done, total):
+                    elapsed = time.monotonic() - started
+                    report(done, total, done / elapsed if elapsed > 0 else None)
+
+                headers = {'User-Agent': USER_AGENT}
+                headers.update(info.get('http_headers') or {})
+                sink = call(open_sink(_source_of(info)))
+                try:
+                    fetch_stream(
+                        info['url'], lambda chunk: call(write(chunk)),
+                        source_url=info.get('webpage_url') or info['url'],
+                        headers=headers,
+                        request_size=(info.get('downloader_options') or {}).get('http_chunk_size'),
+                        on_bytes=on_bytes,
+                        should_stop=lambda: self._stopped(stop),
+                        urlopen=lambda req: self.session.urlopen(req, ydl),
+                        rate_limit=rate_limit,
+                    )
+                finally:
+                    loop.call_soon_threadsafe(sink.close)
+                return True
+        except CannotStream:
+            raise
+        except (BrokenPipeError, ConnectionResetError, FetchCancelled):
+            # The sink went away (FFmpeg died or was killed), or we were cancelled
+            return False
+        except Exception as e:
+            if is_throttled(str(e)):
+                raise Throttled(url)
+            return False
+
+    async def stream(self, track, open_sink: Callable, on_progress: Callable,
+                     rate_limit: Optional[float] = None) -> bool:
+        loop = asyncio.get_running_loop()
+
+        def report(done, total, speed):
+            loop.call_soon_threadsafe(on_progress, track, done, total, speed)
+
+        stop = threading.Event()
+        try:
+            return await loop.run_in_executor(self.executor, self._stream_blocking, track.url, open_sink,
+                                              report, rate_limit, loop, stop)
+        except asyncio.CancelledError:
+            stop.set()
+            raise
+
+ENGINES = {
+    SubprocessEngine.name: SubprocessEngine,
+    InProcessEngine.name: InProcessEngine,
+}
@@ -0,0 +1,93 @@
+import asyncio
+from typing import List, Optional
+
+# Event kinds
+STATUS = "status" # Free-form status line ("Fetching metadata...", stats, ...)
+PROGRESS = "progress" # Bytes of one track arrived
+TRACK = "track" # A track changed phase (see below)
+DONE = "done" # A download run finished
+CONCURRENCY = "concurrency" # The adaptive controller changed a host's limit
+
+# Track phases, in pipeline order
+FETCHING = "fetching"
+TRANSCODING = "transcoding"
+FINISHED = "finished"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+class ProgressEvent:
+    """
+    One structured progress update from a Downloader.
+    `percent` is the overall progress of the run the event belongs to (`url`);
+    the byte fields and `speed` (bytes/s) describe `track` alone.
+    `jobs` is the concurrency controller's state line, when one is running.
+    str(event) gives the human-readable line for logs.
+    """
+    def __init__(self, kind: str, message: str = "", url: Optional[str] = None, track=None,
+                 phase: Optional[str] = None, bytes_done: int = 0, bytes_total: Optional[int] = None,
+                 speed: Optional[float] = None, percent: Optional[float] = None,
+                 completed: int = 0, failed: int = 0, total: int = 0, queue_depth: int = 0,
+                 jobs: Optional[str] = None):
+        self.kind = kind
+        self.message = message
+        self.url = url
+        self.track = track
+        self.phase = phase
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.speed = speed
+        self.percent = percent
+        self.completed = completed
+        self.failed = failed
+        self.total = total
+        self.queue_depth = queue_depth
+        self.jobs = jobs
+
+    @property
+    def track_id(self) -> Optional[str]:
+        return self.track.key if self.track is not None else None
+
+    def __str__(self):
+        if self.kind == PROGRESS:
+            return f"Downloading: {self.percent or 0.0:.1f}%"
+        if self.kind == TRACK and self.phase in (FINISHED, FAILED):
+            status = "Finished" if self.phase == FINISHED else "Failed"
+            return f"{status} [{self.completed + self.failed}/{self.total}]: {self.track.title} (queue: {self.queue_depth})"
+        if self.kind == TRACK and not self.message:
+            return f"{self.phase.capitalize()}: {self.track.title}"
+        return self.message
+
+    def __repr__(self):
+        return f"<ProgressEvent {self.kind} {self.phase or ''} {self.track_id or self.message!r}>"
+
+class ProgressBus:
+    """
+    Fans progress events out to subscriber queues.
+    Publishing never blocks: when a bounded subscriber queue is full, its
+    oldest event is dropped, so a slow consumer (e.g. a UI) only ever
+    falls behind on stale progress instead of stalling the downloads.
+    Publish from the event loop thread.
+    """
+    def __init__(self):
+        self._queues: List[asyncio.Queue] = []
+
+    def subscribe(self, maxsize: int = 0) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=maxsize)
+        self._queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """
+        Stop delivering to `queue` and wake its consumer with a None sentinel.
+        """
+        if queue in self._queues:
+            self._queues.remove(queue)
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def publish(self, event: ProgressEvent):
+        for queue in self._queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
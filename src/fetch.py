@@ -0,0 +1,392 @@
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+CHUNK_SIZE = 256 * 1024 # Read size
+SEGMENT_SIZE = 8 * 1024 * 1024 # Default byte range per request for fetch_segmented
+
+# Content-Range: bytes 0-1023/4096
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+class FetchCancelled(Exception):
+    pass
+
+class FetchError(Exception):
+    pass
+
+def _sidecar_path(part_path: str) -> str:
+    return part_path + ".json"
+
+def _load_sidecar(part_path: str) -> Optional[Dict]:
+    try:
+        with open(_sidecar_path(part_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_sidecar(part_path: str, meta: Dict):
+    tmp = _sidecar_path(part_path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, _sidecar_path(part_path))
+
+def _pace(rate_limit, n: int, transferred: int, started: float):
+    # After `n` more bytes (`transferred` since `started`), sleep until within
+    # rate_limit: bytes/s for this fetch alone, or a shared budget with take(n)
+    # (adaptive.SharedBandwidth) that every fetch in flight draws from
+    if hasattr(rate_limit, "take"):
+        rate_limit.take(n)
+    elif rate_limit:
+        ahead = transferred / rate_limit - (time.monotonic() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def fetch_resumable(media_url: str,
+                    dest: str,
+                    source_url: str,
+                    headers: Optional[Dict[str, str]] = None,
+                    expected_size: Optional[int] = None,
+                    request_size: Optional[int] = None,
+                    on_bytes: Optional[Callable[[int, Optional[int]], None]] = None,
+                    should_stop: Optional[Callable[[], bool]] = None,
+                    urlopen: Optional[Callable] = None,
+                    rate_limit: Optional[float] = None) -> str:
+    """
+    Download `media_url` to `dest`, continuing an earlier partial download if possible.
+
+    Data goes to `dest.part`, with a `dest.part.json` sidecar recording the
+    source (track page) URL, the expected size and the server's validator
+    (ETag / Last-Modified). On the next call the remaining bytes are requested
+    with `Range` + `If-Range`, so a changed file is refetched from scratch
+    instead of being spliced. Media URLs usually expire, so the sidecar is
+    matched on the source URL and size, not on `media_url`.
+
+    `request_size` splits the transfer into Range requests of that many bytes
+    (some hosts throttle long single requests).
+    Stopping (via `should_stop`) keeps the part file and sidecar and raises FetchCancelled.
+    `urlopen(request)` can be swapped for a pooled opener (see YtSession.urlopen).
+    `rate_limit` (bytes/s) paces the reads so this call stays under it on average;
+    a shared budget (adaptive.SharedBandwidth) paces it along with other fetches.
+    """
+    part = dest + ".part"
+    urlopen = urlopen or (lambda req: urllib.request.urlopen(req, timeout=30))
+    base_headers = dict(headers or {})
+
+    offset = 0
+    meta = _load_sidecar(part)
+    if (meta and os.path.exists(part) and meta.get("source_url") == source_url
+            and "segment_size" not in meta # A preallocated segmented part isn't a prefix
+            and (expected_size is None or meta.get("expected_size") in (None, expected_size))):
+        offset = os.path.getsize(part)
+    else:
+        meta = {"source_url": source_url, "expected_size": expected_size}
+    total = expected_size or meta.get("expected_size")
+
+    started = time.monotonic()
+    transferred = 0 # Bytes received by this call, for rate_limit
+
+    f = open(part, "ab" if offset else "wb")
+    try:
+        while total is None or offset < total:
+            req_headers = dict(base_headers)
+            if offset or request_size:
+                end = offset + request_size - 1 if request_size else ""
+                req_headers["Range"] = f"bytes={offset}-{end}"
+                validator = meta.get("etag") or meta.get("last_modified")
+                if offset and validator:
+                    req_headers["If-Range"] = validator
+
+            try:
+                resp = urlopen(urllib.request.Request(media_url, headers=req_headers))
+            except urllib.error.HTTPError as e:
+                raise FetchError(f"HTTP {e.code} for {source_url}")
+            except OSError as e:
+                raise FetchError(str(e))
+
+            with resp:
+                if resp.status == 206:
+                    match = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+                    if match and match.group(3) != "*":
+                        total = int(match.group(3))
+                else:
+                    # Range ignored or validator changed: start over
+                    if offset:
+                        f.seek(0)
+                        f.truncate()
+                        offset = 0
+                    length = resp.headers.get("Content-Length")
+                    total = int(length) if length is not None else total
+
+                if expected_size is not None and total is not None and total != expected_size:
+                    raise FetchError(f"Size mismatch for {source_url}: server has {total}, expected {expected_size}")
+
+                meta.update({
+                    "expected_size": total,
+                    "etag": resp.headers.get("ETag") or meta.get("etag"),
+                    "last_modified": resp.headers.get("Last-Modified") or meta.get("last_modified"),
+                })
+                _save_sidecar(part, meta)
+
+                received = 0
+                while True:
+                    if should_stop and should_stop():
+                        raise FetchCancelled()
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    offset += len(chunk)
+                    received += len(chunk)
+                    transferred += len(chunk)
+                    if on_bytes:
+                        on_bytes(offset, total)
+                    _pace(rate_limit, len(chunk), transferred, started)
+
+            if resp.status != 206 or not received:
+                # Whole body in one response (or nothing more to get)
+                break
+    finally:
+        f.close()
+
+    if total is not None and offset != total:
+        # Connection dropped early: keep the part for the next attempt
+        raise FetchError(f"Incomplete download of {source_url}: {offset}/{total} bytes")
+
+    os.replace(part, dest)
+    try:
+        os.remove(_sidecar_path(part))
+    except OSError:
+        pass
+    return dest
+
+def fetch_stream(media_url: str,
+                 write: Callable[[bytes], None],
+                 source_url: str,
+                 headers: Optional[Dict[str, str]] = None,
+                 request_size: Optional[int] = None,
+                 on_bytes: Optional[Callable[[int, Optional[int]], None]] = None,
+                 should_stop: Optional[Callable[[], bool]] = None,
+                 urlopen: Optional[Callable] = None,
+                 rate_limit: Optional[float] = None) -> int:
+    """
+    Download `media_url` into `write(chunk)` instead of a file (e.g. an FFmpeg pipe).
+    Nothing touches the disk, so there is nothing to resume either: an error
+    or a stop (FetchCancelled) means starting over. Same options as fetch_resumable.
+    Returns the number of bytes written.
+    """
+    urlopen = urlopen or (lambda req: urllib.request.urlopen(req, timeout=30))
+    started = time.monotonic()
+    offset = 0
+    total = None
+    while total is None or offset < total:
+        req_headers = dict(headers or {})
+        if request_size:
+            req_headers["Range"] = f"bytes={offset}-{offset + request_size - 1}"
+        try:
+            resp = urlopen(urllib.request.Request(media_url, headers=req_headers))
+        except urllib.error.HTTPError as e:
+            raise FetchError(f"HTTP {e.code} for {source_url}")
+        except OSError as e:
+            raise FetchError(str(e))
+
+        with resp:
+            if resp.status == 206:
+                match = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+                if match and match.group(3) != "*":
+                    total = int(match.group(3))
+            elif offset:
+                # Can't splice a full response onto what was already written
+                raise FetchError(f"Server ignored the Range request for {source_url}")
+            else:
+                length = resp.headers.get("Content-Length")
+                total = int(length) if length is not None else None
+
+            received = 0
+            while True:
+                if should_stop and should_stop():
+                    raise FetchCancelled()
+                chunk = resp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                write(chunk)
+                offset += len(chunk)
+                received += len(chunk)
+                if on_bytes:
+                    on_bytes(offset, total)
+                _pace(rate_limit, len(chunk), offset, started)
+
+        if resp.status != 206 or not received:
+            break
+
+    if total is not None and offset != total:
+        raise FetchError(f"Incomplete download of {source_url}: {offset}/{total} bytes")
+    return offset
+
+def _probe(media_url: str, headers: Dict[str, str], source_url: str, urlopen: Callable):
+    """
+    (total size, validator) from a one-byte Range request; (None, None) when
+    the server doesn't answer Range requests with a sized 206.
+    """
+    req_headers = dict(headers, Range="bytes=0-0")
+    try:
+        resp = urlopen(urllib.request.Request(media_url, headers=req_headers))
+    except urllib.error.HTTPError as e:
+        raise FetchError(f"HTTP {e.code} for {source_url}")
+    except OSError as e:
+        raise FetchError(str(e))
+    with resp:
+        match = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+        if resp.status != 206 or not match or match.group(3) == "*":
+            return None, None
+        resp.read()
+        return int(match.group(3)), resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+
+def _preallocate(fd: int, size: int):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not on this platform / filesystem: a sparse file of the right length will do
+        os.ftruncate(fd, size)
+
+def fetch_segmented(media_url: str,
+                    dest: str,
+                    source_url: str,
+                    headers: Optional[Dict[str, str]] = None,
+                    expected_size: Optional[int] = None,
+                    segments: int = 4,
+                    segment_size: int = SEGMENT_SIZE,
+                    on_bytes: Optional[Callable[[int, Optional[int]], None]] = None,
+                    should_stop: Optional[Callable[[], bool]] = None,
+                    urlopen: Optional[Callable] = None,
+                    rate_limit: Optional[float] = None) -> str:
+    """
+    Download `media_url` to `dest` over `segments` parallel connections.
+
+    The file is cut into `segment_size` byte ranges which the connections
+    take in turn. Each range is written in place into `dest.part`,
+    preallocated to the full size, so memory use stays at one read buffer per
+    connection whatever the file size. Every response has to be a 206 for
+    exactly the requested range of a file of the probed total (`If-Range`
+    makes a changed file come back as a 200, which fails this attempt and
+    makes the next one start over).
+    The finished ranges are listed in the `dest.part.json` sidecar, so an
+    interrupted download only refetches the missing ones.
+
+    Servers that ignore Range requests get a plain fetch_resumable.
+    `urlopen` is called from several threads at once. Otherwise the
+    options are the same as fetch_resumable's.
+    """
+    part = dest + ".part"
+    urlopen = urlopen or (lambda req: urllib.request.urlopen(req, timeout=30))
+    base_headers = dict(headers or {})
+
+    meta = _load_sidecar(part)
+    if not (meta and os.path.exists(part) and meta.get("source_url") == source_url
+            and meta.get("segment_size") == segment_size and "done" in meta
+            and (expected_size is None or meta.get("expected_size") == expected_size)):
+        total, validator = _probe(media_url, base_headers, source_url, urlopen)
+        if total is None:
+            return fetch_resumable(media_url, dest, source_url, headers, expected_size,
+                                   on_bytes=on_bytes, should_stop=should_stop, urlopen=urlopen,
+                                   rate_limit=rate_limit)
+        if expected_size is not None and total != expected_size:
+            raise FetchError(f"Size mismatch for {source_url}: server has {total}, expected {expected_size}")
+        meta = {"source_url": source_url, "expected_size": total, "segment_size": segment_size,
+                "etag": validator, "done": []}
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _preallocate(fd, total)
+        finally:
+            os.close(fd)
+        _save_sidecar(part, meta)
+
+    total = meta["expected_size"]
+    ranges = [(start, min(start + segment_size, total) - 1) for start in range(0, total, segment_size)]
+    done = set(meta["done"])
+    lock = threading.Lock()
+    stop = threading.Event() # One range failed: the others give up too
+    stale = threading.Event() # The server's file is not the one in the part file
+    received = [sum(end - start + 1 for i, (start, end) in enumerate(ranges) if i in done)]
+    resumed_from = received[0]
+    started = time.monotonic()
+
+    def fetch_range(index: int, start: int, end: int):
+        req_headers = dict(base_headers, Range=f"bytes={start}-{end}")
+        if meta.get("etag"):
+            req_headers["If-Range"] = meta["etag"]
+        if stop.is_set() or (should_stop and should_stop()):
+            raise FetchCancelled()
+        try:
+            resp = urlopen(urllib.request.Request(media_url, headers=req_headers))
+        except urllib.error.HTTPError as e:
+            raise FetchError(f"HTTP {e.code} for {source_url}")
+        except OSError as e:
+            raise FetchError(str(e))
+
+        with resp:
+            match = CONTENT_RANGE_RE.match(resp.headers.get("Content-Range", ""))
+            if (resp.status != 206 or not match or int(match.group(1)) != start
+                    or match.group(3) not in ("*", str(total))):
+                stale.set()
+                raise FetchError(f"{source_url} changed or ignored the range {start}-{end}")
+            pos = start
+            while pos <= end:
+                if stop.is_set() or (should_stop and should_stop()):
+                    raise FetchCancelled()
+                chunk = resp.read(min(CHUNK_SIZE, end + 1 - pos))
+                if not chunk:
+                    break
+                os.pwrite(fd, chunk, pos)
+                pos += len(chunk)
+                with lock:
+                    received[0] += len(chunk)
+                    now = received[0]
+                if on_bytes:
+                    on_bytes(now, total)
+                _pace(rate_limit, len(chunk), now - resumed_from, started)
+            if pos != end + 1:
+                raise FetchError(f"Incomplete range {start}-{end} of {source_url}: {pos - start}/{end + 1 - start} bytes")
+
+        with lock:
+            done.add(index)
+            meta["done"] = sorted(done)
+            _save_sidecar(part, meta)
+
+    fd = os.open(part, os.O_WRONLY)
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, segments), thread_name_prefix="segment") as pool:
+            futures = [pool.submit(fetch_range, i, start, end)
+                       for i, (start, end) in enumerate(ranges) if i not in done]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    stop.set()
+                    errors.append(e)
+    finally:
+        os.close(fd)
+
+    if stale.is_set():
+        try:
+            os.remove(_sidecar_path(part))
+        except OSError:
+            pass
+    if errors:
+        # Report the cause rather than the ranges that stopped because of it
+        raise next((e for e in errors if not isinstance(e, FetchCancelled)), errors[0])
+    if len(done) != len(ranges) or os.path.getsize(part) != total:
+        raise FetchError(f"Incomplete download of {source_url}: {len(done)}/{len(ranges)} ranges")
+
+    os.replace(part, dest)
+    try:
+        os.remove(_sidecar_path(part))
+    except OSError:
+        pass
+    return dest
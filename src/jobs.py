@@ -0,0 +1,223 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from src.cache import DEFAULT_STATE_DIR, normalize_url
+
+# Per-track states, in pipeline order
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+TRANSCODING = "transcoding" # Raw file fetched and staged, waiting for / inside FFmpeg
+DONE = "done"
+FAILED = "failed"
+
+def selection_key(indices: Optional[Iterable[int]]) -> str:
+    """
+    Canonical form of a track selection, as ranges: [1, 2, 3, 5] -> "1-3,5".
+    "" is the whole playlist.
+    """
+    ranges = []
+    for i in sorted(set(indices or ())):
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def selection_indices(key: str) -> Optional[List[int]]:
+    """
+    The track indices of a selection_key (None for the whole playlist).
+    """
+    if not key:
+        return None
+    indices = []
+    for part in key.split(","):
+        start, _, end = part.partition("-")
+        indices.extend(range(int(start), int(end or start) + 1))
+    return indices
+
+class JobInfo:
+    def __init__(self, id: int, url: str, output_dir: str, format: str, status: str, listed: bool,
+                 done: int = 0, total: int = 0, selection: str = ""):
+        self.id = id
+        self.url = url
+        self.output_dir = output_dir
+        self.format = format
+        self.status = status # running / paused / failed / done
+        self.listed = listed # Whole track listing (of the selection) has been recorded
+        self.done = done
+        self.total = total
+        self.selection = selection # Selected playlist items, see selection_key ("" = all)
+
+    @property
+    def track_indices(self) -> Optional[List[int]]:
+        return selection_indices(self.selection)
+
+    def __repr__(self):
+        items = f" items {self.selection}" if self.selection else ""
+        return f"#{self.id} {self.url} ({self.format}){items} {self.status} {self.done}/{self.total}"
+
+class JobStore:
+    """
+    Durable record of download jobs and the state of every track in them
+    (SQLite in WAL mode, one row update per state change). A job for the same
+    URL/output/format/selection that didn't finish is picked up again instead of
+    starting over, so finished tracks are never redone after a pause, crash or reboot.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(DEFAULT_STATE_DIR, "jobs.db")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL: a crash mid-write never corrupts earlier state, and commits are cheap
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                url_key TEXT NOT NULL,
+                output_dir TEXT NOT NULL,
+                format TEXT NOT NULL,
+                status TEXT NOT NULL,
+                listed INTEGER NOT NULL DEFAULT 0,
+                selection TEXT NOT NULL DEFAULT '',
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_tracks (
+                job_id INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                track TEXT NOT NULL,
+                state TEXT NOT NULL,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                path TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (job_id, key)
+            );
+        """)
+        # Stores from before track selections were part of the job key
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        if "selection" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN selection TEXT NOT NULL DEFAULT ''")
+        self._db.commit()
+
+    def _job(self, row) -> JobInfo:
+        job_id = row[0]
+        done, total = self._db.execute(
+            "SELECT COALESCE(SUM(state = ?), 0), COUNT(*) FROM job_tracks WHERE job_id = ?", (DONE, job_id)
+        ).fetchone()
+        return JobInfo(job_id, row[1], row[2], row[3], row[4], bool(row[5]), done, total, row[6])
+
+    def open_job(self, url: str, output_dir: str, format: str,
+                 track_indices: Optional[Iterable[int]] = None) -> JobInfo:
+        """
+        The unfinished job for this URL/output/format and track selection, or a new one.
+        A job that ended with failures is listed again when reopened: its recorded
+        listing may be stale, and finished tracks are skipped either way.
+        """
+        output_dir = os.path.abspath(output_dir)
+        selection = selection_key(track_indices)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, url, output_dir, format, status, listed, selection FROM jobs "
+                "WHERE url_key = ? AND output_dir = ? AND format = ? AND selection = ? AND status != 'done' "
+                "ORDER BY id DESC LIMIT 1",
+                (normalize_url(url), output_dir, format, selection)
+            ).fetchone()
+            if row is None:
+                cur = self._db.execute(
+                    "INSERT INTO jobs (url, url_key, output_dir, format, selection, status, created, updated) "
+                    "VALUES (?, ?, ?, ?, ?, 'running', ?, ?)",
+                    (url, normalize_url(url), output_dir, format, selection, now, now)
+                )
+                row = (cur.lastrowid, url, output_dir, format, "running", 0, selection)
+            else:
+                listed = row[5] and row[4] != "failed"
+                self._db.execute("UPDATE jobs SET status = 'running', listed = ?, updated = ? WHERE id = ?",
+                                 (int(listed), now, row[0]))
+                row = row[:4] + ("running", listed, selection)
+            self._db.commit()
+            return self._job(row)
+
+    def get_job(self, job_id: int) -> Optional[JobInfo]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, url, output_dir, format, status, listed, selection FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            return self._job(row) if row else None
+
+    def unfinished_jobs(self) -> List[JobInfo]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, url, output_dir, format, status, listed, selection FROM jobs "
+                "WHERE status != 'done' ORDER BY updated DESC"
+            ).fetchall()
+            return [self._job(row) for row in rows]
+
+    def set_status(self, job_id: int, status: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (status, time.time(), job_id))
+            self._db.commit()
+
+    def mark_listed(self, job_id: int):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET listed = 1, updated = ? WHERE id = ?", (time.time(), job_id))
+            self._db.commit()
+
+    def add_tracks(self, job_id: int, tracks: list):
+        """
+        Record tracks as queued; tracks the job already knows keep their state.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO job_tracks (job_id, key, position, track, state, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, t.key, t.index, json.dumps(t.to_dict()), QUEUED, now) for t in tracks]
+            )
+            self._db.commit()
+
+    def set_state(self, job_id: int, key: str, state: str, bytes: Optional[int] = None, path: Optional[str] = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE job_tracks SET state = ?, bytes = COALESCE(?, bytes), path = COALESCE(?, path), updated = ? "
+                "WHERE job_id = ? AND key = ?",
+                (state, bytes, path, time.time(), job_id, key)
+            )
+            self._db.commit()
+
+    def track_dicts(self, job_id: int, exclude_done: bool = True) -> List[Dict]:
+        """
+        Track dicts (see TrackInfo.from_dict) in playlist order.
+        """
+        query = "SELECT track FROM job_tracks WHERE job_id = ?"
+        if exclude_done:
+            query += f" AND state != '{DONE}'"
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY position", (job_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def done_keys(self, job_id: int) -> Set[str]:
+        with self._lock:
+            rows = self._db.execute("SELECT key FROM job_tracks WHERE job_id = ? AND state = ?", (job_id, DONE)).fetchall()
+        return {row[0] for row in rows}
+
+    def staged_paths(self, job_id: int) -> Dict[str, str]:
+        """
+        Tracks that were fetched but not yet transcoded, whose raw file still exists.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, path FROM job_tracks WHERE job_id = ? AND state = ? AND path IS NOT NULL",
+                (job_id, TRANSCODING)
+            ).fetchall()
+        return {key: path for key, path in rows if os.path.exists(path)}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -4,11 +4,224 @@ import os
 import sys
 import subprocess
 import platform
+from typing import Optional
 
 # Ensure src is in path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from src.core import Downloader, TrackInfo
+from src import events
+from src.core import Downloader, TrackInfo, parse_items, parse_job_format
+
+class ProgressRenderer:
+    """
+    Coalesces download events and pushes them to the page at most `fps` times a second.
+    Events only update plain state; each frame copies the values that changed
+    onto their controls and updates just those controls, so a large parallel
+    job costs a handful of small diffs per second instead of one page update per event.
+    """
+    def __init__(self, page: ft.Page, bar: ft.ProgressBar, detail: ft.Text, fps: int = 15,
+                 jobs: ft.Text = None):
+        self.page = page
+        self.bar = bar
+        self.detail = detail
+        self.jobs = jobs # Optional line for the concurrency controller's state
+        self.interval = 1.0 / fps
+        self.value = None # Latest progress bar value
+        self.text = None # Latest status line
+        self.jobs_text = None # Latest controller state
+        self.speeds = {} # Latest speed of every track being fetched
+        self._last_flush = 0.0
+        self._scheduled = None
+
+    def apply(self, event):
+        if event.kind != events.PROGRESS:
+            print(event)
+        if event.percent is not None:
+            self.value = event.percent / 100.0
+        if event.jobs:
+            self.jobs_text = f"Parallel: {event.jobs}"
+        if event.kind == events.CONCURRENCY:
+            return
+        if event.kind == events.PROGRESS:
+            self.speeds[event.track_id] = event.speed or 0.0
+            speed = sum(self.speeds.values())
+            self.text = (f"Downloading: {event.percent:.1f}% ({event.completed}/{event.total} done)"
+                         + (f" - {speed / 1e6:.2f} MB/s" if speed else ""))
+            return
+        if event.kind == events.TRACK and event.phase != events.FETCHING:
+            self.speeds.pop(event.track_id, None)
+        if event.kind != events.TRACK or event.phase in (events.FINISHED, events.FAILED):
+            self.text = str(event)
+
+    def flush(self):
+        self._scheduled = None
+        self._last_flush = asyncio.get_running_loop().time()
+        changed = []
+        if self.value is not None and self.bar.value != self.value:
+            self.bar.value = self.value
+            changed.append(self.bar)
+        if self.text is not None and self.detail.value != self.text:
+            self.detail.value = self.text
+            changed.append(self.detail)
+        if self.jobs is not None and self.jobs_text is not None and self.jobs.value != self.jobs_text:
+            self.jobs.value = self.jobs_text
+            self.jobs.visible = True
+            changed.append(self.jobs)
+        if changed:
+            self.page.update(*changed)
+
+    def _request_frame(self):
+        if self._scheduled is not None:
+            return # Next frame already due
+        loop = asyncio.get_running_loop()
+        wait = self._last_flush + self.interval - loop.time()
+        if wait <= 0:
+            self.flush()
+        else:
+            self._scheduled = loop.call_later(wait, self.flush)
+
+    async def run(self, queue: asyncio.Queue):
+        """
+        Render events from a ProgressBus subscription until it is closed.
+        """
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                self.apply(event)
+                # Fold in everything else that's already queued before drawing
+                while not queue.empty():
+                    event = queue.get_nowait()
+                    if event is None:
+                        return
+                    self.apply(event)
+                self._request_frame()
+        finally:
+            if self._scheduled is not None:
+                self._scheduled.cancel()
+            self.flush()
+
+class TrackPicker:
+    """
+    Track selection list for the playlist dialog.
+    Only one page of `page_size` checkbox rows ever exists: paging just rebinds
+    them to other tracks, and search / select all / none / range work on the
+    index set. The control count is the same for 10 tracks or 10,000.
+    """
+    def __init__(self, page_size: int = 50):
+        self.page_size = page_size
+        self.tracks: list[TrackInfo] = []
+        self.labels: list[str] = [] # Lowercased "n. artist - title", for search
+        self.selected = set() # Track indices
+        self.query = ""
+        self.matches: list[int] = [] # Positions in self.tracks matching the query
+        self.page_no = 0
+
+        self.search = ft.TextField(
+            hint_text="Search", dense=True, prefix_icon=ft.Icons.SEARCH,
+            text_style=ft.TextStyle(color=ft.Colors.WHITE), border_color=ft.Colors.CYAN_700,
+            on_change=self._on_search
+        )
+        self.range_input = ft.TextField(
+            hint_text="e.g. 1-20,35", dense=True, width=130,
+            text_style=ft.TextStyle(color=ft.Colors.WHITE), border_color=ft.Colors.CYAN_700,
+            on_submit=self._on_range
+        )
+        self.rows = [
+            ft.Checkbox(visible=False, fill_color=ft.Colors.CYAN_700, on_change=self._on_check)
+            for _ in range(page_size)
+        ]
+        self.page_label = ft.Text(size=12, color=ft.Colors.GREY_400)
+        self.count_label = ft.Text(size=12, color=ft.Colors.CYAN_200)
+        self.prev_btn = ft.IconButton(icon=ft.Icons.CHEVRON_LEFT, on_click=lambda e: self._go(-1))
+        self.next_btn = ft.IconButton(icon=ft.Icons.CHEVRON_RIGHT, on_click=lambda e: self._go(1))
+
+        self.control = ft.Column([
+            self.search,
+            ft.Row([
+                ft.TextButton("All", on_click=self._on_all),
+                ft.TextButton("None", on_click=self._on_none),
+                self.range_input,
+                ft.TextButton("Only these", on_click=self._on_range),
+            ], spacing=4),
+            ft.ListView(self.rows, height=300, item_extent=36),
+            ft.Row([self.prev_btn, self.page_label, self.next_btn, self.count_label],
+                   alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+        ], tight=True, width=420)
+
+    def add(self, tracks: list[TrackInfo]):
+        """
+        Append tracks (selected by default), e.g. as playlist pages arrive.
+        """
+        start = len(self.tracks)
+        for t in tracks:
+            self.tracks.append(t)
+            self.labels.append(f"{t.index}. {t.artist} - {t.title}".lower())
+            self.selected.add(t.index)
+        self.matches.extend(i for i in range(start, len(self.tracks)) if self.query in self.labels[i])
+        self.render()
+
+    def render(self):
+        pages = max(1, -(-len(self.matches) // self.page_size))
+        self.page_no = min(self.page_no, pages - 1)
+        start = self.page_no * self.page_size
+        for i, row in enumerate(self.rows):
+            pos = start + i
+            if pos < len(self.matches):
+                t = self.tracks[self.matches[pos]]
+                row.label = f"{t.index}. {t.artist} - {t.title}"
+                row.value = t.index in self.selected
+                row.data = t.index
+                row.visible = True
+            else:
+                row.visible = False
+        if self.matches:
+            self.page_label.value = f"{start + 1}-{min(start + self.page_size, len(self.matches))} of {len(self.matches)}"
+        else:
+            self.page_label.value = "No matches"
+        self.count_label.value = f"{len(self.selected)} selected"
+        self.prev_btn.disabled = self.page_no == 0
+        self.next_btn.disabled = self.page_no >= pages - 1
+
+    def _refresh(self):
+        self.render()
+        self.control.update()
+
+    def _go(self, step: int):
+        self.page_no = max(0, self.page_no + step)
+        self._refresh()
+
+    def _on_check(self, e):
+        if e.control.value:
+            self.selected.add(e.control.data)
+        else:
+            self.selected.discard(e.control.data)
+        self.count_label.value = f"{len(self.selected)} selected"
+        self.count_label.update()
+
+    def _on_search(self, e):
+        self.query = (e.control.value or "").strip().lower()
+        self.matches = [i for i, label in enumerate(self.labels) if self.query in label]
+        self.page_no = 0
+        self._refresh()
+
+    def _on_all(self, e):
+        # With a search active, only the matches are affected
+        self.selected.update(self.tracks[i].index for i in self.matches)
+        self._refresh()
+
+    def _on_none(self, e):
+        self.selected.difference_update(self.tracks[i].index for i in self.matches)
+        self._refresh()
+
+    def _on_range(self, e):
+        wanted = set(parse_items(self.range_input.value) or [])
+        if not wanted:
+            return
+        self.selected.clear()
+        self.selected.update(t.index for t in self.tracks if t.index in wanted)
+        self._refresh()
 
 class MusicDownloaderApp:
     def __init__(self, page: ft.Page):
@@ -24,6 +237,9 @@ class MusicDownloaderApp:
         
         # State
         self.current_tracks: list[TrackInfo] = []
+        self.listing = False # process_url is still receiving pages
+        self.listing_queue: Optional[asyncio.Queue] = None
+        self.download_requested = False # Download clicked, download_selected not yet running
         self.selected_indices = set()
         self.output_dir = os.path.join(os.getcwd(), "downloads")
         
@@ -95,6 +311,8 @@ class MusicDownloaderApp:
                 ft.dropdown.Option("mp3"),
                 ft.dropdown.Option("flac"),
                 ft.dropdown.Option("m4a"),
+                ft.dropdown.Option("opus"),
+                ft.dropdown.Option("smart"), # Remux when the source allows, else mp3
             ],
             value="wav",
             border_color=ft.Colors.PURPLE_700,
@@ -102,10 +320,26 @@ class MusicDownloaderApp:
             label_style=ft.TextStyle(color=ft.Colors.PURPLE_200),
         )
 
+        self.jobs_dropdown = ft.Dropdown(
+            label="Parallel",
+            width=100,
+            options=[
+                ft.dropdown.Option("1"),
+                ft.dropdown.Option("2"),
+                ft.dropdown.Option("4"),
+                ft.dropdown.Option("8"),
+                ft.dropdown.Option("Auto"), # Adaptive, starting at 4 per host
+            ],
+            value=str(self.downloader.jobs),
+            border_color=ft.Colors.PURPLE_700,
+            text_style=ft.TextStyle(color=ft.Colors.WHITE),
+            label_style=ft.TextStyle(color=ft.Colors.PURPLE_200),
+        )
+
         settings_container = ft.Container(
             content=ft.Row([
                 ft.Text("Settings", color=ft.Colors.GREY_500, size=16),
-                self.format_dropdown
+                ft.Row([self.jobs_dropdown, self.format_dropdown])
             ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
             padding=ft.padding.symmetric(horizontal=25, vertical=10)
         )
@@ -114,6 +348,7 @@ class MusicDownloaderApp:
         self.status_title = ft.Text("Ready", size=16, color=ft.Colors.CYAN_100, weight=ft.FontWeight.BOLD)
         self.status_detail = ft.Text("Waiting for input...", size=12, color=ft.Colors.GREY_400)
         self.progress_bar = ft.ProgressBar(width=350, color=ft.Colors.CYAN, bgcolor="#2a2a35", value=0, visible=False)
+        self.jobs_detail = ft.Text("", size=10, color=ft.Colors.GREY_500, visible=False)
         
         # --- Control Buttons ---
         self.pause_btn = ft.IconButton(ft.Icons.PAUSE_CIRCLE_FILLED, icon_color=ft.Colors.YELLOW, icon_size=30, tooltip="Pause (Stop & Resume later)", on_click=self.pause_download, visible=False)
@@ -138,6 +373,7 @@ class MusicDownloaderApp:
                 self.status_detail,
                 ft.Container(height=10),
                 self.progress_bar,
+                self.jobs_detail,
                 ft.Row([self.pause_btn, self.resume_btn, self.stop_btn], alignment=ft.MainAxisAlignment.CENTER),
                 ft.Container(height=10),
                 ft.Row([
@@ -199,6 +435,35 @@ class MusicDownloaderApp:
         
         # Persist logic
         self.last_tracks = []
+        self.last_indices = None # Selection of last_tracks, None when it's the whole playlist
+        self.last_download = False # A download ran in this session (last_tracks is None when it was streamed)
+        self.last_format = None # Stored job format the last download resumed with, None: the dropdown's
+        self.unfinished_job = None # Job from a previous session, offered for resuming
+        self.show_unfinished_job()
+
+    def show_unfinished_job(self):
+        """
+        Offer to resume a job that was interrupted when the app last exited.
+        """
+        store = self.downloader.job_store
+        if store is None:
+            return
+        jobs = [j for j in store.unfinished_jobs() if j.output_dir == os.path.abspath(self.output_dir)]
+        if not jobs:
+            return
+        job = jobs[0]
+        self.unfinished_job = job
+        self.url_input.value = job.url
+        # The job resumes with its own format(s), which the dropdown can't always show ("flac,mp3")
+        smart, fmt = parse_job_format(job.format)
+        shown = ("smart" if fmt == "mp3" else None) if smart else fmt
+        if shown in [o.key for o in self.format_dropdown.options]:
+            self.format_dropdown.value = shown
+        self.status_title.value = "Unfinished download"
+        self.status_title.color = ft.Colors.YELLOW
+        self.status_detail.value = f"{job.done}/{job.total} tracks done ({job.format}). Press resume to continue."
+        self.resume_btn.visible = True
+        self.page.update()
 
     def check_url(self, e):
         # ... (same)
@@ -215,10 +480,38 @@ class MusicDownloaderApp:
         self.page.run_task(self.process_url, url)
 
     async def process_url(self, url):
-        # ... (same)
+        # Metadata arrives page by page: open the dialog on the first page
+        # and keep appending to it while the rest of the listing loads
+        stream = self.downloader.iter_metadata(url)
+        self.current_tracks = []
+        self.listing = True
+        self.listing_queue = None # Set when a download starts before the listing is done
+        self.download_requested = False
+        dialog_shown = False
+        listed, error = False, None
         try:
-            tracks = await self.downloader.get_metadata(url)
-            self.current_tracks = tracks
+            async for batch in stream:
+                self.current_tracks.extend(batch)
+                if self.listing_queue is not None:
+                    # The rest of the playlist goes to the running download
+                    self.listing_queue.put_nowait(batch)
+                    continue
+                if dialog_shown:
+                    if not self.dlg_modal.open and not self.download_requested:
+                        # Dialog closed without downloading: stop listing
+                        break
+                    self.append_to_playlist_dialog(batch)
+                elif len(self.current_tracks) > 1:
+                    dialog_shown = True
+                    self.progress_bar.visible = False
+                    self.status_title.color = ft.Colors.CYAN_100
+                    self.show_playlist_dialog(self.current_tracks)
+            else:
+                listed = True
+
+            if self.listing_queue is not None:
+                return # The download reports from here on
+            tracks = self.current_tracks
             self.progress_bar.visible = False
             
             if len(tracks) == 0:
@@ -229,8 +522,9 @@ class MusicDownloaderApp:
                 return
 
             self.status_title.color = ft.Colors.CYAN_100
-            if len(tracks) > 1:
-                self.show_playlist_dialog(tracks)
+            if dialog_shown:
+                self.dlg_modal.title.value = f"Select Tracks ({len(tracks)})"
+                self.page.update()
             else:
                 self.status_title.value = f"Found: {tracks[0].title}"
                 self.status_detail.value = f"Artist: {tracks[0].artist}"
@@ -238,41 +532,46 @@ class MusicDownloaderApp:
                 await self.download_tracks(tracks)
                 
         except Exception as e:
+            error = e
+            if self.listing_queue is not None:
+                return # The download fails with it (see below)
             self.status_title.value = "Error"
             self.status_detail.value = str(e)
             self.status_title.color = ft.Colors.RED
             self.progress_bar.visible = False
             self.page.update()
+        finally:
+            self.listing = False
+            if self.listing_queue is not None:
+                # A partial listing must not pass for the whole playlist
+                self.listing_queue.put_nowait(None if listed else error or Exception("Playlist listing stopped"))
+            await stream.aclose()
+
+    async def listed_batches(self, first: list[TrackInfo], queue: asyncio.Queue):
+        """
+        The tracks listed so far, then every batch process_url lists after them.
+        Raises the listing's error if it didn't finish.
+        """
+        yield first
+        while (batch := await queue.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
 
     def show_playlist_dialog(self, tracks: list[TrackInfo]):
-        # ... (same)
-        self.selected_indices = set(t.index for t in tracks)
-        checklist = ft.Column()
-        
-        def on_checkbox_change(e):
-            idx = e.control.data
-            if e.control.value:
-                self.selected_indices.add(idx)
-            else:
-                self.selected_indices.discard(idx)
-        
-        # Add "Select All/None" logic later if needed, for now just list
-        for t in tracks:
-            checklist.controls.append(
-                ft.Checkbox(
-                    label=f"{t.index}. {t.artist} - {t.title}", 
-                    value=True, 
-                    data=t.index,
-                    on_change=on_checkbox_change,
-                    fill_color=ft.Colors.CYAN_700
-                )
-            )
-            
-        self.dlg_modal.content = checklist
+        self.picker = TrackPicker()
+        self.selected_indices = self.picker.selected
+        self.dlg_modal.title.value = "Select Tracks (loading...)"
+        self.dlg_modal.content = self.picker.control
+        self.append_to_playlist_dialog(tracks)
         self.page.dialog = self.dlg_modal
         self.dlg_modal.open = True
         self.page.update()
 
+    def append_to_playlist_dialog(self, tracks: list[TrackInfo]):
+        self.picker.add(tracks)
+        self.page.update()
+
     def close_dialog(self, e):
         self.dlg_modal.open = False
         self.page.update()
@@ -282,14 +581,39 @@ class MusicDownloaderApp:
         self.page.update()
 
     def start_download_from_dialog(self, e):
+        self.download_requested = True # Before closing, so process_url keeps listing
         self.close_dialog(e)
-        selected_tracks = [t for t in self.current_tracks if t.index in self.selected_indices]
+        self.page.run_task(self.download_selected, set(self.selected_indices))
+
+    async def download_selected(self, selected: set):
+        # Runs on the event loop: no page can be listed between the snapshot and the queue
+        self.download_requested = False
+        selected_tracks = [t for t in self.current_tracks if t.index in selected]
         if not selected_tracks:
             return
-        self.page.run_task(self.download_tracks, selected_tracks)
-
-    async def download_tracks(self, tracks: list[TrackInfo]):
-        self.last_tracks = tracks # save for resume
+        # A subset gets its own job, so resuming the whole playlist later doesn't stop at it
+        subset = len(selected_tracks) < len(self.current_tracks)
+        if not self.listing:
+            await self.download_tracks(selected_tracks, [t.index for t in selected_tracks] if subset else None)
+            return
+        # Still listing: the download starts now and takes the later pages as they
+        # arrive (all of them with everything selected, else only selected indices)
+        self.listing_queue = asyncio.Queue()
+        await self.download_tracks(self.listed_batches(list(self.current_tracks), self.listing_queue),
+                                   sorted(selected) if subset else None)
+
+    async def download_tracks(self, tracks, track_indices: Optional[list[int]] = None,
+                              job_format: Optional[str] = None):
+        """
+        `tracks`: a list, an async iterator of batches still being listed, or
+        None to list the URL again (resuming a download started mid-listing).
+        `job_format`: format a resumed job is stored under ("flac,mp3",
+        "smart:mp3"), used instead of the dropdown's.
+        """
+        self.last_tracks = tracks if isinstance(tracks, list) else None # save for resume
+        self.last_indices = track_indices
+        self.last_format = job_format
+        self.last_download = True
         self.progress_bar.visible = True
         self.progress_bar.value = None
         
@@ -300,43 +624,46 @@ class MusicDownloaderApp:
         self.delete_btn.visible = False 
         self.page.update()
         
-        total = len(tracks)
+        total = len(tracks) if isinstance(tracks, list) else None
         url = self.url_input.value
-        fmt = self.format_dropdown.value
-        
-        indices = [t.index for t in tracks] if len(tracks) > 1 else None
-        if len(self.current_tracks) > 1 and len(tracks) == 1:
-             indices = [tracks[0].index]
-
-        self.status_title.value = f"Downloading {total} Items..."
+        if job_format:
+            self.downloader.smart, fmt = parse_job_format(job_format)
+        else:
+            fmt = self.format_dropdown.value
+            self.downloader.smart = fmt == "smart"
+            if self.downloader.smart:
+                fmt = "mp3" # For sources that can't be remuxed; the job is stored as "smart:mp3"
+        if self.jobs_dropdown.value == "Auto":
+            self.downloader.set_concurrency(4, adaptive=True)
+        else:
+            self.downloader.set_concurrency(int(self.jobs_dropdown.value or 1))
+        self.jobs_detail.visible = False
+
+        self.status_title.value = f"Downloading {total} Items..." if total is not None else "Downloading playlist..."
         self.status_detail.value = "Initializing..."
         self.page.update()
 
-        def update_progress(msg):
-            print(msg)
-            if "Downloading:" in msg:
-                self.status_detail.value = msg
-                try:
-                    pct_str = msg.replace("Downloading:", "").replace("%", "").strip()
-                    val = float(pct_str) / 100.0
-                    self.progress_bar.value = val
-                except:
-                    pass
-            else:
-                self.status_detail.value = msg
-            self.page.update()
-
+        renderer = ProgressRenderer(self.page, self.progress_bar, self.status_detail, jobs=self.jobs_detail)
+        queue = self.downloader.events.subscribe(maxsize=100)
+        watcher = asyncio.create_task(renderer.run(queue))
         try:
-            await self.downloader.download(
-                url=url,
-                output_dir=self.output_dir,
-                format=fmt,
-                track_indices=indices,
-                progress_callback=update_progress
-            )
+            try:
+                report = await self.downloader.download(
+                    url=url,
+                    output_dir=self.output_dir,
+                    format=fmt,
+                    tracks=tracks,
+                    track_indices=track_indices
+                )
+            finally:
+                # Let the last events render before the final status below
+                self.downloader.events.unsubscribe(queue)
+                await watcher
             self.status_title.value = "COMPLETED"
             self.status_title.color = ft.Colors.GREEN
             self.status_detail.value = f"Saved in {self.output_dir}"
+            if report is not None and report.skipped:
+                self.status_detail.value += f" ({len(report.skipped)} already downloaded)"
             self.progress_bar.value = 1.0
             
             # Show Delete (Cleanup)
@@ -391,8 +718,23 @@ class MusicDownloaderApp:
         self.status_detail.value = "Resuming..."
         self.page.update()
         # triggering download again with last tracks
+        # (the job store skips whatever already finished)
         if self.last_tracks:
-            self.page.run_task(self.download_tracks, self.last_tracks)
+            self.page.run_task(self.download_tracks, self.last_tracks, self.last_indices, self.last_format)
+            return
+        if self.last_download:
+            # Started while the playlist was still listing: list it again
+            self.page.run_task(self.download_tracks, None, self.last_indices, self.last_format)
+            return
+
+        # Job left over from a previous session
+        store = self.downloader.job_store
+        job = self.unfinished_job
+        if store is not None and job is not None:
+            tracks = [TrackInfo.from_dict(d) for d in store.track_dicts(job.id, exclude_done=False)]
+            if tracks:
+                self.current_tracks = tracks
+                self.page.run_task(self.download_tracks, tracks, job.track_indices, job.format)
 
     def delete_file(self, e):
         # Open confirmation dialog instead of just clearing
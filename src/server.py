@@ -0,0 +1,438 @@
+import asyncio
+import itertools
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from src import events
+from src.cache import normalize_url
+from src.core import AUDIO_CODECS, Downloader, split_formats
+from src.events import ProgressBus, ProgressEvent
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+MAX_HEADER = 16 * 1024
+MAX_BODY = 64 * 1024
+HEARTBEAT = 15.0 # Seconds between SSE keep-alive comments
+PROGRESS_INTERVAL = 0.5 # Min seconds between forwarded progress events of one job
+KEEP_FINISHED = 200 # Finished jobs kept for listing
+
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class ApiJob:
+    """
+    One submitted URL and what became of it.
+    """
+    def __init__(self, id: int, url: str, format: str, output_dir: str,
+                 items: Optional[List[int]] = None, force: bool = False):
+        self.id = id
+        self.url = url
+        self.format = format
+        self.output_dir = output_dir
+        self.items = items
+        self.force = force
+        self.state = QUEUED
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.percent = 0.0
+        self.completed = 0
+        self.failed = 0
+        self.total = 0
+        self.message = ""
+        self.error: Optional[str] = None
+        self.report: Optional[Dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_progress = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.state not in FINISHED_STATES
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id, 'url': self.url, 'format': self.format, 'output_dir': self.output_dir,
+            'items': self.items, 'state': self.state, 'created': self.created, 'started': self.started,
+            'finished': self.finished, 'percent': round(self.percent, 1), 'completed': self.completed,
+            'failed': self.failed, 'total': self.total, 'message': self.message, 'error': self.error,
+            'report': self.report,
+        }
+
+def event_dict(event: ProgressEvent) -> Dict:
+    """
+    JSON-friendly form of a Downloader progress event.
+    """
+    track = event.track
+    return {
+        'kind': event.kind, 'message': str(event), 'phase': event.phase,
+        'track': {'key': track.key, 'title': track.title, 'artist': track.artist, 'index': track.index} if track else None,
+        'bytes_done': event.bytes_done, 'bytes_total': event.bytes_total, 'speed': event.speed,
+        'percent': event.percent, 'completed': event.completed, 'failed': event.failed,
+        'total': event.total, 'jobs': event.jobs,
+    }
+
+class ApiServer:
+    """
+    Headless HTTP/JSON front end for one long-lived Downloader (stdlib asyncio only).
+    Every job runs on the same Downloader, so all clients share its fetch and
+    transcode limits, engine workers, HTTP session and metadata cache.
+
+      POST /jobs                 {"url", "format"? ("flac,mp3" for both), "items"?: [1, 3], "output"?, "force"?}
+      GET  /jobs                 every job, newest first
+      GET  /jobs/<id>            one job
+      POST /jobs/<id>/cancel     stop a queued or running job (its other work keeps going)
+      GET  /jobs/<id>/events     Server-Sent Events for one job, until it finishes
+      GET  /events               Server-Sent Events for all jobs
+      GET  /stats                concurrency, HTTP session and cache statistics
+
+    `output` is a directory under the server's output root. At most
+    `url_concurrency` jobs are listed and scheduled at once; the rest wait as
+    queued. There is no authentication: bind to localhost unless the network is trusted.
+    """
+    def __init__(self, downloader: Downloader, output_dir: str = "downloads", host: str = "127.0.0.1",
+                 port: int = 8750, default_format: str = "mp3", url_concurrency: Optional[int] = None):
+        self.downloader = downloader
+        self.output_dir = os.path.abspath(output_dir)
+        self.host = host
+        self.port = port
+        self.default_format = default_format
+        self.url_slots = asyncio.Semaphore(url_concurrency or downloader.jobs)
+        self.jobs: Dict[int, ApiJob] = {}
+        self.bus = ProgressBus() # (job id or None, SSE event name, payload) for the SSE clients
+        self._ids = itertools.count(1)
+        self._by_url: Dict[str, ApiJob] = {} # Active jobs by the URL their events carry
+        self._events: Optional[asyncio.Queue] = None # The dispatcher's subscription to the Downloader
+        self._server = None
+        self.routes = [
+            ('POST', re.compile(r'/jobs'), self.submit),
+            ('GET', re.compile(r'/jobs'), self.list_jobs),
+            ('GET', re.compile(r'/jobs/(\d+)'), self.get_job),
+            ('POST', re.compile(r'/jobs/(\d+)/cancel'), self.cancel_job),
+            ('GET', re.compile(r'/jobs/(\d+)/events'), self.job_events),
+            ('GET', re.compile(r'/events'), self.all_events),
+            ('GET', re.compile(r'/stats'), self.stats),
+        ]
+
+    async def run(self, on_ready=None):
+        """
+        Serve until cancelled; running jobs are cancelled on the way out.
+        """
+        dispatcher = asyncio.create_task(self._dispatch())
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_HEADER)
+        if on_ready:
+            on_ready(self)
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            dispatcher.cancel()
+            self.downloader.engine.close()
+
+    # Jobs
+
+    def _job(self, job_id: str) -> ApiJob:
+        job = self.jobs.get(int(job_id))
+        if job is None:
+            raise HttpError(404, f"No job {job_id}")
+        return job
+
+    def _changed(self, job: ApiJob):
+        self.bus.publish((job.id, "job", job.to_dict()))
+
+    def _output_dir(self, output) -> str:
+        if output is None:
+            return self.output_dir
+        if not isinstance(output, str):
+            raise HttpError(400, "'output' must be a string")
+        path = os.path.normpath(os.path.join(self.output_dir, output))
+        if os.path.commonpath([self.output_dir, path]) != self.output_dir:
+            raise HttpError(400, "'output' must stay inside the server's output directory")
+        return path
+
+    def _forget_finished(self):
+        finished = [job for job in self.jobs.values() if not job.active]
+        for job in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+            del self.jobs[job.id]
+
+    async def _run(self, job: ApiJob):
+        try:
+            async with self.url_slots:
+                job.state, job.started = RUNNING, time.time()
+                self._changed(job)
+                report = await self.downloader.download(
+                    url=job.url,
+                    output_dir=job.output_dir,
+                    format=job.format,
+                    track_indices=job.items,
+                    force=job.force,
+                )
+            job.state = DONE
+            if report is not None:
+                job.report = {'completed': len(report.completed), 'failed': len(report.failed),
+                              'skipped': len(report.skipped)}
+        except asyncio.CancelledError:
+            job.state = CANCELLED
+        except Exception as e:
+            job.state, job.error = FAILED, str(e)
+        finally:
+            # The job's last events (DONE, ...) go out before its final state
+            await self._flush_events()
+            self._finish(job)
+
+    def _finish(self, job: ApiJob):
+        job.finished = time.time()
+        self._by_url.pop(job.url, None)
+        self._changed(job)
+        self._forget_finished()
+
+    async def _flush_events(self):
+        """
+        Wait until the dispatcher has passed on every event the Downloader emitted so far.
+        """
+        queue = self._events
+        if queue is None:
+            return
+        flushed = asyncio.get_running_loop().create_future()
+        if queue.full():
+            queue.get_nowait() # Same as ProgressBus.publish: the oldest event goes
+        queue.put_nowait(flushed)
+        try:
+            await asyncio.wait_for(flushed, timeout=5)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self):
+        """
+        Route the Downloader's events to the job they belong to (by URL) and on to the SSE clients.
+        """
+        queue = self._events = self.downloader.events.subscribe(maxsize=1000)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                if isinstance(event, asyncio.Future):
+                    # _flush_events marker: everything queued before it is out
+                    if not event.done():
+                        event.set_result(None)
+                    continue
+                job = self._by_url.get(event.url) if event.url else None
+                if job is None:
+                    self.bus.publish((None, event.kind, event_dict(event)))
+                    continue
+                if event.percent is not None:
+                    job.percent = event.percent
+                if event.kind in (events.PROGRESS, events.TRACK, events.DONE):
+                    job.completed, job.failed, job.total = event.completed, event.failed, event.total
+                if event.kind == events.PROGRESS:
+                    now = time.monotonic()
+                    if now - job.last_progress < PROGRESS_INTERVAL:
+                        continue
+                    job.last_progress = now
+                else:
+                    job.message = str(event)
+                self.bus.publish((job.id, event.kind, event_dict(event)))
+        finally:
+            self._events = None
+            self.downloader.events.unsubscribe(queue)
+
+    # Endpoints
+
+    async def submit(self, body: Dict, writer):
+        url = body.get('url')
+        if not isinstance(url, str) or not url.strip():
+            raise HttpError(400, "'url' is required")
+        url = url.strip()
+        format = body.get('format') or self.default_format
+        if not isinstance(format, str) or not split_formats(format):
+            raise HttpError(400, "'format' must be a format name or a comma-separated list of them")
+        for f in split_formats(format):
+            if f not in AUDIO_CODECS:
+                raise HttpError(400, f"Unknown format '{f}' (choose from {', '.join(AUDIO_CODECS)})")
+        format = ",".join(split_formats(format))
+        items = body.get('items')
+        if items is not None and (not isinstance(items, list) or not all(isinstance(i, int) and i > 0 for i in items)):
+            raise HttpError(400, "'items' must be a list of 1-based track numbers")
+        output_dir = self._output_dir(body.get('output'))
+
+        # Events are matched to jobs by URL, so one URL can only run once at a time
+        key = normalize_url(url)
+        for other in self._by_url.values():
+            if normalize_url(other.url) == key:
+                raise HttpError(409, f"Job {other.id} is already downloading this URL")
+
+        job = ApiJob(next(self._ids), url, format, output_dir, items or None, bool(body.get('force')))
+        self.jobs[job.id] = job
+        self._by_url[url] = job
+        job.task = asyncio.create_task(self._run(job))
+        self._changed(job)
+        return 201, job.to_dict()
+
+    async def list_jobs(self, body, writer):
+        return 200, {'jobs': [job.to_dict() for job in sorted(self.jobs.values(), key=lambda j: -j.id)]}
+
+    async def get_job(self, body, writer, job_id):
+        return 200, self._job(job_id).to_dict()
+
+    async def cancel_job(self, body, writer, job_id):
+        job = self._job(job_id)
+        if not job.active:
+            raise HttpError(409, f"Job {job.id} already {job.state}")
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+        if job.active:
+            # Cancelled before its task got to run
+            job.state = CANCELLED
+            self._finish(job)
+        return 200, job.to_dict()
+
+    async def job_events(self, body, writer, job_id):
+        job = self._job(job_id)
+        await self._stream_events(writer, job)
+
+    async def all_events(self, body, writer):
+        await self._stream_events(writer)
+
+    async def stats(self, body, writer):
+        d = self.downloader
+        states = {}
+        for job in self.jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return 200, {
+            'jobs': states,
+            'concurrency': d.controller.describe() if d.controller is not None else f"{d.jobs} tracks at a time",
+            'http': d.session.stats() if d.session is not None else None,
+            'metadata_cache': d.metadata_cache.stats() if d.metadata_cache is not None else None,
+        }
+
+    # HTTP
+
+    async def _stream_events(self, writer, job: Optional[ApiJob] = None):
+        """
+        Server-Sent Events until the client goes away, or until `job`'s final
+        "job" event (its finished state) has been sent.
+        A slow client only loses stale progress events, see ProgressBus.
+        """
+        queue = self.bus.subscribe(maxsize=200)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            if job is not None:
+                self._send_event(writer, "job", job.to_dict())
+            await writer.drain()
+            if job is not None and job.finished is not None:
+                return # Already over
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if job is not None and job.finished is not None:
+                        # Its final event was dropped (slow client): send the state instead
+                        self._send_event(writer, "job", job.to_dict())
+                        await writer.drain()
+                        break
+                    writer.write(b": keep-alive\n\n")
+                    await writer.drain()
+                    continue
+                if item is None:
+                    break
+                job_id, name, payload = item
+                if job is not None and job_id != job.id:
+                    continue
+                if job is None:
+                    payload = dict(payload, job=job_id)
+                self._send_event(writer, name, payload)
+                await writer.drain()
+                if job is not None and name == "job" and payload['state'] in FINISHED_STATES:
+                    break
+        finally:
+            self.bus.unsubscribe(queue)
+
+    @staticmethod
+    def _send_event(writer, name: str, payload: Dict):
+        writer.write(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode())
+
+    @staticmethod
+    def _send_json(writer, status: int, payload: Dict):
+        body = json.dumps(payload).encode()
+        writer.write((f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                      f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                      f"Connection: close\r\n\r\n").encode() + body)
+
+    async def _read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HttpError(413, "Request headers too large")
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        body = {}
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY:
+            raise HttpError(413, "Request body too large")
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                raise HttpError(400, "Body must be JSON")
+            if not isinstance(body, dict):
+                raise HttpError(400, "Body must be a JSON object")
+        return method, target.split("?", 1)[0].rstrip("/") or "/", body
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+                result = None
+                allowed = False
+                for route_method, pattern, handler in self.routes:
+                    match = pattern.fullmatch(path)
+                    if not match:
+                        continue
+                    allowed = True
+                    if route_method == method:
+                        result = await handler(body, writer, *match.groups())
+                        break
+                else:
+                    raise HttpError(405 if allowed else 404, f"{method} {path} not supported")
+                if result is not None:
+                    self._send_json(writer, *result)
+            except HttpError as e:
+                self._send_json(writer, e.status, {'error': str(e)})
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass # Client went away
+            except Exception as e:
+                print(f"[WARNING] API request failed: {e}")
+                self._send_json(writer, 500, {'error': str(e)})
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
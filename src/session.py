@@ -0,0 +1,208 @@
+import functools
+import threading
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+# Try importing yt_dlp, handle if not installed (though it should be)
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+try:
+    import requests # noqa: F401 - yt-dlp only pools connections through its requests handler
+    POOLING = True
+except ImportError:
+    POOLING = False
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+class ConnectionCounter:
+    """
+    Counts HTTP connections opened vs. requests sent through urllib3 (which
+    yt-dlp's requests handler pools with), by wrapping the socket setup of
+    its connections and the request call of its pools. Everything else was
+    served on a kept-alive connection. urllib3's loggers are left alone.
+    """
+    def __init__(self):
+        self.opened = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _add(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def install(self):
+        try:
+            from urllib3 import connection, connectionpool
+        except ImportError:
+            return # Nothing pools connections then
+        counter = self
+
+        def count(cls, method: str, name: str):
+            original = getattr(cls, method)
+
+            @functools.wraps(original)
+            def counted(*args, **kwargs):
+                counter._add(name)
+                return original(*args, **kwargs)
+            setattr(cls, method, counted)
+
+        # HTTPS connections set up their socket through the same _new_conn,
+        # also when a dropped kept-alive connection reconnects
+        count(connection.HTTPConnection, "_new_conn", "opened")
+        count(connectionpool.HTTPConnectionPool, "_make_request", "requests")
+
+    @property
+    def reused(self) -> int:
+        return max(0, self.requests - self.opened)
+
+_counter = None
+_counter_lock = threading.Lock()
+
+def connection_counter() -> ConnectionCounter:
+    """
+    The process-wide counter, installed into urllib3 on first use.
+    """
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            _counter = ConnectionCounter()
+            _counter.install()
+        return _counter
+
+class YtSession:
+    """
+    Long-lived YoutubeDL instances shared by metadata listing, Spotify matching
+    and the in-process engine. Each instance keeps its HTTP connection pool
+    (keep-alive, so DNS/TCP/TLS handshakes happen once per host) and its
+    extractors' in-memory caches (player JS, signature functions) between calls.
+
+    YoutubeDL isn't thread-safe, so every call borrows an instance for itself;
+    per-call options are applied on top of the shared base options and undone
+    when the instance is returned. Idle instances are kept, most recently used first.
+    """
+    BASE_OPTS = {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'user_agent': USER_AGENT,
+    }
+
+    def __init__(self, max_idle: int = 16):
+        if yt_dlp is None:
+            raise RuntimeError("The shared session needs the yt_dlp package")
+        self.max_idle = max_idle
+        self.created = 0
+        self.borrowed = 0
+        self._idle: List = []
+        self._all: List = [] # Every instance created, idle or borrowed
+        self._hooks: List[Callable] = []
+        self._lock = threading.Lock()
+        self.counter = connection_counter()
+        self._baseline = (self.counter.opened, self.counter.requests)
+
+    def add_progress_hook(self, hook: Callable[[Dict], None]):
+        """
+        Install a download progress hook on every instance, now and later.
+        """
+        with self._lock:
+            self._hooks.append(hook)
+            for ydl in self._all:
+                ydl.add_progress_hook(hook)
+
+    def _new(self):
+        ydl = yt_dlp.YoutubeDL(dict(self.BASE_OPTS))
+        for hook in self._hooks:
+            ydl.add_progress_hook(hook)
+        self._all.append(ydl)
+        self.created += 1
+        return ydl
+
+    @contextmanager
+    def borrow(self, **opts):
+        """
+        A YoutubeDL for exclusive use inside the `with` block, with `opts`
+        (YoutubeDL params) applied. `outtmpl` may be given as a plain string
+        (the default template); `format` is compiled for this borrow.
+        """
+        with self._lock:
+            ydl = self._idle.pop() if self._idle else None
+            if ydl is None:
+                ydl = self._new()
+            self.borrowed += 1
+
+        if 'outtmpl' in opts:
+            # Merged into the instance's templates: YoutubeDL expects every type to be there
+            outtmpl = opts['outtmpl']
+            opts['outtmpl'] = {**ydl.params['outtmpl'],
+                               **(outtmpl if isinstance(outtmpl, dict) else {'default': outtmpl})}
+        missing = object()
+        saved = {key: ydl.params.get(key, missing) for key in opts}
+        saved_selector = ydl.format_selector
+        ydl.params.update(opts)
+        try:
+            if 'format' in opts:
+                # YoutubeDL compiles `format` once, in __init__
+                ydl.format_selector = ydl.build_format_selector(opts['format'])
+            yield ydl
+        finally:
+            for key, value in saved.items():
+                if value is missing:
+                    ydl.params.pop(key, None)
+                else:
+                    ydl.params[key] = value
+            ydl.format_selector = saved_selector
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(ydl)
+                    ydl = None
+                else:
+                    self._all.remove(ydl)
+            if ydl is not None:
+                ydl.close()
+
+    def urlopen(self, req: urllib.request.Request, ydl=None):
+        """
+        Send a urllib Request over pooled connections: those of `ydl` (an
+        instance the caller already borrowed) or of any idle instance.
+        Errors are mapped to urllib's (HTTPError / OSError), so callers written
+        against urllib.request.urlopen work unchanged.
+        """
+        from yt_dlp.networking import Request
+        from yt_dlp.networking.exceptions import HTTPError, RequestError
+        if ydl is None:
+            with self.borrow() as ydl:
+                return self.urlopen(req, ydl)
+        try:
+            return ydl.urlopen(Request(req.full_url, headers=dict(req.header_items())))
+        except HTTPError as e:
+            raise urllib.error.HTTPError(req.full_url, e.status, e.reason, None, None)
+        except RequestError as e:
+            raise OSError(str(e))
+
+    @property
+    def connections_opened(self) -> int:
+        return self.counter.opened - self._baseline[0]
+
+    @property
+    def connections_reused(self) -> int:
+        return max(0, (self.counter.requests - self._baseline[1]) - self.connections_opened)
+
+    def stats(self) -> str:
+        text = (f"{self.connections_opened} connections opened, {self.connections_reused} reused "
+                f"({self.created} extractor sessions, {self.borrowed} calls)")
+        if not POOLING:
+            text += " - install 'requests' for keep-alive pooling"
+        return text
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            for ydl in idle:
+                self._all.remove(ydl)
+        for ydl in idle:
+            ydl.close()
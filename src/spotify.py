@@ -0,0 +1,197 @@
+import asyncio
+import base64
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.cache import MetadataCache
+from src.session import USER_AGENT, YtSession
+
+# Try importing yt_dlp, handle if not installed (though it should be)
+try:
+    import yt_dlp
+except ImportError:
+    yt_dlp = None
+
+API_BASE = "https://api.spotify.com/v1"
+AUTH_URL = "https://accounts.spotify.com/api/token"
+
+# open.spotify.com/[intl-xx/]<kind>/<id> or spotify:<kind>:<id>
+SPOTIFY_URL_RE = re.compile(r'(?:open\.spotify\.com/(?:intl-[a-z]+/)?|spotify:)(track|album|playlist)[/:]([A-Za-z0-9]+)')
+
+def parse_spotify_url(url: str) -> Tuple[str, str]:
+    match = SPOTIFY_URL_RE.search(url)
+    if not match:
+        raise ValueError(f"Not a Spotify track/album/playlist URL: {url}")
+    return match.group(1), match.group(2)
+
+def default_credentials() -> Tuple[Optional[str], Optional[str]]:
+    """
+    SPOTIFY_CLIENT_ID / SPOTIFY_CLIENT_SECRET, or the app credentials bundled with spotdl.
+    """
+    client_id = os.environ.get("SPOTIFY_CLIENT_ID")
+    client_secret = os.environ.get("SPOTIFY_CLIENT_SECRET")
+    if client_id and client_secret:
+        return client_id, client_secret
+    try:
+        from spotdl.utils.config import DEFAULT_CONFIG
+        return DEFAULT_CONFIG.get("client_id"), DEFAULT_CONFIG.get("client_secret")
+    except Exception:
+        return None, None
+
+class SpotifyClient:
+    """
+    Minimal Spotify Web API client (client-credentials flow) for listing
+    the tracks of a track/album/playlist URL. `api_base` and `auth_url`
+    can point at a local stub server for offline testing.
+    """
+    def __init__(self, client_id: Optional[str] = None, client_secret: Optional[str] = None,
+                 api_base: Optional[str] = None, auth_url: Optional[str] = None):
+        if not client_id or not client_secret:
+            client_id, client_secret = default_credentials()
+        if not client_id or not client_secret:
+            raise RuntimeError("No Spotify credentials (set SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET)")
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_base = (api_base or os.environ.get("SPOTIFY_API_BASE") or API_BASE).rstrip("/")
+        self.auth_url = auth_url or os.environ.get("SPOTIFY_AUTH_URL") or AUTH_URL
+        self._token: Optional[str] = None
+        self._token_expires = 0.0
+        self._lock = threading.Lock()
+
+    def _get_token(self) -> str:
+        with self._lock:
+            if self._token and time.time() < self._token_expires - 60:
+                return self._token
+            basic = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+            req = urllib.request.Request(
+                self.auth_url,
+                data=urllib.parse.urlencode({"grant_type": "client_credentials"}).encode(),
+                headers={"Authorization": f"Basic {basic}", "User-Agent": USER_AGENT},
+            )
+            with urllib.request.urlopen(req, timeout=15) as resp:
+                data = json.load(resp)
+            self._token = data["access_token"]
+            self._token_expires = time.time() + data.get("expires_in", 3600)
+            return self._token
+
+    def _get(self, url: str) -> Dict:
+        if not url.startswith("http"):
+            url = f"{self.api_base}/{url.lstrip('/')}"
+        req = urllib.request.Request(url, headers={
+            "Authorization": f"Bearer {self._get_token()}",
+            "User-Agent": USER_AGENT,
+        })
+        with urllib.request.urlopen(req, timeout=15) as resp:
+            return json.load(resp)
+
+    def _paged(self, first: Dict):
+        page = first
+        while page:
+            yield from page.get("items", [])
+            page = self._get(page["next"]) if page.get("next") else None
+
+    @staticmethod
+    def _track_dict(track: Dict) -> Dict:
+        return {
+            'id': track['id'],
+            'title': track.get('name', 'Unknown'),
+            'artist': ", ".join(a['name'] for a in track.get('artists', [])) or 'Unknown',
+            'duration': (track.get('duration_ms') or 0) // 1000,
+        }
+
+    def get_tracks(self, url: str) -> List[Dict]:
+        """
+        Tracks of a Spotify URL as dicts with id, title, artist and duration (seconds).
+        """
+        kind, spotify_id = parse_spotify_url(url)
+        if kind == "track":
+            return [self._track_dict(self._get(f"tracks/{spotify_id}"))]
+        if kind == "album":
+            album = self._get(f"albums/{spotify_id}")
+            return [self._track_dict(t) for t in self._paged(album["tracks"]) if t and t.get('id')]
+        playlist = self._get(f"playlists/{spotify_id}")
+        return [self._track_dict(item["track"]) for item in self._paged(playlist["tracks"])
+                if item and item.get("track") and item["track"].get("id")]
+
+def youtube_search(query: str, duration: int = 0, session: Optional[YtSession] = None) -> Optional[Dict]:
+    """
+    Default matcher backend: best yt-dlp YouTube search hit for `query`,
+    preferring the result whose length is closest to `duration`.
+    Uses a YoutubeDL from `session` when given (pooled connections).
+    Returns {'url', 'source_id'} or None.
+    """
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'ignoreerrors': True,
+    }
+    if session is not None:
+        with session.borrow(**ydl_opts) as ydl:
+            info = ydl.extract_info(f"ytsearch3:{query}", download=False)
+    else:
+        with yt_dlp.YoutubeDL({**ydl_opts, 'quiet': True, 'user_agent': USER_AGENT}) as ydl:
+            info = ydl.extract_info(f"ytsearch3:{query}", download=False)
+    entries = [e for e in (info or {}).get('entries') or [] if e and e.get('id')]
+    if not entries:
+        return None
+    if duration:
+        entries.sort(key=lambda e: abs((e.get('duration') or 0) - duration))
+    best = entries[0]
+    return {
+        'url': best.get('url') or f"https://www.youtube.com/watch?v={best['id']}",
+        'source_id': f"{(best.get('ie_key') or 'youtube').lower()}:{best['id']}",
+    }
+
+class TrackMatcher:
+    """
+    Finds an audio source for each Spotify track, `concurrency` searches at
+    a time, in batches of `batch_size`. Matches are cached per Spotify track
+    id, so re-resolving a playlist only searches for new tracks.
+    `search(query, duration)` is pluggable (e.g. a stub for offline tests).
+    """
+    def __init__(self, search: Optional[Callable[[str, int], Optional[Dict]]] = None,
+                 cache: Optional[MetadataCache] = None, concurrency: int = 8, batch_size: int = 50):
+        self.search = search or youtube_search
+        self.cache = cache
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+
+    def _cached(self, spotify_id: str) -> Optional[Dict]:
+        if self.cache is None:
+            return None
+        return self.cache.get(f"https://open.spotify.com/track/{spotify_id}", namespace="match")
+
+    def _store(self, spotify_id: str, match: Dict):
+        if self.cache is not None:
+            self.cache.put(f"https://open.spotify.com/track/{spotify_id}", match, namespace="match")
+
+    def _match_one(self, track: Dict) -> Optional[Dict]:
+        match = self._cached(track['id'])
+        if match is not None:
+            return match
+        try:
+            match = self.search(f"{track['artist']} - {track['title']}", track.get('duration', 0))
+        except Exception as e:
+            print(f"Error matching '{track['title']}': {e}")
+            return None
+        if match:
+            self._store(track['id'], match)
+        return match
+
+    async def match_all(self, tracks: List[Dict]) -> List[Optional[Dict]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def match(track):
+            async with semaphore:
+                return await asyncio.to_thread(self._match_one, track)
+
+        results = []
+        for i in range(0, len(tracks), self.batch_size):
+            batch = tracks[i:i + self.batch_size]
+            results.extend(await asyncio.gather(*(match(t) for t in batch)))
+        return results
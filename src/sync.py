@@ -0,0 +1,139 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+
+from src.cache import DEFAULT_STATE_DIR, normalize_url
+from src.core import DownloadReport, Downloader, TrackInfo
+
+class PlaylistDiff:
+    """
+    Changes between two listings of the same playlist, matched by track key.
+    """
+    def __init__(self, added: List[TrackInfo], removed: List[TrackInfo], reordered: List[TrackInfo]):
+        self.added = added
+        self.removed = removed
+        self.reordered = reordered # In both listings, but at a different relative position
+
+    def __repr__(self):
+        return f"<PlaylistDiff +{len(self.added)} -{len(self.removed)} ~{len(self.reordered)}>"
+
+def diff_tracks(old: List[TrackInfo], new: List[TrackInfo]) -> PlaylistDiff:
+    old_keys = {t.key for t in old}
+    new_keys = {t.key for t in new}
+
+    added = [t for t in new if t.key not in old_keys]
+    removed = [t for t in old if t.key not in new_keys]
+
+    # Compare positions among the tracks both listings share, so an insert
+    # near the top doesn't flag everything below it as moved
+    old_order = [t.key for t in old if t.key in new_keys]
+    new_pos = {key: pos for pos, key in enumerate(t.key for t in new if t.key in old_keys)}
+    moved = {key for pos, key in enumerate(old_order) if new_pos.get(key) != pos}
+    reordered = [t for t in new if t.key in moved]
+
+    return PlaylistDiff(added, removed, reordered)
+
+class SnapshotStore:
+    """
+    Last-seen track listing per playlist URL.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(DEFAULT_STATE_DIR, "snapshots.db")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                key TEXT PRIMARY KEY,
+                tracks TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._db.commit()
+
+    def load(self, url: str) -> Optional[List[TrackInfo]]:
+        with self._lock:
+            row = self._db.execute("SELECT tracks FROM snapshots WHERE key = ?", (normalize_url(url),)).fetchone()
+        if row is None:
+            return None
+        return [TrackInfo.from_dict(d) for d in json.loads(row[0])]
+
+    def save(self, url: str, tracks: List[TrackInfo]):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots (key, tracks, updated) VALUES (?, ?, ?)",
+                (normalize_url(url), json.dumps([t.to_dict() for t in tracks]), time.time())
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class SyncResult:
+    def __init__(self, diff: PlaylistDiff, report: DownloadReport, pruned: List[str]):
+        self.diff = diff
+        self.report = report
+        self.pruned = pruned # Files deleted because their track left the playlist
+
+async def sync_playlist(downloader: Downloader,
+                        store: SnapshotStore,
+                        url: str,
+                        output_dir: str,
+                        format: str = 'wav',
+                        prune: bool = False,
+                        progress_callback: Optional[Callable[[str], None]] = None) -> SyncResult:
+    """
+    Bring `output_dir` in line with the playlist's current contents:
+    download only tracks added since the last sync and optionally delete removed ones.
+    """
+    downloader.reset_cancel()
+    os.makedirs(output_dir, exist_ok=True)
+
+    if progress_callback:
+        progress_callback("Fetching current playlist listing...")
+    # The whole point is to see what changed, so never trust the metadata cache here
+    tracks = await downloader.get_metadata(url, refresh=True)
+    if not tracks:
+        raise Exception("No tracks found or invalid URL.")
+
+    previous = store.load(url)
+    diff = diff_tracks(previous or [], tracks)
+    if progress_callback:
+        if previous is None:
+            progress_callback(f"First sync: {len(tracks)} tracks")
+        else:
+            progress_callback(f"Changes since last sync: {len(diff.added)} added, "
+                              f"{len(diff.removed)} removed, {len(diff.reordered)} reordered")
+
+    report = DownloadReport()
+    if diff.added:
+        try:
+            report = await downloader.download_tracks(diff.added, output_dir, format, progress_callback, url=url)
+        except Exception as e:
+            if "Cancelled" in str(e):
+                raise
+            # Every new track failed: keep them out of the snapshot so the next sync retries them
+            report.failed = list(diff.added)
+
+    pruned = []
+    if prune and downloader.archive is not None:
+        for t in diff.removed:
+            for archive_format in downloader.archive_formats(format):
+                path = downloader.archive.lookup(t.key, archive_format, output_dir)
+                if path:
+                    try:
+                        os.remove(path)
+                        pruned.append(path)
+                    except OSError as e:
+                        print(f"Failed to delete {path}. Reason: {e}")
+                downloader.archive.forget(t.key, archive_format, output_dir)
+
+    # Failed tracks stay out of the snapshot so they count as "added" next time
+    failed = {t.key for t in report.failed}
+    store.save(url, [t for t in tracks if t.key not in failed])
+
+    return SyncResult(diff, report, pruned)
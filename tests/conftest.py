@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Ensure src (and the benchmark stub server) are in path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "benchmarks"))
@@ -0,0 +1,56 @@
+"""
+The shared bandwidth cap and the adjustable semaphore behind per-host limits.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from src.adaptive import AdaptiveLimit, SharedBandwidth
+from src.fetch import fetch_resumable
+from stub_server import StubMediaServer
+
+CAP = 4_000_000
+
+def timed_fetches(n: int, tmp_path) -> float:
+    server = StubMediaServer(os.urandom(2_000_000)).start()
+    try:
+        bandwidth = SharedBandwidth(CAP, lambda: n, burst=0)
+        threads = [threading.Thread(target=fetch_resumable, args=(f"http://{server.address}/media/{i}.mp3",
+                                                                  str(tmp_path / f"{i}.mp3"), "page"),
+                                    kwargs={'rate_limit': bandwidth}) for i in range(n)]
+        started = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return n * len(server.media) / (time.monotonic() - started)
+    finally:
+        server.stop()
+
+def test_shared_bandwidth_is_used_whole_by_one_fetch(tmp_path):
+    assert 0.8 * CAP < timed_fetches(1, tmp_path) <= 1.05 * CAP
+
+def test_shared_bandwidth_is_split_between_fetches(tmp_path):
+    assert 0.8 * CAP < timed_fetches(4, tmp_path) <= 1.05 * CAP
+
+def test_share_follows_the_active_fetches():
+    active = [4]
+    bandwidth = SharedBandwidth(CAP, lambda: active[0])
+    assert bandwidth.share() == CAP / 4
+    active[0] = 0
+    assert bandwidth.share() == CAP
+
+def test_wakeup_of_a_cancelled_waiter_is_passed_on():
+    async def main():
+        limit = AdaptiveLimit(1)
+        await limit.__aenter__()
+        first = asyncio.create_task(limit.__aenter__())
+        second = asyncio.create_task(limit.__aenter__())
+        await asyncio.sleep(0)
+        await limit.__aexit__() # Wakes `first`...
+        first.cancel() # ...which is cancelled before it gets to run
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.wait_for(second, 1)
+        assert limit.active == 1
+    asyncio.run(main())
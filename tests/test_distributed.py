@@ -0,0 +1,167 @@
+"""
+Distributed downloads on one machine: a coordinator in the test process
+and several worker processes, over both the TCP and the file transport.
+The workers' Downloader is a stub that just takes its time, so the tests
+are about leases, not about downloading.
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+
+import pytest
+
+from src.core import DownloadReport, TrackInfo
+from src.distributed import DONE, LeaseTable, Worker, open_coordinator, open_queue, split_units
+
+LEASE = 1.0
+POLL = 0.1
+
+class StubDownloader:
+    """
+    Enough of a Downloader for a Worker: each unit takes `delay` seconds and
+    every track of it is recorded as a file named after the track's index.
+    """
+    is_cancelled = False
+
+    def __init__(self, delay: float, worker: str):
+        self.delay = delay
+        self.worker = worker
+
+    async def download_tracks(self, tracks, output_dir, format, progress_callback=None):
+        await asyncio.sleep(self.delay)
+        report = DownloadReport()
+        for track in tracks:
+            with open(os.path.join(output_dir, f"{track.index}.{self.worker}"), "w") as f:
+                f.write(format)
+            report.completed.append(track)
+        return report
+
+def run_worker(spec: str, name: str, output_dir: str, delay: float):
+    queue = open_queue(spec, name)
+    worker = Worker(StubDownloader(delay, name), queue, output_dir, poll=POLL, max_misses=50)
+    asyncio.run(worker.run())
+
+def run_stalled(spec: str, name: str, leased, finished, reported):
+    """
+    Takes one unit and goes quiet without renewing it; once the others have
+    finished the run it reports the unit anyway, like a node that was only
+    presumed dead.
+    """
+    async def main():
+        queue = open_queue(spec, name)
+        while True:
+            try:
+                unit, _ = await queue.lease()
+            except OSError:
+                unit = None # Coordinator not listening yet
+            if unit:
+                break
+            await asyncio.sleep(POLL)
+        leased.put(unit.id)
+        await asyncio.to_thread(finished.wait, 60)
+        reported.put(await queue.complete(unit, {'completed': [t['url'] for t in unit.tracks]}))
+    asyncio.run(main())
+
+def tracks(n: int):
+    return [TrackInfo(f"Track {i}", "Artist", 60, f"https://example.com/{i}", i) for i in range(1, n + 1)]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(params=["tcp", "file"])
+def spec(request, tmp_path):
+    if request.param == "tcp":
+        return f"tcp://127.0.0.1:{free_port()}"
+    return str(tmp_path / "queue")
+
+@pytest.fixture
+def mp():
+    # Fresh interpreters, like workers on other machines would be
+    return multiprocessing.get_context("spawn")
+
+async def serve(spec: str, table: LeaseTable):
+    coordinator = open_coordinator(spec, table)
+    task = asyncio.create_task(coordinator.run(poll=POLL, linger=2.0))
+    if not spec.startswith("tcp://"):
+        # Workers can only open the queue once the coordinator has laid it out
+        while not os.path.isdir(os.path.join(spec, "pending")):
+            await asyncio.sleep(0.01)
+    return task
+
+async def join(processes, timeout: float = 60):
+    for p in processes:
+        await asyncio.to_thread(p.join, timeout)
+    for p in processes:
+        if p.is_alive():
+            p.kill()
+        assert p.exitcode == 0
+
+def produced(output_dir: str):
+    # Track index -> the workers that wrote it
+    files = {}
+    for name in os.listdir(output_dir):
+        index, _, worker = name.partition(".")
+        files.setdefault(int(index), []).append(worker)
+    return files
+
+def test_workers_complete_every_unit(spec, mp, tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    table = LeaseTable(split_units(tracks(24), "mp3", unit_size=3, lease=LEASE))
+
+    async def main():
+        coordinator = await serve(spec, table)
+        workers = [mp.Process(target=run_worker, args=(spec, f"w{n}", str(out), 0.2)) for n in range(3)]
+        for p in workers:
+            p.start()
+        await asyncio.wait_for(coordinator, 60)
+        await join(workers)
+
+    asyncio.run(main())
+    assert table.finished and table.count(DONE) == 8
+    # Every track exactly once: no unit was handed out twice
+    files = produced(str(out))
+    assert sorted(files) == list(range(1, 25))
+    assert all(len(w) == 1 for w in files.values())
+    assert all(u.attempts == 1 for u in table.units.values())
+    assert "24 tracks downloaded, 0 failed" in table.summary()
+
+def test_expired_lease_is_reassigned(spec, mp, tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    table = LeaseTable(split_units(tracks(6), "mp3", unit_size=2, lease=LEASE))
+    leased, finished, reported = mp.Queue(), mp.Event(), mp.Queue()
+
+    async def main():
+        coordinator = await serve(spec, table)
+        stalled = mp.Process(target=run_stalled, args=(spec, "stalled", leased, finished, reported))
+        stalled.start()
+        unit_id = await asyncio.to_thread(leased.get, True, 30)
+
+        # Slow enough that a healthy lease has to be renewed a few times
+        workers = [mp.Process(target=run_worker, args=(spec, f"w{n}", str(out), 2 * LEASE)) for n in range(2)]
+        for p in workers:
+            p.start()
+        while not table.finished:
+            await asyncio.sleep(POLL)
+        finished.set()
+        late = await asyncio.to_thread(reported.get, True, 30)
+        await asyncio.wait_for(coordinator, 60)
+        await join(workers + [stalled])
+        return unit_id, late
+
+    unit_id, late = asyncio.run(main())
+    assert table.finished and table.count(DONE) == 3
+    unit = table.units[unit_id]
+    # Taken back from the silent worker and finished by a healthy one...
+    assert unit.attempts == 2 and unit.worker != "stalled"
+    # ...whose renewals kept everyone else's unit from being handed out twice
+    assert all(u.attempts == 1 for u in table.units.values() if u.id != unit_id)
+    # The first result wins; the stalled worker's late report is turned down
+    assert late is False
+    files = produced(str(out))
+    assert sorted(files) == list(range(1, 7))
+    assert all(len(w) == 1 for w in files.values())
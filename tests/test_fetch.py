@@ -0,0 +1,119 @@
+"""
+Range-resumable and segmented fetches against the local stub media server
+(benchmarks/stub_server.py).
+"""
+import json
+import os
+
+import pytest
+
+from src.fetch import FetchCancelled, FetchError, fetch_resumable, fetch_segmented
+from stub_server import StubMediaServer
+
+SIZE = 1_000_000
+SEGMENT = 64 * 1024
+RANGES = -(-SIZE // SEGMENT)
+
+def media(seed: int) -> bytes:
+    return bytes((i * seed) % 251 for i in range(SIZE))
+
+@pytest.fixture
+def server():
+    server = StubMediaServer(media(7)).start()
+    yield server
+    server.stop()
+
+def url(server):
+    return f"http://{server.address}/media/1.mp3"
+
+def stop_after(limit: int):
+    # should_stop / on_bytes pair that interrupts a fetch once `limit` bytes arrived
+    seen = [0]
+    def on_bytes(done, total):
+        seen[0] = max(seen[0], done)
+    return (lambda: seen[0] >= limit), on_bytes
+
+def interrupted_segmented(server, dest):
+    should_stop, on_bytes = stop_after(SIZE // 3)
+    with pytest.raises(FetchCancelled):
+        fetch_segmented(url(server), dest, "page", segments=2, segment_size=SEGMENT,
+                        on_bytes=on_bytes, should_stop=should_stop)
+    with open(dest + ".part.json") as f:
+        return set(json.load(f)["done"])
+
+def test_segmented_fetch_is_byte_exact(server, tmp_path):
+    dest = str(tmp_path / "a.mp3")
+    assert fetch_segmented(url(server), dest, "page", segments=4, segment_size=SEGMENT) == dest
+    with open(dest, "rb") as f:
+        assert f.read() == server.media
+    # One probe plus one request per range; no part file or sidecar left behind
+    assert len(server.log) == 1 + RANGES
+    assert sorted(os.listdir(tmp_path)) == ["a.mp3"]
+
+def test_segmented_resume_refetches_only_missing_ranges(server, tmp_path):
+    dest = str(tmp_path / "a.mp3")
+    done = interrupted_segmented(server, dest)
+    assert 0 < len(done) < RANGES
+
+    server.reset_counters()
+    fetch_segmented(url(server), dest, "page", segments=2, segment_size=SEGMENT)
+    with open(dest, "rb") as f:
+        assert f.read() == server.media
+    # No probe, and exactly the ranges the sidecar didn't list as done
+    requested = sorted(int(r.split("=")[1].split("-")[0]) // SEGMENT for _, r in server.log)
+    assert requested == sorted(set(range(RANGES)) - done)
+
+def test_segmented_restarts_when_the_remote_file_changed(server, tmp_path):
+    dest = str(tmp_path / "a.mp3")
+    interrupted_segmented(server, dest)
+    server.set_media(media(11)) # Same size, new ETag: If-Range answers with the whole file
+
+    with pytest.raises(FetchError):
+        fetch_segmented(url(server), dest, "page", segments=2, segment_size=SEGMENT)
+    assert not os.path.exists(dest + ".part.json") # Stale progress is dropped...
+
+    fetch_segmented(url(server), dest, "page", segments=2, segment_size=SEGMENT)
+    with open(dest, "rb") as f:
+        assert f.read() == server.media # ...so the next attempt starts over on the new file
+
+def test_segmented_falls_back_without_range_support(tmp_path):
+    server = StubMediaServer(media(7), ranges=False).start()
+    try:
+        dest = str(tmp_path / "a.mp3")
+        fetch_segmented(url(server), dest, "page", segments=4, segment_size=SEGMENT)
+        with open(dest, "rb") as f:
+            assert f.read() == server.media
+        # The probe, then a single plain GET
+        assert [r for _, r in server.log] == ["bytes=0-0", None]
+    finally:
+        server.stop()
+
+def test_segmented_size_mismatch(server, tmp_path):
+    with pytest.raises(FetchError, match="Size mismatch"):
+        fetch_segmented(url(server), str(tmp_path / "a.mp3"), "page", expected_size=SIZE + 1,
+                        segment_size=SEGMENT)
+
+def test_resumable_continues_from_the_part_file(server, tmp_path):
+    dest = str(tmp_path / "a.mp3")
+    should_stop, on_bytes = stop_after(SIZE // 2)
+    with pytest.raises(FetchCancelled):
+        fetch_resumable(url(server), dest, "page", on_bytes=on_bytes, should_stop=should_stop)
+    kept = os.path.getsize(dest + ".part")
+    assert 0 < kept < SIZE
+
+    server.reset_counters()
+    fetch_resumable(url(server), dest, "page")
+    with open(dest, "rb") as f:
+        assert f.read() == server.media
+    assert [r for _, r in server.log] == [f"bytes={kept}-"]
+
+def test_resumable_starts_over_when_the_remote_file_changed(server, tmp_path):
+    dest = str(tmp_path / "a.mp3")
+    should_stop, on_bytes = stop_after(SIZE // 2)
+    with pytest.raises(FetchCancelled):
+        fetch_resumable(url(server), dest, "page", on_bytes=on_bytes, should_stop=should_stop)
+    server.set_media(media(11))
+
+    fetch_resumable(url(server), dest, "page")
+    with open(dest, "rb") as f:
+        assert f.read() == server.media
@@ -0,0 +1,186 @@
+"""
+Spotify listing and source matching, offline: a local stub of the Web API
+and a stub search function stand in for Spotify and YouTube.
+"""
+import asyncio
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.archive import DownloadArchive
+from src.cache import MetadataCache
+from src.core import Downloader, SPOTIFY_PLACEHOLDER
+from src.jobs import JobStore
+from src.spotify import SpotifyClient, TrackMatcher, parse_spotify_url
+
+def api_track(n, artists=("Artist",), duration_ms=200_000):
+    return {"id": f"t{n}", "name": f"Song {n}", "artists": [{"name": a} for a in artists], "duration_ms": duration_ms}
+
+class StubSpotify:
+    """
+    /token plus the track, album and playlist endpoints, with the playlist
+    split in pages of two like the real API's `next` links.
+    """
+    def __init__(self):
+        self.token_requests = 0
+        self.requests = []
+        playlist = [{"track": api_track(n)} for n in range(1, 6)]
+        playlist.insert(2, {"track": None}) # Removed track
+        playlist.insert(4, {"track": {"id": None, "name": "Local file"}}) # Local file, no id
+        self.playlist = playlist
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def _page(self, offset):
+        items = self.playlist[offset:offset + 2]
+        more = offset + 2 < len(self.playlist)
+        return {"items": items, "next": f"{self.base}/v1/playlists/p1/tracks?offset={offset + 2}" if more else None}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _json(self, payload, status=200):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                stub.token_requests += 1
+                self._json({"access_token": "stub-token", "expires_in": 3600})
+
+            def do_GET(self):
+                if self.headers.get("Authorization") != "Bearer stub-token":
+                    self._json({"error": "unauthorized"}, 401)
+                    return
+                stub.requests.append(self.path)
+                if self.path == "/v1/tracks/t9":
+                    self._json(api_track(9, ("A", "B")))
+                elif self.path == "/v1/albums/a1":
+                    self._json({"tracks": {"items": [api_track(1), api_track(2)], "next": None}})
+                elif self.path == "/v1/playlists/p1":
+                    self._json({"tracks": stub._page(0)})
+                elif re.fullmatch(r"/v1/playlists/p1/tracks\?offset=\d+", self.path):
+                    self._json(stub._page(int(self.path.rsplit("=", 1)[1])))
+                else:
+                    self._json({"error": "not found"}, 404)
+
+        return Handler
+
+@pytest.fixture
+def spotify():
+    stub = StubSpotify()
+    thread = threading.Thread(target=stub.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.httpd.shutdown()
+    stub.httpd.server_close()
+
+@pytest.fixture
+def client(spotify):
+    return SpotifyClient("id", "secret", api_base=f"{spotify.base}/v1", auth_url=f"{spotify.base}/token")
+
+def stub_search(calls):
+    def search(query, duration):
+        calls.append((query, duration))
+        if "Song 3" in query:
+            return None # No match
+        if "Song 4" in query:
+            raise RuntimeError("search backend down")
+        n = re.search(r"Song (\d+)", query).group(1)
+        return {"url": f"https://www.youtube.com/watch?v=vid{n}", "source_id": f"youtube:vid{n}"}
+    return search
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://open.spotify.com/track/abc123?si=x", ("track", "abc123")),
+    ("https://open.spotify.com/intl-de/album/XYZ", ("album", "XYZ")),
+    ("spotify:playlist:37i9dQ", ("playlist", "37i9dQ")),
+])
+def test_parse_spotify_url(url, expected):
+    assert parse_spotify_url(url) == expected
+
+def test_parse_spotify_url_rejects_other_urls():
+    with pytest.raises(ValueError):
+        parse_spotify_url("https://open.spotify.com/artist/abc")
+
+def test_playlist_follows_pages_and_skips_unplayable(client, spotify):
+    tracks = client.get_tracks("https://open.spotify.com/playlist/p1")
+    assert [t["id"] for t in tracks] == ["t1", "t2", "t3", "t4", "t5"]
+    assert tracks[0] == {"id": "t1", "title": "Song 1", "artist": "Artist", "duration": 200}
+    assert len(spotify.requests) == 4 # The playlist plus three more pages
+    assert spotify.token_requests == 1 # One token for every call
+
+def test_track_and_album(client):
+    assert client.get_tracks("spotify:track:t9") == [{"id": "t9", "title": "Song 9", "artist": "A, B", "duration": 200}]
+    assert [t["id"] for t in client.get_tracks("https://open.spotify.com/album/a1")] == ["t1", "t2"]
+
+def test_matcher_queries_and_keeps_order(client):
+    calls = []
+    matcher = TrackMatcher(search=stub_search(calls), concurrency=2, batch_size=2)
+    items = client.get_tracks("https://open.spotify.com/playlist/p1")
+    matches = asyncio.run(matcher.match_all(items))
+    assert [m and m["source_id"] for m in matches] == ["youtube:vid1", "youtube:vid2", None, None, "youtube:vid5"]
+    assert sorted(calls) == [(f"Artist - Song {n}", 200) for n in range(1, 6)]
+
+def test_matcher_limits_concurrency():
+    running, peak = [0], [0]
+    lock = threading.Lock()
+    def search(query, duration):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        threading.Event().wait(0.02)
+        with lock:
+            running[0] -= 1
+        return {"url": "u", "source_id": f"youtube:{query}"}
+    items = [{"id": f"t{n}", "title": f"Song {n}", "artist": "A", "duration": 1} for n in range(12)]
+    asyncio.run(TrackMatcher(search=search, concurrency=3).match_all(items))
+    assert peak[0] <= 3
+
+def test_matches_are_cached(tmp_path, client):
+    cache = MetadataCache(str(tmp_path / "metadata.db"))
+    items = client.get_tracks("https://open.spotify.com/playlist/p1")
+    first = []
+    asyncio.run(TrackMatcher(search=stub_search(first), cache=cache).match_all(items))
+    again = []
+    matches = asyncio.run(TrackMatcher(search=stub_search(again), cache=cache).match_all(items))
+    # Only the tracks that found nothing are searched again
+    assert sorted(q for q, _ in again) == ["Artist - Song 3", "Artist - Song 4"]
+    assert matches[0]["source_id"] == "youtube:vid1"
+
+@pytest.fixture
+def downloader(tmp_path, client):
+    return Downloader(
+        engine="inprocess",
+        spotify_client=client,
+        track_matcher=TrackMatcher(search=stub_search([])),
+        metadata_cache=MetadataCache(str(tmp_path / "metadata.db")),
+        archive=DownloadArchive(str(tmp_path / "archive.db")),
+        job_store=JobStore(str(tmp_path / "jobs.db")),
+    )
+
+def test_spotify_metadata_through_downloader(downloader):
+    tracks = asyncio.run(downloader.get_metadata("https://open.spotify.com/playlist/p1"))
+    # Unmatched tracks are dropped; indices follow the Spotify listing
+    assert [(t.index, t.title, t.url) for t in tracks] == [
+        (1, "Song 1", "https://www.youtube.com/watch?v=vid1"),
+        (2, "Song 2", "https://www.youtube.com/watch?v=vid2"),
+        (5, "Song 5", "https://www.youtube.com/watch?v=vid5"),
+    ]
+    assert tracks[0].source_id == "spotify:t1"
+
+def test_unreachable_api_falls_back_to_spotdl(downloader, spotify):
+    downloader.spotify_client = SpotifyClient("id", "secret", api_base=f"{spotify.base}/missing",
+                                              auth_url=f"{spotify.base}/token")
+    tracks = asyncio.run(downloader.get_metadata("https://open.spotify.com/playlist/p1"))
+    assert len(tracks) == 1 and tracks[0].title == SPOTIFY_PLACEHOLDER